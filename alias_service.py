@@ -40,13 +40,7 @@ def get_alias_to_id_map_in_list_format(dao, aliases):
 
 
 def get_player_suggestions_from_player_aliases(dao, aliases):
-    alias_to_suggestion_map = {}
-
-    for alias in aliases:
-        alias_to_suggestion_map[
-            alias] = dao.get_players_with_similar_alias(alias)
-
-    return alias_to_suggestion_map
+    return dao.get_players_with_similar_aliases(aliases)
 
 # return a map from alias -> {"player": Player with matches,
 # "suggestions": list of Players}
@@ -54,11 +48,13 @@ def get_player_suggestions_from_player_aliases(dao, aliases):
 
 def get_player_or_suggestions_from_player_aliases(dao, aliases):
     alias_to_player_or_suggestions_map = {}
+    players = dao.get_players_by_aliases(aliases)
+    suggestions = dao.get_players_with_similar_aliases(aliases)
 
     for alias in aliases:
         alias_to_player_or_suggestions_map[alias] = {
-            "player": dao.get_player_by_alias(alias),
-            "suggestions": dao.get_players_with_similar_alias(alias)
+            "player": players[alias],
+            "suggestions": suggestions[alias]
         }
 
     return alias_to_player_or_suggestions_map
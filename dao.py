@@ -1,19 +1,48 @@
+from bson.objectid import ObjectId
 from datetime import timedelta
 
 import base64
+import difflib
 import hashlib
 import os
 import pymongo
 import re
+import threading
+import time
+import traceback
 
 from config.config import Config
 
 import model as M
+import player_search
 
 config = Config()
 
 ITERATION_COUNT = 100000
 
+# max number of ids we put in a single $in query
+ID_BATCH_SIZE = 1000
+
+# documents fetched per round trip by the iter_* methods, which is also
+# about how many raw documents they hold in memory at a time
+ITER_BATCH_SIZE = 100
+
+# times a compare-and-set match update is retried before giving up
+MATCH_UPDATE_ATTEMPTS = 5
+
+# seconds the region list is cached for. writes through the Dao invalidate
+# the cache right away, this only bounds how long writes from other
+# processes (e.g. scripts) take to show up
+REGION_CACHE_TTL = 60
+
+# seconds the player search index is kept before it's rebuilt in the
+# background. like the region cache, writes through the Dao update it right away
+PLAYER_SEARCH_INDEX_TTL = 60
+
+# rankings are stored as deltas against a full snapshot; a new snapshot is
+# taken every RANKING_SNAPSHOT_INTERVAL rankings
+RANKING_SNAPSHOT_INTERVAL = 10
+
 DATABASE_NAME = config.get_db_name()
 
 special_chars = re.compile("[^\w\s]*")
@@ -60,6 +89,117 @@ def verify_password(password, salt, hashed_password):
     return (the_hash and the_hash == hashed_password)
 
 
+def _get_similar_aliases(alias):
+    '''Lowercase variations of alias (without crew tags, pool prefixes etc.)
+    to look for when matching an alias to players.'''
+    alias_lower = alias.lower()
+
+    # here be regex dragons
+    re_test_1 = '([1-9]+\s+[1-9]+\s+)(.+)'  # to match '1 1 slox'
+    re_test_2 = '(.[1-9]+.[1-9]+\s+)(.+)'  # to match 'p1s1 slox'
+
+    alias_set_1 = re.split(re_test_1, alias_lower)
+    alias_set_2 = re.split(re_test_2, alias_lower)
+
+    similar_aliases = [
+        alias_lower,
+        alias_lower.replace(" ", ""),  # remove spaces
+        # remove special characters
+        re.sub(special_chars, '', alias_lower),
+        # remove everything before the last special character; hopefully
+        # removes crew/sponsor tags
+        re.split(special_chars, alias_lower)[-1].strip()
+    ]
+
+    # regex nonsense to deal with pool prefixes
+    # prevent index OOB errors when dealing with tags that don't split well
+    if len(alias_set_1) == 4:
+        similar_aliases.append(alias_set_1[2].strip())
+    if len(alias_set_2) == 4:
+        similar_aliases.append(alias_set_2[2].strip())
+
+    # add suffixes of the string
+    alias_words = alias_lower.split()
+    similar_aliases.extend([' '.join(alias_words[i:])
+                            for i in xrange(len(alias_words))])
+
+    # uniqify
+    return list(set(similar_aliases))
+
+
+def _apply_player_search_updates(index, players, removed_ids):
+    for player_id in removed_ids:
+        index.remove(player_id)
+    for player in players:
+        if player.merged:
+            index.remove(player.id)
+        else:
+            index.add(player)
+
+
+def _is_ranked_in_order(entry_dicts):
+    return all(entry_dict['rank'] == rank for rank, entry_dict in enumerate(entry_dicts, 1))
+
+
+def _ranking_delta(ranking_dict, base_dict):
+    '''ranking_dict stored as a delta against base_dict, see
+    Dao.insert_ranking.'''
+    tournaments = ranking_dict['tournaments']
+    base_tournaments = base_dict['tournaments']
+    num_base_tournaments = 0
+    while num_base_tournaments < min(len(tournaments), len(base_tournaments)) and \
+            tournaments[num_base_tournaments] == base_tournaments[num_base_tournaments]:
+        num_base_tournaments += 1
+
+    base_order = [entry_dict['player'] for entry_dict in base_dict['ranking']]
+    order_ids = [entry_dict['player'] for entry_dict in ranking_dict['ranking']]
+    order = []
+    matcher = difflib.SequenceMatcher(None, base_order, order_ids, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            order.append([i1, i2])
+        elif tag != 'delete':
+            order.extend(order_ids[j1:j2])
+
+    base_entries = {entry_dict['player']: entry_dict for entry_dict in base_dict['ranking']}
+    changed_entries = []
+    for entry_dict in ranking_dict['ranking']:
+        base_entry_dict = base_entries.get(entry_dict['player'])
+        if base_entry_dict is None or \
+                base_entry_dict.get('rating') != entry_dict.get('rating') or \
+                base_entry_dict.get('previous_rank') != entry_dict.get('previous_rank'):
+            changed_entries.append({key: value for key, value in entry_dict.iteritems()
+                                    if key != 'rank'})
+
+    return dict(ranking_dict,
+                base=base_dict['_id'],
+                base_tournaments=num_base_tournaments,
+                tournaments=tournaments[num_base_tournaments:],
+                order=order,
+                ranking=changed_entries)
+
+
+def _expand_ranking_delta(ranking_dict, base_dict):
+    '''The full ranking dict of a delta stored by _ranking_delta.'''
+    base_order = [entry_dict['player'] for entry_dict in base_dict['ranking']]
+    order = []
+    for item in ranking_dict['order']:
+        if isinstance(item, list):
+            order.extend(base_order[item[0]:item[1]])
+        else:
+            order.append(item)
+
+    entries = {entry_dict['player']: entry_dict for entry_dict in base_dict['ranking']}
+    entries.update((entry_dict['player'], entry_dict) for entry_dict in ranking_dict['ranking'])
+    expanded = {key: value for key, value in ranking_dict.iteritems()
+                if key not in ('base', 'base_tournaments', 'order')}
+    expanded['tournaments'] = base_dict['tournaments'][:ranking_dict.get('base_tournaments', 0)] + \
+        ranking_dict['tournaments']
+    expanded['ranking'] = [dict(entries[player_id], rank=rank)
+                           for rank, player_id in enumerate(order, 1)]
+    return expanded
+
+
 # TODO create RegionSpecificDao object rn we pass in norcal for a buncha
 # things we dont need to
 class Dao(object):
@@ -67,9 +207,7 @@ class Dao(object):
     # here lies some serious abuse of magic methods, here be dragons
     # use __new__ so that we can return None
     def __new__(cls, region_id, mongo_client, database_name=DATABASE_NAME):
-        all_region_ids = [r.id for r in Dao.get_all_regions(
-            mongo_client, database_name=database_name)]
-        if region_id and region_id not in all_region_ids:
+        if region_id and region_id not in Dao._get_cached_regions(mongo_client, database_name):
             return None
         # this is how we call __init__
         return super(Dao, cls).__new__(cls, region_id, mongo_client, database_name)
@@ -80,6 +218,16 @@ class Dao(object):
             database_name][M.Tournament.collection_name]
         self.rankings_col = mongo_client[
             database_name][M.Ranking.collection_name]
+        self.ranking_checkpoints_col = mongo_client[
+            database_name][M.RankingCheckpoint.collection_name]
+        self.ranking_jobs_col = mongo_client[
+            database_name][M.RankingJob.collection_name]
+        self.ranking_views_col = mongo_client[
+            database_name][M.RankingView.collection_name]
+        self.rating_history_col = mongo_client[
+            database_name][M.RatingHistory.collection_name]
+        self.player_matches_col = mongo_client[
+            database_name][M.PlayerMatch.collection_name]
         self.users_col = mongo_client[database_name][M.User.collection_name]
         self.pending_tournaments_col = mongo_client[
             database_name][M.PendingTournament.collection_name]
@@ -88,22 +236,164 @@ class Dao(object):
         self.raw_files_col = mongo_client[database_name][M.RawFile.collection_name]
         self.regions_col = mongo_client[database_name][M.Region.collection_name]
         self.mongo_client = mongo_client
+        self.database_name = database_name
         self.region_id = region_id
 
+        # player id -> Player (None if there's no such player) for players
+        # loaded through this Dao. a Dao lives for one request, so this saves
+        # loading the same player over and over while rendering a response.
+        # player writes through this Dao drop the written ids.
+        self.player_cache = {}
+
+    # (id of mongo client, database name) -> (mongo client, expiry time,
+    # region id -> region db dict)
+    _region_cache = {}
+
+    @classmethod
+    def _get_cached_regions(cls, mongo_client, database_name):
+        key = (id(mongo_client), database_name)
+        now = time.time()
+        entry = cls._region_cache.get(key)
+        if entry is not None and entry[0] is mongo_client and entry[1] > now:
+            return entry[2]
+
+        # drop expired entries so we don't hold on to old clients
+        for other_key, other_entry in cls._region_cache.items():
+            if other_entry[1] <= now:
+                cls._region_cache.pop(other_key, None)
+
+        regions = {r['_id']: r for r in mongo_client[
+            database_name][M.Region.collection_name].find()}
+        cls._region_cache[key] = (mongo_client, now + REGION_CACHE_TTL, regions)
+        return regions
+
+    @classmethod
+    def invalidate_region_cache(cls, mongo_client, database_name=DATABASE_NAME):
+        cls._region_cache.pop((id(mongo_client), database_name), None)
+
     @classmethod
     def insert_region(cls, region, mongo_client, database_name=DATABASE_NAME):
-        return mongo_client[database_name][M.Region.collection_name].insert(region.dump(context='db'))
+        try:
+            return mongo_client[database_name][M.Region.collection_name].insert(region.dump(context='db'))
+        finally:
+            cls.invalidate_region_cache(mongo_client, database_name)
+
+    # (id of mongo client, database name) -> (mongo client, expiry time,
+    # PlayerSearchIndex of unmerged players in all regions)
+    _player_search_cache = {}
+    # key of _player_search_cache -> player updates made while its index is
+    # rebuilt in the background, replayed onto the new index
+    _player_search_rebuilds = {}
+    _player_search_lock = threading.Lock()
+
+    def get_player_search_index(self):
+        '''Builds the index on first use. Once it expires, it's rebuilt in a
+        background thread and the old one is returned until that's done.'''
+        key = (id(self.mongo_client), self.database_name)
+        entry = Dao._player_search_cache.get(key)
+        if entry is not None and entry[0] is self.mongo_client:
+            if entry[1] <= time.time():
+                self._start_player_search_rebuild(key)
+            return entry[2]
+
+        with Dao._player_search_lock:
+            # another thread may have built it while we waited
+            entry = Dao._player_search_cache.get(key)
+            if entry is not None and entry[0] is self.mongo_client:
+                return entry[2]
+
+            # drop expired entries so we don't hold on to old clients
+            now = time.time()
+            for other_key, other_entry in Dao._player_search_cache.items():
+                if other_entry[1] <= now and other_key not in Dao._player_search_rebuilds:
+                    Dao._player_search_cache.pop(other_key, None)
+
+            index = player_search.PlayerSearchIndex(self.get_all_players(all_regions=True))
+            Dao._player_search_cache[key] = (self.mongo_client, now + PLAYER_SEARCH_INDEX_TTL, index)
+            return index
+
+    def _start_player_search_rebuild(self, key):
+        with Dao._player_search_lock:
+            if key in Dao._player_search_rebuilds:
+                return
+            Dao._player_search_rebuilds[key] = []
+        thread = threading.Thread(target=self._rebuild_player_search_index, args=(key,))
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild_player_search_index(self, key):
+        index = None
+        try:
+            # a Dao of our own, since this one is still used by its request
+            dao = Dao(None, self.mongo_client, database_name=self.database_name)
+            index = player_search.PlayerSearchIndex(dao.get_all_players(all_regions=True))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with Dao._player_search_lock:
+                updates = Dao._player_search_rebuilds.pop(key)
+                # on failure keep the old index, the next search retries
+                if index is not None:
+                    for players, removed_ids in updates:
+                        _apply_player_search_updates(index, players, removed_ids)
+                    Dao._player_search_cache[key] = (
+                        self.mongo_client, time.time() + PLAYER_SEARCH_INDEX_TTL, index)
+
+    def _update_player_search_index(self, players=(), removed_ids=()):
+        # copy so later changes to the caller's players don't leak in
+        players = [M.Player.load(player.dump(context='db'), context='db', trusted=True)
+                   for player in players]
+        key = (id(self.mongo_client), self.database_name)
+        with Dao._player_search_lock:
+            entry = Dao._player_search_cache.get(key)
+            if entry is None or entry[0] is not self.mongo_client:
+                return
+            updates = Dao._player_search_rebuilds.get(key)
+            if updates is not None:
+                updates.append((players, removed_ids))
+        _apply_player_search_updates(entry[2], players, removed_ids)
+
+    def search_players(self, query, limit=None):
+        '''Unmerged players in all regions matching query, see
+        PlayerSearchIndex.search.'''
+        return self.get_player_search_index().search(query, limit=limit)
 
     # sorted by display name
     @classmethod
     def get_all_regions(cls, mongo_client, database_name=DATABASE_NAME):
-        regions = [M.Region.load(r, context='db') for r in mongo_client[
-            database_name][M.Region.collection_name].find()]
+        regions = [M.Region.load(r, context='db', trusted=True) for r in
+                   cls._get_cached_regions(mongo_client, database_name).values()]
         return sorted(regions, key=lambda r: r.display_name)
 
     def get_player_by_id(self, id):
         '''id must be an ObjectId'''
-        return M.Player.load(self.players_col.find_one({'_id': id}), context='db')
+        if id not in self.player_cache:
+            self.player_cache[id] = M.Player.load(self.players_col.find_one({'_id': id}), context='db', trusted=True)
+        return self.player_cache[id]
+
+    def get_players_by_ids(self, ids):
+        '''ids must be ObjectIds. Returns a dict from id to Player, ids that
+        don't exist are left out. Players that aren't cached yet are loaded
+        with one query per ID_BATCH_SIZE ids.'''
+        self.prefetch_players(ids)
+        players = {}
+        for id in ids:
+            player = self.player_cache[id]
+            if player is not None:
+                players[id] = player
+        return players
+
+    def prefetch_players(self, ids):
+        '''Loads the players with the given ids that aren't cached yet, so
+        that following get_player_by_id calls don't hit the db.'''
+        missing_ids = list(set(id for id in ids if id not in self.player_cache))
+        for i in xrange(0, len(missing_ids), ID_BATCH_SIZE):
+            batch = missing_ids[i:i + ID_BATCH_SIZE]
+            for id in batch:
+                self.player_cache[id] = None
+            for p in self.players_col.find({'_id': {'$in': batch}}):
+                player = M.Player.load(p, context='db', trusted=True)
+                self.player_cache[player.id] = player
 
     def get_player_by_alias(self, alias):
         '''Converts alias to lowercase'''
@@ -111,11 +401,36 @@ class Dao(object):
             'aliases': {'$in': [alias.lower()]},
             'regions': {'$in': [self.region_id]},
             'merged': False
-        }), context='db')
+        }), context='db', trusted=True)
+
+    def get_players_by_aliases(self, aliases):
+        '''get_player_by_alias for many aliases at once, with one query per
+        ID_BATCH_SIZE aliases. Returns a dict from alias to Player (None if
+        no player has the alias).'''
+        # lowercase alias -> aliases
+        alias_map = {}
+        for alias in aliases:
+            alias_map.setdefault(alias.lower(), []).append(alias)
+
+        players = {alias: None for alias in aliases}
+        lower_aliases = alias_map.keys()
+        for i in xrange(0, len(lower_aliases), ID_BATCH_SIZE):
+            batch = lower_aliases[i:i + ID_BATCH_SIZE]
+            for p in self.players_col.find({
+                    'aliases': {'$in': batch},
+                    'regions': {'$in': [self.region_id]},
+                    'merged': False}):
+                player = M.Player.load(p, context='db', trusted=True)
+                for player_alias in player.aliases:
+                    for alias in alias_map.get(player_alias, ()):
+                        # like find_one, the first match wins
+                        if players[alias] is None:
+                            players[alias] = player
+        return players
 
     def get_players_by_alias_from_all_regions(self, alias):
         '''Converts alias to lowercase'''
-        return [M.Player.load(p, context='db') for p in self.players_col.find({
+        return [M.Player.load(p, context='db', trusted=True) for p in self.players_col.find({
             'aliases': {'$in': [alias.lower()]},
             'merged': False
         })]
@@ -124,10 +439,11 @@ class Dao(object):
         '''Given a list of player aliases, returns a list of player aliases/id pairs for the current
         region. If no player can be found, the player id field will be set to None.'''
         player_alias_to_player_id_map = []
+        players = self.get_players_by_aliases(aliases)
 
         for alias in aliases:
             id = None
-            player = self.get_player_by_alias(alias)
+            player = players[alias]
             if player is not None:
                 id = player.id
 
@@ -138,31 +454,76 @@ class Dao(object):
 
         return player_alias_to_player_id_map
 
-    def get_all_players(self, all_regions=False, include_merged=False):
-        '''Sorts by name in lexographical order.'''
+    def get_all_players(self, all_regions=False, include_merged=False,
+                        exclude=None, only=None, limit=None, after=None):
+        '''Sorts by name in lexographical order. exclude/only limit the fields
+        loaded (see Document.projection), limit/after page through the
+        players (see _find_page).'''
+        return list(self.iter_players(all_regions=all_regions, include_merged=include_merged,
+                                      exclude=exclude, only=only, limit=limit, after=after))
+
+    def iter_players(self, all_regions=False, include_merged=False,
+                     exclude=None, only=None, limit=None, after=None,
+                     batch_size=ITER_BATCH_SIZE):
+        '''Like get_all_players, but loads the players batch_size at a time
+        as they're iterated over.'''
         mongo_request = {}
         if not all_regions:
             mongo_request['regions'] = {'$in': [self.region_id]}
         if not include_merged:
             mongo_request['merged'] = False
-        return [M.Player.load(p, context='db')
-                for p in self.players_col.find(mongo_request).sort([('name', 1)])]
+        projection = M.Player.projection('db', exclude=exclude, only=only)
+        # players missing fields aren't trusted, dumping them validates them
+        # in full
+        for p in self._find_page(self.players_col, mongo_request, 'name', projection,
+                                 limit=limit, after=after, batch_size=batch_size):
+            yield M.Player.load(p, context='db', validate_on_load=False,
+                                trusted=projection is None)
 
     def insert_player(self, player):
-        return self.players_col.insert(player.dump(context='db'))
+        self.player_cache.pop(player.id, None)
+        result = self.players_col.insert(player.dump(context='db'))
+        self._update_player_search_index([player])
+        return result
 
     def delete_player(self, player):
-        return self.players_col.remove({'_id': player.id})
+        self.player_cache.pop(player.id, None)
+        result = self.players_col.remove({'_id': player.id})
+        self._update_player_search_index(removed_ids=[player.id])
+        for view_dict in self.ranking_views_col.find({'entries.player': player.id}, {'_id': 1}):
+            self.refresh_ranking_view(view_dict['_id'])
+        return result
 
     def update_player(self, player):
-        return self.players_col.update({'_id': player.id}, player.dump(context='db'))
+        self.player_cache.pop(player.id, None)
+        result = self.players_col.update({'_id': player.id}, player.dump(context='db'))
+        self._update_player_search_index([player])
+        # keep the name in ranking views in sync (renames and merges both
+        # write players through here)
+        self.ranking_views_col.update(
+            {'entries': {'$elemMatch': {'player': player.id, 'name': {'$ne': player.name}}}},
+            {'$set': {'entries.$.name': player.name, 'etag': str(ObjectId())}},
+            multi=True)
+        return result
 
     def update_region(self, region):
-        return self.regions_col.update({'_id': region.id}, region.dump(context='db'))
+        try:
+            return self.regions_col.update({'_id': region.id}, region.dump(context='db'))
+        finally:
+            Dao.invalidate_region_cache(self.mongo_client, self.database_name)
 
-    # TODO bulk update
     def update_players(self, players):
-        pass
+        '''Writes the ratings of all players in one bulk operation.'''
+        if not players:
+            return None
+        bulk = self.players_col.initialize_unordered_bulk_op()
+        for player in players:
+            self.player_cache.pop(player.id, None)
+            bulk.find({'_id': player.id}).update_one(
+                {'$set': player.dump(context='db', only=('ratings',))})
+        result = bulk.execute()
+        self._update_player_search_index(players)
+        return result
 
     # unused, if you use this, make sure to surround it in a try block!
     def add_alias_to_player(self, player, alias):
@@ -202,6 +563,11 @@ class Dao(object):
 
     def get_all_pending_tournaments(self, regions=None):
         '''players is a list of Players'''
+        return list(self.iter_pending_tournaments(regions=regions))
+
+    def iter_pending_tournaments(self, regions=None, batch_size=ITER_BATCH_SIZE):
+        '''Like get_all_pending_tournaments, but loads the pending
+        tournaments batch_size at a time as they're iterated over.'''
         query_dict = {}
         query_list = []
 
@@ -211,26 +577,134 @@ class Dao(object):
         if query_list:
             query_dict['$and'] = query_list
 
-        pending_tournaments = [t for t in self.pending_tournaments_col.find(
-            query_dict).sort([('date', 1)])]
-
-        return [M.PendingTournament.load(t, context='db') for t in pending_tournaments]
+        for t in self.pending_tournaments_col.find(query_dict).sort([('date', 1)]).batch_size(batch_size):
+            yield M.PendingTournament.load(t, context='db', trusted=True)
 
     def get_pending_tournament_by_id(self, id):
         '''id must be an ObjectId'''
         return M.PendingTournament.load(self.pending_tournaments_col.find_one({'_id': id}),
-                                        context='db')
+                                        context='db', trusted=True)
 
     def insert_tournament(self, tournament):
-        return self.tournaments_col.insert(tournament.dump(context='db'))
+        result = self.tournaments_col.insert(tournament.dump(context='db'))
+        self._write_player_matches([tournament])
+        return result
 
     # all uses of this MUST use a try/except block!
     def update_tournament(self, tournament):
-        return self.tournaments_col.update({'_id': tournament.id}, tournament.dump(context='db'))
+        result = self.tournaments_col.update({'_id': tournament.id}, tournament.dump(context='db'))
+        self._write_player_matches([tournament])
+        self._invalidate_ranking_checkpoints([tournament.id])
+        return result
+
+    def update_tournaments(self, tournaments):
+        '''Writes all tournaments in one bulk operation. Tournaments that
+        fail validation are printed and skipped.'''
+        bulk = None
+        written = []
+        for tournament in tournaments:
+            try:
+                tournament_dict = tournament.dump(context='db')
+            except Exception as e:
+                print "error updating tournament", tournament.id
+                print e
+                continue
+            if bulk is None:
+                bulk = self.tournaments_col.initialize_unordered_bulk_op()
+            bulk.find({'_id': tournament.id}).replace_one(tournament_dict)
+            written.append(tournament)
+        if bulk is None:
+            return None
+        result = bulk.execute()
+        self._write_player_matches(written)
+        self._invalidate_ranking_checkpoints([tournament.id for tournament in written])
+        return result
 
     def delete_tournament(self, tournament):
+        self._invalidate_ranking_checkpoints([tournament.id])
+        self.player_matches_col.remove({'tournament': tournament.id})
         return self.tournaments_col.remove({'_id': tournament.id})
 
+    def _write_player_matches(self, tournaments):
+        '''Replaces the player matches of the given tournaments.'''
+        if not tournaments:
+            return
+        self.player_matches_col.remove(
+            {'tournament': {'$in': [tournament.id for tournament in tournaments]}})
+        player_matches = [player_match.dump(context='db')
+                          for tournament in tournaments
+                          for player_match in tournament.get_player_matches()]
+        if player_matches:
+            self.player_matches_col.insert_many(player_matches)
+
+    def rebuild_player_matches(self, missing_only=False):
+        '''Rewrites the player matches of every tournament in every region.
+        With missing_only, only writes those of tournaments that don't have
+        any yet, which makes it safe to rerun. Returns the number of
+        tournaments written.'''
+        if missing_only:
+            written_ids = set(self.player_matches_col.distinct('tournament'))
+        else:
+            written_ids = set()
+            self.player_matches_col.remove()
+
+        missing_ids = [tournament_dict['_id'] for tournament_dict in
+                       self.tournaments_col.find({}, {'_id': 1})
+                       if tournament_dict['_id'] not in written_ids]
+        for i in xrange(0, len(missing_ids), ID_BATCH_SIZE):
+            for tournament_dict in self.tournaments_col.find(
+                    {'_id': {'$in': missing_ids[i:i + ID_BATCH_SIZE]}}):
+                self._write_player_matches(
+                    [M.Tournament.load(tournament_dict, context='db', trusted=True)])
+        return len(missing_ids)
+
+    def get_player_matches(self, player_id, opponent_id=None, limit=None, after=None):
+        '''Matches player_id played (against opponent_id if given), oldest
+        first. For paging, after is the id of the last PlayerMatch of the
+        previous page.'''
+        query_dict = {'player': player_id}
+        if opponent_id is not None:
+            query_dict['opponent'] = opponent_id
+
+        return [M.PlayerMatch.load(m, context='db', trusted=True)
+                for m in self._find_page(self.player_matches_col, query_dict, 'date',
+                                         limit=limit, after=after)]
+
+    def _find_page(self, col, query_dict, sort_field, projection=None, limit=None, after=None,
+                   batch_size=None):
+        '''Cursor over the documents matching query_dict sorted by
+        (sort_field, _id), at most limit of them. after is the _id of the last
+        document of the previous page; returns [] if there's no such
+        document.'''
+        query_dict = dict(query_dict)
+        if after is not None:
+            after_dict = col.find_one({'_id': after}, {sort_field: 1})
+            if after_dict is None:
+                return []
+            after_value = after_dict.get(sort_field)
+            query_dict['$or'] = [{sort_field: {'$gt': after_value}},
+                                 {sort_field: after_value, '_id': {'$gt': after}}]
+
+        cursor = col.find(query_dict, projection).sort([(sort_field, 1), ('_id', 1)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    def get_player_match_record(self, player_id, opponent_id=None):
+        '''(wins, losses) of player_id, not counting excluded matches.'''
+        query_dict = {'player': player_id, 'excluded': False}
+        if opponent_id is not None:
+            query_dict['opponent'] = opponent_id
+        wins = self.player_matches_col.find(dict(query_dict, result='win')).count()
+        losses = self.player_matches_col.find(dict(query_dict, result='lose')).count()
+        return wins, losses
+
+    def player_has_tournaments(self, player_id):
+        '''Whether player_id was in any tournament.'''
+        return self.tournaments_col.find_one({'players': player_id}, {'_id': 1}) is not None
+
     def get_all_tournament_ids(self, players=None, regions=None):
         '''players is a list of Players'''
         query_dict = {}
@@ -248,8 +722,19 @@ class Dao(object):
 
         return [t['_id'] for t in self.tournaments_col.find(query_dict, {'_id': 1}).sort([('date', 1)])]
 
-    def get_all_tournaments(self, players=None, regions=None):
-        '''players is a list of Players'''
+    def get_all_tournaments(self, players=None, regions=None,
+                            exclude=None, only=None, limit=None, after=None):
+        '''players is a list of Players. exclude/only limit the fields loaded
+        (see Document.projection), limit/after page through the tournaments
+        (see _find_page). Matches are only unserialized when a tournament's
+        matches are first read.'''
+        return list(self.iter_tournaments(players=players, regions=regions, exclude=exclude,
+                                          only=only, limit=limit, after=after))
+
+    def iter_tournaments(self, players=None, regions=None, exclude=None, only=None,
+                         limit=None, after=None, batch_size=ITER_BATCH_SIZE):
+        '''Like get_all_tournaments, but loads the tournaments batch_size at
+        a time as they're iterated over.'''
         query_dict = {}
         query_list = []
 
@@ -263,17 +748,20 @@ class Dao(object):
         if query_list:
             query_dict['$and'] = query_list
 
-        tournaments = [t for t in self.tournaments_col.find(
-            query_dict).sort([('date', 1)])]
-
-        return [M.Tournament.load(t, context='db') for t in tournaments]
+        projection = M.Tournament.projection('db', exclude=exclude, only=only)
+        # tournaments missing fields aren't trusted, dumping them validates
+        # them in full
+        for t in self._find_page(self.tournaments_col, query_dict, 'date', projection,
+                                 limit=limit, after=after, batch_size=batch_size):
+            yield M.Tournament.load(t, context='db', validate_on_load=False,
+                                    trusted=projection is None, lazy=True)
 
     def get_tournament_by_id(self, id):
         '''id must be an ObjectId'''
-        return M.Tournament.load(self.tournaments_col.find_one({'_id': id}), context='db')
+        return M.Tournament.load(self.tournaments_col.find_one({'_id': id}), context='db', trusted=True)
 
     def get_match_by_tournament_id_and_match_id(self, tournament_id, match_id):
-        tourney_m = M.Tournament.load(self.tournaments_col.find_one({'_id': tournament_id}, {'matches', 1}), context='db')
+        tourney_m = M.Tournament.load(self.tournaments_col.find_one({'_id': tournament_id}, {'matches': 1}), context='db', validate_on_load=False)
         for match in tourney_m.matches:
             try:
                 if match_id == match.match_id:
@@ -283,105 +771,139 @@ class Dao(object):
 
 
     def set_match_exclusion_by_tournament_id_and_match_id(self, tournament_id, match_id, excluded):
-        # TODO ENHANCE THIS ALGORITHM TO ONLY UPDATE MATCH
-        match_updated = False
-        new_matches = []
-        tourney_m = \
-            M.Tournament.load(self.tournaments_col.find_one({'_id': tournament_id}), context='db')
-
-        for match in tourney_m.matches:
-            try:
-                if match_id == match.match_id:
-                    match.excluded = excluded
-                    match_updated = True
-                new_matches.append(match)
-            except Exception as e:
-                print('Could not attain match. ' + str(e))
-
-        if match_updated is True:
-            tourney_m.matches = new_matches
-            self.tournaments_col.update({'_id': tournament_id}, tourney_m.dump(context='db'))
+        self.tournaments_col.update({'_id': tournament_id, 'matches.match_id': match_id},
+                                    {'$set': {'matches.$.excluded': excluded}})
+        self.player_matches_col.update({'tournament': tournament_id, 'match_id': match_id},
+                                       {'$set': {'excluded': excluded}}, multi=True)
+        self._invalidate_ranking_checkpoints([tournament_id])
+
+    # adding and swapping have to read before writing, so they write with a
+    # compare-and-set on what they read and retry if someone else got there
+    # first
+
+    def _get_num_matches(self, tournament_id):
+        '''Length of the tournament's matches array, found by checking which
+        of its positions exist so the matches themselves are never read
+        (mongomock, which the tests run against, supports neither $slice
+        projections nor $size in aggregations).'''
+        def has_match(position):
+            return self.tournaments_col.find_one(
+                {'_id': tournament_id, 'matches.%d' % position: {'$exists': True}},
+                {'_id': 1}) is not None
+
+        # double until we're past the end, then binary search between the
+        # last position that exists (low - 1) and the first that doesn't
+        low, high = 0, 1
+        while has_match(high - 1):
+            low, high = high, high * 2
+        while low < high - 1:
+            mid = (low + high - 1) // 2
+            if has_match(mid):
+                low = mid + 1
+            else:
+                high = mid + 1
+        return low
 
     def add_match_by_tournament_id(self, tournament_id, winner_id, loser_id):
-        match_updates = False
-        tourney_m = \
-            M.Tournament.load(self.tournaments_col.find_one({'_id':tournament_id}), context='db')
-
-        new_match_id = len(tourney_m.matches)
-        new_match = M.Match(match_id=new_match_id, winner=winner_id, loser=loser_id, excluded=False)
-
-        tourney_m.matches.append(new_match)
-
-        if winner_id not in tourney_m.players:
-            tourney_m.players.append(winner_id)
-        if loser_id not in tourney_m.players:
-            tourney_m.players.append(loser_id)
-
-        self.tournaments_col.update({'_id': tournament_id}, tourney_m.dump(context='db'))
-
+        if winner_id == loser_id:
+            raise ValueError("a player can't play themself")
+
+        for _ in xrange(MATCH_UPDATE_ATTEMPTS):
+            new_match_id = self._get_num_matches(tournament_id)
+            tournament = self.tournaments_col.find_one(
+                {'_id': tournament_id}, {'players': 1, 'name': 1, 'date': 1})
+            if tournament is None:
+                raise ValueError("tournament not found")
+
+            new_match = M.Match(match_id=new_match_id, winner=winner_id, loser=loser_id, excluded=False)
+            new_player_ids = [player_id for player_id in (winner_id, loser_id)
+                              if player_id not in tournament['players']]
+
+            # new players are their own original ids
+            result = self.tournaments_col.update(
+                {'_id': tournament_id,
+                 'matches.%d' % new_match_id: {'$exists': False},
+                 'players': {'$nin': new_player_ids}},
+                {'$push': {'matches': new_match.dump(context='db'),
+                           'players': {'$each': new_player_ids},
+                           'orig_ids': {'$each': new_player_ids}}})
+            if result['n']:
+                self.player_matches_col.insert_many(
+                    [player_match.dump(context='db') for player_match in M.PlayerMatch.from_match(
+                        new_match, tournament_id, tournament.get('name'), tournament.get('date'))])
+                self._invalidate_ranking_checkpoints([tournament_id])
+                return
+
+        raise Exception("tournament kept changing while adding match")
 
     def swap_winner_loser_by_tournament_id_and_match_id(self, tournament_id, match_id):
-        new_matches = []
-        tourney_m = \
-            M.Tournament.load(self.tournaments_col.find_one({'_id': tournament_id}), context='db')
-
-        for match in tourney_m.matches:
-            try:
-                if match_id == match.match_id:
-                    winner_holder = match.winner
-                    match.winner = match.loser
-                    match.loser = winner_holder
-                    match_updated = True
-                new_matches.append(match)
-            except Exception as e:
-                raise Exception('Could not attain match. ' + str(e))
-
-        if match_updated is True:
-            tourney_m.matches = new_matches
-            self.tournaments_col.update({'_id': tournament_id}, tourney_m.dump(context='db'))
+        for _ in xrange(MATCH_UPDATE_ATTEMPTS):
+            tournament = self.tournaments_col.find_one(
+                {'_id': tournament_id}, {'matches': {'$elemMatch': {'match_id': match_id}}})
+            if tournament is None or not tournament.get('matches'):
+                raise ValueError("match not found")
+
+            winner_id = tournament['matches'][0]['winner']
+            loser_id = tournament['matches'][0]['loser']
+            result = self.tournaments_col.update(
+                {'_id': tournament_id,
+                 'matches': {'$elemMatch': {'match_id': match_id,
+                                            'winner': winner_id,
+                                            'loser': loser_id}}},
+                {'$set': {'matches.$.winner': loser_id,
+                          'matches.$.loser': winner_id}})
+            if result['n']:
+                # the rows keep their ids, only whose win it was changes
+                for player_id, player_result in ((winner_id, 'lose'), (loser_id, 'win')):
+                    self.player_matches_col.update(
+                        {'tournament': tournament_id, 'match_id': match_id, 'player': player_id},
+                        {'$set': {'result': player_result}})
+                self._invalidate_ranking_checkpoints([tournament_id])
+                return
+
+        raise Exception("match kept changing while swapping winner and loser")
 
     # gets potential merge targets from all regions
     # basically, get players who have an alias similar to the given alias
     def get_players_with_similar_alias(self, alias):
-        alias_lower = alias.lower()
-
-        # here be regex dragons
-        re_test_1 = '([1-9]+\s+[1-9]+\s+)(.+)'  # to match '1 1 slox'
-        re_test_2 = '(.[1-9]+.[1-9]+\s+)(.+)'  # to match 'p1s1 slox'
-
-        alias_set_1 = re.split(re_test_1, alias_lower)
-        alias_set_2 = re.split(re_test_2, alias_lower)
-
-        similar_aliases = [
-            alias_lower,
-            alias_lower.replace(" ", ""),  # remove spaces
-            # remove special characters
-            re.sub(special_chars, '', alias_lower),
-            # remove everything before the last special character; hopefully
-            # removes crew/sponsor tags
-            re.split(special_chars, alias_lower)[-1].strip()
-        ]
-
-        # regex nonsense to deal with pool prefixes
-        # prevent index OOB errors when dealing with tags that don't split well
-        if len(alias_set_1) == 4:
-            similar_aliases.append(alias_set_1[2].strip())
-        if len(alias_set_2) == 4:
-            similar_aliases.append(alias_set_2[2].strip())
-
-        # add suffixes of the string
-        alias_words = alias_lower.split()
-        similar_aliases.extend([' '.join(alias_words[i:])
-                                for i in xrange(len(alias_words))])
-
-        # uniqify
-        similar_aliases = list(set(similar_aliases))
-
+        similar_aliases = _get_similar_aliases(alias)
         ret = self.players_col.find({
             '$or': [
                 {'aliases': {'$in': similar_aliases}, 'merged': False},
                 {'name': {'$in': similar_aliases}, 'merged': False}]})
-        return [M.Player.load(p, context='db') for p in ret]
+        return [M.Player.load(p, context='db', trusted=True) for p in ret]
+
+    def get_players_with_similar_aliases(self, aliases):
+        '''get_players_with_similar_alias for many aliases at once, with one
+        query per ID_BATCH_SIZE similar aliases. Returns a dict from alias to
+        list of Players.'''
+        # similar alias -> aliases it was generated from
+        alias_map = {}
+        for alias in aliases:
+            for similar_alias in _get_similar_aliases(alias):
+                alias_map.setdefault(similar_alias, set()).add(alias)
+
+        similar_players = {alias: [] for alias in aliases}
+        similar_aliases = alias_map.keys()
+        seen_ids = set()
+        for i in xrange(0, len(similar_aliases), ID_BATCH_SIZE):
+            batch = similar_aliases[i:i + ID_BATCH_SIZE]
+            for p in self.players_col.find({
+                    '$or': [
+                        {'aliases': {'$in': batch}, 'merged': False},
+                        {'name': {'$in': batch}, 'merged': False}]}):
+                if p['_id'] in seen_ids:
+                    continue
+                seen_ids.add(p['_id'])
+                player = M.Player.load(p, context='db', trusted=True)
+
+                matching_aliases = set()
+                for key in player.aliases + [player.name]:
+                    matching_aliases.update(alias_map.get(key, ()))
+                for alias in matching_aliases:
+                    similar_players[alias].append(player)
+        return similar_players
+
 
     # inserts and merges players!
     # TODO: add support for pending merges
@@ -391,10 +913,10 @@ class Dao(object):
 
     def get_merge(self, merge_id):
         info = self.merges_col.find_one({'_id': merge_id})
-        return M.Merge.load(info, context='db')
+        return M.Merge.load(info, context='db', trusted=True)
 
     def get_all_merges(self):
-        return [M.Merge.load(m, context='db') for m in self.merges_col.find().sort([('time', 1)])]
+        return [M.Merge.load(m, context='db', trusted=True) for m in self.merges_col.find().sort([('time', 1)])]
 
     def undo_merge(self, the_merge):
         self.unmerge_players(the_merge)
@@ -424,11 +946,8 @@ class Dao(object):
 
         # check if these two players have ever played each other
         # (can't merge players who've played each other)
-        # TODO: reduce db calls for this
-        for tournament_id in self.get_all_tournament_ids():
-            tournament = self.get_tournament_by_id(tournament_id)
-            if source.id in tournament.players and target.id in tournament.players:
-                raise ValueError("source and target have played each other")
+        if self.tournaments_col.find_one({'players': {'$all': [source.id, target.id]}}, {'_id': 1}):
+            raise ValueError("source and target have played each other")
 
         # update target and source players
         target.aliases = list(set(source.aliases + target.aliases))
@@ -444,18 +963,17 @@ class Dao(object):
         self.update_player(source)
         self.update_player(target)
 
-        # replace source with target in all tournaments that contain source
-        # TODO: reduce db calls for this (index tournaments by players)
-        for tournament_id in self.get_all_tournament_ids():
-            tournament = self.get_tournament_by_id(tournament_id)
-            if source.id in tournament.players:
-                try:
-                    tournament.replace_player(
-                        player_to_remove=source, player_to_add=target)
-                    self.update_tournament(tournament)
-                except Exception as e:
-                    print "error replacing source with target in tournament", tournament
-                    print e
+        # replace source with target in all tournaments that contain source,
+        # a batch at a time
+        tournaments = []
+        for tournament in self.iter_tournaments(players=[source]):
+            tournament.replace_player(
+                player_to_remove=source, player_to_add=target)
+            tournaments.append(tournament)
+            if len(tournaments) == ITER_BATCH_SIZE:
+                self.update_tournaments(tournaments)
+                tournaments = []
+        self.update_tournaments(tournaments)
 
     def unmerge_players(self, merge):
         source = self.get_player_by_id(merge.source_player_obj_id)
@@ -480,28 +998,195 @@ class Dao(object):
         self.update_player(source)
         self.update_player(target)
 
-        # unmerge source from target
-        # TODO: reduce db calls for this (index tournaments by players)
-        for tournament_id in self.get_all_tournament_ids():
-            tournament = self.get_tournament_by_id(tournament_id)
-
-            if target.id in tournament.players:
-                print "unmerging tournament", tournament
-                # check if original id now belongs to source
-                if any([child in tournament.orig_ids for child in source.merge_children]):
-                    # replace target with source in tournament
-                    tournament.replace_player(
-                        player_to_remove=target, player_to_add=source)
-                    self.update_tournament(tournament)
-
+        # unmerge source from target, a batch of tournaments at a time
+        tournaments = []
+        for tournament in self.iter_tournaments(players=[target]):
+            # check if original id now belongs to source
+            if any([child in tournament.orig_ids for child in source.merge_children]):
+                print "unmerging tournament", tournament.id
+                # replace target with source in tournament
+                tournament.replace_player(
+                    player_to_remove=target, player_to_add=source)
+                tournaments.append(tournament)
+                if len(tournaments) == ITER_BATCH_SIZE:
+                    self.update_tournaments(tournaments)
+                    tournaments = []
+        self.update_tournaments(tournaments)
+
+    # a stored ranking is either a full snapshot, or a delta against a
+    # snapshot whose id is in 'base':
+    #   'base_tournaments' is how many of the base's tournaments it starts with
+    #     and 'tournaments' only holds the ones after those
+    #   'order' is the players in rank order as a mix of [start, end] slices
+    #     of the base's players and ids of players placed between them, so a
+    #     player moving up only shifts everyone else's rank
+    #   'ranking' only holds the entries whose rating or previous rank
+    #     changed, without their rank
+    # deltas are only stored for rankings ranked 1..n in order (i.e. all the
+    # generated ones). rankings returned from here are always expanded to
+    # full rankings.
     def insert_ranking(self, ranking):
-        return self.rankings_col.insert(ranking.dump(context='db'))
+        '''Stores ranking as a delta against the latest snapshot for its
+        region, or as a new snapshot if the latest one already has
+        RANKING_SNAPSHOT_INTERVAL - 1 deltas.'''
+        ranking_dict = ranking.dump(context='db')
+
+        latest = self.rankings_col.find_one(
+            {'region': ranking.region}, {'base': 1}, sort=[('time', pymongo.DESCENDING)])
+        if latest is not None and _is_ranked_in_order(ranking_dict['ranking']):
+            base_id = latest.get('base') or latest['_id']
+            num_deltas = self.rankings_col.find({'base': base_id}).count()
+            base_dict = self.rankings_col.find_one({'_id': base_id})
+            if num_deltas + 1 < RANKING_SNAPSHOT_INTERVAL and \
+                    _is_ranked_in_order(base_dict['ranking']):
+                ranking_dict = _ranking_delta(ranking_dict, base_dict)
+
+        ranking_id = self.rankings_col.insert(ranking_dict)
+        self.refresh_ranking_view(ranking.region)
+        return ranking_id
+
+    def get_ranking_by_id(self, id):
+        '''id must be an ObjectId'''
+        return self._expand_ranking(self.rankings_col.find_one({'_id': id}))
 
     def get_latest_ranking(self):
-        return M.Ranking.load(
-            self.rankings_col.find({'region': self.region_id}).sort(
-                'time', pymongo.DESCENDING)[0],
-            context='db')
+        return self._expand_ranking(self.rankings_col.find_one(
+            {'region': self.region_id}, sort=[('time', pymongo.DESCENDING)]))
+
+    def _expand_ranking(self, ranking_dict):
+        if ranking_dict is not None and ranking_dict.get('base') is not None:
+            ranking_dict = _expand_ranking_delta(
+                ranking_dict, self.rankings_col.find_one({'_id': ranking_dict['base']}))
+        return M.Ranking.load(ranking_dict, context='db', trusted=True)
+
+    def get_ranking_view(self):
+        '''The latest ranking of this region with player names. Builds the
+        view if the region doesn't have one yet. Returns None if the region
+        has no rankings.'''
+        view = M.RankingView.load(
+            self.ranking_views_col.find_one({'_id': self.region_id}), context='db', trusted=True)
+        if view is None:
+            view = self.refresh_ranking_view(self.region_id)
+        return view
+
+    def get_ranking_view_etag(self):
+        '''Just the etag of this region's ranking view, or None.'''
+        view_dict = self.ranking_views_col.find_one({'_id': self.region_id}, {'etag': 1})
+        return view_dict['etag'] if view_dict else None
+
+    def refresh_ranking_view(self, region_id):
+        '''Rebuilds the view of region_id's latest ranking. Players that no
+        longer exist are left out.'''
+        ranking = self._expand_ranking(self.rankings_col.find_one(
+            {'region': region_id}, sort=[('time', pymongo.DESCENDING)]))
+        if ranking is None:
+            self.ranking_views_col.remove({'_id': region_id})
+            return None
+
+        players = self.get_players_by_ids([entry.player for entry in ranking.ranking])
+        entries = []
+        for entry in ranking.ranking:
+            player = players.get(entry.player)
+            if player:
+                entries.append(M.RankingViewEntry(
+                    player=entry.player,
+                    rank=entry.rank,
+                    rating=entry.rating,
+                    previous_rank=entry.previous_rank,
+                    name=player.name))
+
+        view = M.RankingView(
+            id=region_id,
+            ranking=ranking.id,
+            tournaments=ranking.tournaments,
+            time=ranking.time,
+            entries=entries,
+            etag=str(ObjectId()))
+        self.ranking_views_col.update({'_id': region_id}, view.dump(context='db'), upsert=True)
+        return view
+
+    # besides the checkpoint, a region's checkpoint document holds a token
+    # that changes on every write, and is marked stale when one of the
+    # tournaments it was computed from is written. a ranking run reads the
+    # token before reading the tournaments and only saves its checkpoint if
+    # the token didn't change, so a checkpoint computed from tournaments that
+    # were edited mid-run isn't saved.
+
+    def get_ranking_checkpoint(self):
+        return M.RankingCheckpoint.load(
+            self.ranking_checkpoints_col.find_one({'_id': self.region_id, 'stale': {'$ne': True}}),
+            context='db', trusted=True)
+
+    def get_ranking_checkpoint_token(self):
+        checkpoint_dict = self.ranking_checkpoints_col.find_one_and_update(
+            {'_id': self.region_id}, {'$setOnInsert': {'token': ObjectId(), 'stale': True}},
+            projection={'token': 1}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return checkpoint_dict['token']
+
+    def update_ranking_checkpoint(self, checkpoint, token=None):
+        '''If token is given, only saves checkpoint if the region's token is
+        still the same. Returns whether it was saved.'''
+        checkpoint_dict = checkpoint.dump(context='db')
+        checkpoint_dict['token'] = ObjectId()
+        if token is None:
+            self.ranking_checkpoints_col.update(
+                {'_id': checkpoint.id}, checkpoint_dict, upsert=True)
+            return True
+        result = self.ranking_checkpoints_col.update(
+            {'_id': checkpoint.id, 'token': token}, checkpoint_dict)
+        return result['n'] > 0
+
+    def _invalidate_ranking_checkpoints(self, tournament_ids):
+        '''Marks the checkpoints of the regions of the given tournaments
+        stale, as well as any other checkpoint computed from them.'''
+        regions = set()
+        for tournament_dict in self.tournaments_col.find(
+                {'_id': {'$in': tournament_ids}}, {'regions': 1}):
+            regions.update(tournament_dict.get('regions', []))
+        self.ranking_checkpoints_col.update(
+            {'$or': [{'_id': {'$in': list(regions)}},
+                     {'tournaments': {'$in': tournament_ids}}]},
+            {'$set': {'stale': True, 'token': ObjectId()}}, multi=True)
+
+    def delete_ranking_checkpoint(self):
+        return self.ranking_checkpoints_col.remove({'_id': self.region_id})
+
+    def get_rating_history(self, player_id):
+        '''player_id must be an ObjectId'''
+        return M.RatingHistory.load(self.rating_history_col.find_one(
+            {'region': self.region_id, 'player': player_id}), context='db', trusted=True)
+
+    def update_rating_histories(self, histories, tournament_ids, replace=False):
+        '''histories maps player id to the RatingHistoryEntrys from replaying
+        tournament_ids. Unless replace is set they are appended to the stored
+        histories; entries already stored for those tournaments are dropped
+        first so rerunning a replay doesn't duplicate them. With replace the
+        region's stored histories are replaced entirely.'''
+        if replace:
+            self.rating_history_col.remove({'region': self.region_id})
+        elif tournament_ids:
+            self.rating_history_col.update(
+                {'region': self.region_id},
+                {'$pull': {'history': {'tournament': {'$in': tournament_ids}}}},
+                multi=True)
+
+        if not histories:
+            return None
+        bulk = self.rating_history_col.initialize_unordered_bulk_op()
+        for player_id, entries in histories.items():
+            bulk.find({'region': self.region_id, 'player': player_id}).upsert().update_one(
+                {'$push': {'history': {'$each': [entry.dump(context='db') for entry in entries]}}})
+        return bulk.execute()
+
+    def insert_ranking_job(self, job):
+        return self.ranking_jobs_col.insert(job.dump(context='db'))
+
+    def update_ranking_job(self, job):
+        return self.ranking_jobs_col.update({'_id': job.id}, job.dump(context='db'))
+
+    def get_ranking_job_by_id(self, id):
+        '''id must be an ObjectId'''
+        return M.RankingJob.load(self.ranking_jobs_col.find_one({'_id': id}), context='db', trusted=True)
 
     def insert_raw_file(self, raw_file):
         return self.raw_files_col.insert(raw_file.dump(context='db'))
@@ -512,7 +1197,8 @@ class Dao(object):
     def is_inactive(self, player, now, day_limit, num_tourneys):
 
         qualifying_tournaments = [x for x in self.get_all_tournaments(
-            players=[player], regions=[self.region_id]) if x.date >= (now - timedelta(days=day_limit))]
+            players=[player], regions=[self.region_id], only=('id', 'date'))
+            if x.date >= (now - timedelta(days=day_limit))]
         if len(qualifying_tournaments) >= num_tourneys:
             return False
         return True
@@ -523,11 +1209,12 @@ class Dao(object):
 # region addition
     def create_region(self, display_name):
         the_region = M.Region(id=display_name.lower(), display_name=display_name)
-        return self.insert_region(the_region, self.mongo_client, database_name=DATABASE_NAME)
+        return self.insert_region(the_region, self.mongo_client, database_name=self.database_name)
 
     def remove_region(self, region):
         if self.regions_col.find_one({'display_name': region.display_name}):
             self.regions_col.remove(region.dump(context='db'))
+            Dao.invalidate_region_cache(self.mongo_client, self.database_name)
 
     def update_region_ranking_criteria(self, region_id,
                                        ranking_num_tourneys_attended,
@@ -542,12 +1229,13 @@ class Dao(object):
                                          'tournament_qualified_day_limit': tournament_qualified_day_limit
                                         }
                                      })
+            Dao.invalidate_region_cache(self.mongo_client, self.database_name)
 
 
     def get_region_ranking_criteria(self, region_id):
-        result = self.regions_col.find_one({'_id': region_id})
+        result = Dao._get_cached_regions(self.mongo_client, self.database_name).get(region_id)
         if result:
-            region = M.Region.load(result, context='db')
+            region = M.Region.load(result, context='db', trusted=True)
             return region.dump(context='web')
 
     # throws an exception, which is okay because this is called from just create_user
@@ -592,21 +1280,21 @@ class Dao(object):
             update={"$set": {'hashed_password': hashed_password, 'salt': salt}})
 
     def get_all_users(self):
-        return [M.User.load(u, context='db') for u in self.users_col.find()]
+        return [M.User.load(u, context='db', trusted=True) for u in self.users_col.find()]
 
     def get_user_by_id_or_none(self, id):
         result = self.users_col.find({"_id": id})
         if result.count() == 0:
             return None
         assert result.count() == 1, "WE HAVE MULTIPLE USERS WITH THE SAME UID"
-        return M.User.load(result[0], context='db')
+        return M.User.load(result[0], context='db', trusted=True)
 
     def get_user_by_username_or_none(self, username):
         result = self.users_col.find({"username": username})
         if result.count() == 0:
             return None
         assert result.count() == 1, "WE HAVE MULTIPLE USERS WITH THE SAME USERNAME"
-        return M.User.load(result[0], context='db')
+        return M.User.load(result[0], context='db', trusted=True)
 
     def get_user_by_session_id_or_none(self, session_id):
         # mongo magic here, go through and get a user by session_id if they
@@ -636,7 +1324,7 @@ class Dao(object):
         if result.count() == 0:
             return None
         assert result.count() == 1, "WE HAVE DUPLICATE USERNAMES IN THE DB"
-        user = M.User.load(result[0], context='db')
+        user = M.User.load(result[0], context='db', trusted=True)
         assert user, "mongo has stopped being consistent, abort ship"
 
         # timing oracle on this... good luck
@@ -0,0 +1,61 @@
+from pymongo.errors import OperationFailure
+
+import model as M
+import orm
+
+from dao import DATABASE_NAME
+
+
+def get_indexed_documents():
+    '''All document classes in model that declare indexes, sorted by
+    collection.'''
+    documents = [cls for cls in vars(M).values()
+                 if isinstance(cls, type) and issubclass(cls, orm.Document)
+                 and cls.collection_name and cls.indexes]
+    return sorted(documents, key=lambda cls: cls.collection_name)
+
+
+def ensure_indexes(mongo_client, database_name=DATABASE_NAME, background=False):
+    '''Creates every declared index. Indexes that already exist are left
+    alone, so this is safe to run on every startup. With background, new
+    indexes are built without blocking other operations on their
+    collection. Returns a list of (collection name, index name) for the
+    declared indexes.'''
+    ensured = []
+    for cls in get_indexed_documents():
+        col = mongo_client[database_name][cls.collection_name]
+        for index in cls.indexes:
+            options = dict(index.options)
+            options['name'] = index.name
+            if background:
+                options['background'] = True
+            col.create_index(index.keys, **options)
+            ensured.append((cls.collection_name, index.name))
+    return ensured
+
+
+def report_indexes(mongo_client, database_name=DATABASE_NAME):
+    '''Compares declared indexes against the database. Returns a dict
+    mapping collection name to a dict with:
+      missing: declared indexes that don't exist
+      undeclared: existing indexes that aren't declared (other than _id_)
+      unused: existing indexes (other than _id_) that haven't been used since
+        the server started, or None if the server can't report usage
+        ($indexStats needs mongo 3.2)'''
+    report = {}
+    for cls in get_indexed_documents():
+        col = mongo_client[database_name][cls.collection_name]
+        declared = set(index.name for index in cls.indexes)
+        existing = set(col.index_information().keys()) - {'_id_'}
+
+        try:
+            unused = sorted(stats['name'] for stats in col.aggregate([{'$indexStats': {}}])
+                            if stats['name'] != '_id_' and stats['accesses']['ops'] == 0)
+        except (OperationFailure, NotImplementedError):
+            unused = None
+
+        report[cls.collection_name] = {
+            'missing': sorted(declared - existing),
+            'undeclared': sorted(existing - declared),
+            'unused': unused}
+    return report
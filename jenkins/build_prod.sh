@@ -2,5 +2,6 @@ cd /home/deploy/prod/garpr
 sudo systemctl stop prod.webapp.service
 sudo systemctl stop prod.api.service
 sudo git pull
+python scripts/migrations/add_player_matches.py
 sudo systemctl start prod.api.service
 sudo systemctl start prod.webapp.service
@@ -6,5 +6,6 @@ git pull
 git checkout $branch
 sudo pip install -r requirements.txt
 nose2 -v -B
+python scripts/migrations/add_player_matches.py
 sudo systemctl start stage.api.service
 sudo systemctl start stage.webapp.service
@@ -5,23 +5,28 @@ import trueskill
 import orm
 
 SOURCE_TYPE_CHOICES = ('tio', 'challonge', 'smashgg', 'other')
+RANKING_JOB_STATUS_CHOICES = ('queued', 'running', 'done', 'failed')
+MATCH_RESULT_CHOICES = ('win', 'lose')
 
 # Embedded documents
 
 class AliasMapping(orm.Document):
     collection_name = None
+    use_slots = True
     fields = [('player_id', orm.ObjectIDField()),
               ('player_alias', orm.StringField(required=True))]
 
 
 class AliasMatch(orm.Document):
     collection_name = None
+    use_slots = True
     fields = [('winner', orm.StringField(required=True)),
               ('loser', orm.StringField(required=True))]
 
 
 class Match(orm.Document):
     collection_name = None
+    use_slots = True
     fields = [('match_id', orm.IntField(required=True)),
               ('winner', orm.ObjectIDField(required=True)),
               ('loser', orm.ObjectIDField(required=True)),
@@ -52,14 +57,22 @@ class Match(orm.Document):
 
 class RankingEntry(orm.Document):
     collection_name = None
+    use_slots = True
     fields = [('player', orm.ObjectIDField(required=True)),
               ('rank', orm.IntField(required=True)),
               ('rating', orm.FloatField(required=True)),
               ('previous_rank', orm.IntField())]
 
 
+class RankingViewEntry(orm.Document):
+    collection_name = None
+    use_slots = True
+    fields = RankingEntry.fields + [('name', orm.StringField(required=True))]
+
+
 class Rating(orm.Document):
     collection_name = None
+    use_slots = True
     fields = [('mu', orm.FloatField(required=True, default=25.)),
               ('sigma', orm.FloatField(required=True, default=25. / 3))]
 
@@ -72,6 +85,15 @@ class Rating(orm.Document):
                       sigma=trueskill_rating.sigma)
 
 
+class RatingHistoryEntry(orm.Document):
+    collection_name = None
+    use_slots = True
+    fields = [('tournament', orm.ObjectIDField(required=True)),
+              ('date', orm.DateTimeField()),
+              ('mu', orm.FloatField(required=True)),
+              ('sigma', orm.FloatField(required=True))]
+
+
 # MongoDB collection documents
 
 MONGO_ID_SELECTOR = {'db': '_id',
@@ -90,6 +112,9 @@ class Player(orm.Document):
               ('merge_parent', orm.ObjectIDField()),
               ('merge_children', orm.ListField(orm.ObjectIDField()))
               ]
+    indexes = [orm.Index([('aliases', 1)]),
+               orm.Index([('name', 1)]),
+               orm.Index([('regions', 1), ('merged', 1), ('name', 1)])]
 
     def validate_document(self):
         # check: merged is True <=> merge_parent is not None
@@ -134,6 +159,10 @@ class Tournament(orm.Document):
               ('matches', orm.ListField(orm.DocumentField(Match))),
               ('players', orm.ListField(orm.ObjectIDField())),
               ('orig_ids', orm.ListField(orm.ObjectIDField()))]
+    indexes = [orm.Index([('players', 1)]),
+               orm.Index([('regions', 1), ('date', 1)]),
+               orm.Index([('date', 1)])]
+    lazy_fields = ('matches',)
 
     def validate_document(self):
         # check: set of players in players = set of players in matches
@@ -189,6 +218,14 @@ class Tournament(orm.Document):
     def contains_player(self, player):
       return player.id in self.players
 
+    def get_player_matches(self):
+        '''Each match from the point of view of both its players, in match
+        order.'''
+        player_matches = []
+        for match in self.matches:
+            player_matches.extend(PlayerMatch.from_match(match, self.id, self.name, self.date))
+        return player_matches
+
     @classmethod
     def from_pending_tournament(cls, pending_tournament):
         # takes a real alias to id map instead of a list of objects
@@ -235,6 +272,42 @@ class Tournament(orm.Document):
             orig_ids=players)
 
 
+# one match from one player's point of view, so match history and head to
+# head are a range scan. kept in sync with tournaments by the Dao.
+class PlayerMatch(orm.Document):
+    collection_name = 'matches'
+    fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
+                                       dump_to=MONGO_ID_SELECTOR)),
+              ('player', orm.ObjectIDField(required=True)),
+              ('opponent', orm.ObjectIDField(required=True)),
+              ('result', orm.StringField(
+                  required=True,
+                  validators=[orm.validate_choices(MATCH_RESULT_CHOICES)])),
+              ('excluded', orm.BooleanField(required=True, default=False)),
+              ('match_id', orm.IntField()),
+              ('tournament', orm.ObjectIDField(required=True)),
+              ('tournament_name', orm.StringField()),
+              ('date', orm.DateTimeField())]
+    indexes = [orm.Index([('player', 1), ('opponent', 1), ('date', 1)]),
+               orm.Index([('player', 1), ('date', 1)]),
+               orm.Index([('tournament', 1)])]
+
+    @classmethod
+    def from_match(cls, match, tournament_id, tournament_name, date):
+        '''The match from the point of view of its winner, then its loser.'''
+        return [cls(id=ObjectId(),
+                    player=player,
+                    opponent=opponent,
+                    result=result,
+                    excluded=match.excluded,
+                    match_id=match.match_id,
+                    tournament=tournament_id,
+                    tournament_name=tournament_name,
+                    date=date)
+                for player, opponent, result in ((match.winner, match.loser, 'win'),
+                                                 (match.loser, match.winner, 'lose'))]
+
+
 class PendingTournament(orm.Document):
     collection_name = 'pending_tournaments'
     fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
@@ -248,6 +321,7 @@ class PendingTournament(orm.Document):
               ('matches', orm.ListField(orm.DocumentField(AliasMatch))),
               ('players', orm.ListField(orm.StringField())),
               ('alias_to_id_map', orm.ListField(orm.DocumentField(AliasMapping)))]
+    indexes = [orm.Index([('regions', 1), ('date', 1)])]
 
     def validate_document(self):
         # check: set of aliases = set of aliases in matches
@@ -338,12 +412,86 @@ class Ranking(orm.Document):
               ('tournaments', orm.ListField(orm.ObjectIDField())),
               ('time', orm.DateTimeField()),
               ('ranking', orm.ListField(orm.DocumentField(RankingEntry)))]
+    # base is only set on stored deltas, see Dao.insert_ranking
+    indexes = [orm.Index([('region', 1), ('time', -1)]),
+               orm.Index([('base', 1)], sparse=True)]
+
+    def __setattr__(self, name, value):
+        # the player id -> rank map is built from ranking, so drop it when
+        # ranking is reassigned (mutating the list in place isn't tracked)
+        if name == 'ranking':
+            self.__dict__.pop('_rank_by_player_id', None)
+        super(Ranking, self).__setattr__(name, value)
 
     def get_ranking_for_player_id(self, player_id):
-        for entry in self.ranking:
-            if entry.player == player_id:
-                return entry.rank
-        return None
+        rank_by_player_id = self.__dict__.get('_rank_by_player_id')
+        if rank_by_player_id is None:
+            rank_by_player_id = {}
+            for entry in self.ranking:
+                rank_by_player_id.setdefault(entry.player, entry.rank)
+            self._rank_by_player_id = rank_by_player_id
+        return rank_by_player_id.get(player_id)
+
+# the latest ranking of a region with player names filled in, so the rankings
+# page can be served without loading players. id is the region id, etag
+# changes whenever the view does.
+class RankingView(orm.Document):
+    collection_name = 'ranking_views'
+    fields = [('id', orm.StringField(required=True, load_from=MONGO_ID_SELECTOR,
+                                     dump_to=MONGO_ID_SELECTOR)),
+              ('ranking', orm.ObjectIDField(required=True)),
+              ('tournaments', orm.ListField(orm.ObjectIDField())),
+              ('time', orm.DateTimeField()),
+              ('entries', orm.ListField(orm.DocumentField(RankingViewEntry))),
+              ('etag', orm.StringField(required=True))]
+    indexes = [orm.Index([('entries.player', 1)])]
+
+# rating state saved after each ranking run so that the next run only has to
+# replay tournaments newer than the checkpoint. id is the region id. the Dao
+# invalidates it when one of its tournaments is written.
+class RankingCheckpoint(orm.Document):
+    collection_name = 'ranking_checkpoints'
+    fields = [('id', orm.StringField(required=True, load_from=MONGO_ID_SELECTOR,
+                                     dump_to=MONGO_ID_SELECTOR)),
+              ('time', orm.DateTimeField()),
+              ('tournaments', orm.ListField(orm.ObjectIDField())),
+              ('ratings', orm.DictField(orm.StringField(), orm.DocumentField(Rating))),
+              ('history', orm.BooleanField(required=True, default=False))]
+
+# a background ranking generation (see ranking_jobs.py), with its parameters
+# and progress
+class RankingJob(orm.Document):
+    collection_name = 'ranking_jobs'
+    fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
+                                       dump_to=MONGO_ID_SELECTOR)),
+              ('region', orm.StringField(required=True)),
+              ('status', orm.StringField(
+                  required=True,
+                  validators=[orm.validate_choices(RANKING_JOB_STATUS_CHOICES)])),
+              ('ranking_time', orm.DateTimeField()),
+              ('day_limit', orm.IntField(required=True, default=60)),
+              ('num_tourneys', orm.IntField(required=True, default=2)),
+              ('tournament_qualified_day_limit', orm.IntField(required=True, default=999)),
+              ('tournament_to_diff', orm.ObjectIDField()),
+              ('time_queued', orm.DateTimeField()),
+              ('time_started', orm.DateTimeField()),
+              ('time_finished', orm.DateTimeField()),
+              ('tournaments_processed', orm.IntField(required=True, default=0)),
+              ('tournaments_total', orm.IntField(required=True, default=0)),
+              ('players_updated', orm.IntField(required=True, default=0)),
+              ('ranking', orm.ObjectIDField()),
+              ('error', orm.StringField())]
+
+# a player's rating in a region after each tournament they played, in
+# tournament order. written by the ranking replay.
+class RatingHistory(orm.Document):
+    collection_name = 'rating_history'
+    fields = [('id', orm.ObjectIDField(required=True, load_from=MONGO_ID_SELECTOR,
+                                       dump_to=MONGO_ID_SELECTOR)),
+              ('region', orm.StringField(required=True)),
+              ('player', orm.ObjectIDField(required=True)),
+              ('history', orm.ListField(orm.DocumentField(RatingHistoryEntry)))]
+    indexes = [orm.Index([('region', 1), ('player', 1)])]
 
 class Region(orm.Document):
     collection_name = 'regions'
@@ -363,6 +511,7 @@ class User(orm.Document):
               ('salt', orm.StringField(required=True)),
               ('hashed_password', orm.StringField(required=True)),
               ('admin_regions', orm.ListField(orm.StringField()))]
+    indexes = [orm.Index([('username', 1)])]
 
 
 class Merge(orm.Document):
@@ -373,6 +522,7 @@ class Merge(orm.Document):
               ('source_player_obj_id', orm.ObjectIDField(required=True)),
               ('target_player_obj_id', orm.ObjectIDField(required=True)),
               ('time', orm.DateTimeField())]
+    indexes = [orm.Index([('time', 1)])]
 
     def validate_document(self):
         if self.source_player_obj_id == self.target_player_obj_id:
@@ -385,3 +535,5 @@ class Session(orm.Document):
     collection_name = 'sessions'
     fields = [('session_id', orm.StringField(required=True)),
               ('user_id', orm.StringField(required=True))]
+    indexes = [orm.Index([('session_id', 1)]),
+               orm.Index([('user_id', 1)])]
@@ -72,6 +72,17 @@ class Field(object):
     def unserialize(self, value, context, data):
         raise NotImplementedError
 
+    # serializer and unserializer return a function that does what
+    # serialize/unserialize do for one context, without the decorator and
+    # context checks, or None if the value is passed through as is. the
+    # compiled dump/load of Document calls these once per class and context.
+
+    def serializer(self, context):
+        return lambda value, obj: self.serialize(value, context, obj)
+
+    def unserializer(self, context):
+        return lambda value, data: self.unserialize(value, context, data)
+
     def validate(self, value):
         if self.required and (value is None):
             return False
@@ -97,6 +108,12 @@ class BooleanField(Field):
         else:
             return value
 
+    def serializer(self, context):
+        return None
+
+    def unserializer(self, context):
+        return lambda value, data: value if isinstance(value, bool) else None
+
     @validate_super
     def validate(self, value):
         return isinstance(value, bool)
@@ -122,6 +139,27 @@ class DateTimeField(Field):
                 # TODO: log this error
                 return None
 
+    def serializer(self, context):
+        if context == 'db':
+            return None
+        elif context == 'web':
+            return lambda value, obj: None if value is None else value.strftime("%x")
+        return lambda value, obj: None
+
+    def unserializer(self, context):
+        if context == 'db':
+            return None
+        elif context == 'web':
+            def unserialize(value, data):
+                if value is None:
+                    return None
+                try:
+                    return datetime.datetime.strptime(value, "%x")
+                except ValueError:
+                    return None
+            return unserialize
+        return lambda value, data: None
+
     @validate_super
     def validate(self, value):
         return isinstance(value, datetime.datetime)
@@ -151,6 +189,26 @@ class DictField(Field):
         return {self.from_field.unserialize(k, context, data): self.to_field.unserialize(v, context, data)
                 for k, v in value.items()}
 
+    def serializer(self, context):
+        from_serializer = self.from_field.serializer(context) or _pass_through
+        to_serializer = self.to_field.serializer(context) or _pass_through
+
+        def serialize(value, obj):
+            if value is None:
+                return dict()
+            return {from_serializer(k, obj): to_serializer(v, obj) for k, v in value.items()}
+        return serialize
+
+    def unserializer(self, context):
+        from_unserializer = self.from_field.unserializer(context) or _pass_through
+        to_unserializer = self.to_field.unserializer(context) or _pass_through
+
+        def unserialize(value, data):
+            if not isinstance(value, dict):
+                return dict()
+            return {from_unserializer(k, data): to_unserializer(v, data) for k, v in value.items()}
+        return unserialize
+
     @validate_super
     def validate(self, value):
         if not isinstance(value, dict):
@@ -181,6 +239,29 @@ class DocumentField(Field):
         except:
             return None
 
+    def serializer(self, context):
+        document_type = self.document_type
+
+        def serialize(value, obj):
+            if value is None:
+                return None
+            if type(value) is document_type:
+                return document_type.compiled_dump(context)(value)
+            return value.dump(context, validate_on_dump=False)
+        return serialize
+
+    def unserializer(self, context):
+        document_type = self.document_type
+
+        def unserialize(value, data):
+            if value is None:
+                return None
+            try:
+                return document_type.compiled_load(context)(value)
+            except:
+                return None
+        return unserialize
+
     @validate_super
     def validate(self, value):
         return isinstance(value, self.document_type)
@@ -199,6 +280,12 @@ class FloatField(Field):
         else:
             return float(value)
 
+    def serializer(self, context):
+        return None
+
+    def unserializer(self, context):
+        return lambda value, data: float(value) if isinstance(value, (float, int, long)) else None
+
     @validate_super
     def validate(self, value):
         return isinstance(value, float)
@@ -217,6 +304,12 @@ class IntField(Field):
         else:
             return value
 
+    def serializer(self, context):
+        return None
+
+    def unserializer(self, context):
+        return lambda value, data: value if isinstance(value, int) else None
+
     @validate_super
     def validate(self, value):
         return isinstance(value, int)
@@ -244,6 +337,28 @@ class ListField(Field):
             return []
         return [self.field_type.unserialize(v, context, data) for v in value]
 
+    def serializer(self, context):
+        item_serializer = self.field_type.serializer(context)
+
+        def serialize(value, obj):
+            if value is None:
+                return []
+            if item_serializer is None:
+                return list(value)
+            return [item_serializer(v, obj) for v in value]
+        return serialize
+
+    def unserializer(self, context):
+        item_unserializer = self.field_type.unserializer(context)
+
+        def unserialize(value, data):
+            if value is None or not isinstance(value, collections.Iterable):
+                return []
+            if item_unserializer is None:
+                return list(value)
+            return [item_unserializer(v, data) for v in value]
+        return unserialize
+
     @validate_super
     def validate(self, value):
         if not isinstance(value, list):
@@ -276,6 +391,27 @@ class ObjectIDField(Field):
                 # TODO: log this error
                 return None
 
+    def serializer(self, context):
+        if context == 'db':
+            return None
+        elif context == 'web':
+            return lambda value, obj: None if value is None else str(value)
+        return lambda value, obj: None
+
+    def unserializer(self, context):
+        if context == 'db':
+            return None
+        elif context == 'web':
+            def unserialize(value, data):
+                if value is None:
+                    return None
+                try:
+                    return ObjectId(value)
+                except InvalidId:
+                    return None
+            return unserialize
+        return lambda value, data: None
+
     @validate_super
     def validate(self, value):
         return isinstance(value, ObjectId)
@@ -302,21 +438,131 @@ class StringField(Field):
         else:
             return None
 
+    def serializer(self, context):
+        return _to_ascii
+
+    def unserializer(self, context):
+        return _to_ascii
+
     @validate_super
     def validate(self, value):
         return isinstance(value, (str, unicode))
 
+
+def _to_ascii(value, obj_or_data):
+    # TODO: figure out a better Unicode strategy
+    if isinstance(value, unicode):
+        return value.encode('ascii', 'ignore')
+    elif isinstance(value, str):
+        return value
+    return None
+
+
+def _pass_through(value, obj_or_data):
+    return value
+
+
+# stands in for a value that isn't in the loaded data
+_MISSING = object()
+
+
 # Field validators
 
 
 def validate_choices(choices):
     return (lambda x: x in choices)
 
+# Indexes
+
+class Index(object):
+    '''An index on a document's collection. keys is a list of
+    (field name, direction) pairs, options are passed on to create_index.'''
+
+    def __init__(self, keys, **options):
+        self.keys = keys
+        self.options = options
+
+    @property
+    def name(self):
+        # same name mongo generates by default
+        return self.options.get('name') or \
+            '_'.join('{}_{}'.format(field, direction) for field, direction in self.keys)
+
+    def __repr__(self):
+        return 'Index({})'.format(self.name)
+
+
 # Documents
 
 
+class LazyField(object):
+    '''Stands in for a field listed in lazy_fields on documents loaded with
+    lazy=True. The field is unserialized from its loaded value the first time
+    it's read and stored on the instance, which hides this descriptor from
+    then on. The loaded value is dropped once it's unserialized.'''
+
+    def __init__(self, field_name, field):
+        self.field_name = field_name
+        self.field = field
+        self.unserializers = {}
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            context, loaded_values = obj.__dict__['_lazy']
+            loaded_value = loaded_values.pop(self.field_name)
+        except KeyError:
+            raise AttributeError(self.field_name)
+        if not loaded_values:
+            del obj.__dict__['_lazy']
+
+        if context not in self.unserializers:
+            self.unserializers[context] = self.field.unserializer(context)
+        unserialize = self.unserializers[context]
+        value = None if loaded_value is _MISSING else loaded_value
+        if unserialize is not None:
+            value = unserialize(value, None)
+        if value is None:
+            value = self.field.default() if callable(self.field.default) else self.field.default
+        obj.__dict__[self.field_name] = value
+        return value
+
+
+class DocumentMeta(type):
+    '''Gives documents that set use_slots = True a __slots__ with one slot
+    per field, so their instances don't carry a __dict__. Meant for embedded
+    documents that are created by the thousands (matches, rating entries);
+    their instances can't have attributes other than their fields.
+
+    Fields in lazy_fields get a LazyField, see Document.load. Documents
+    can't have both.'''
+
+    def __new__(mcs, name, bases, namespace):
+        if namespace.get('use_slots') and '__slots__' not in namespace:
+            namespace['__slots__'] = \
+                tuple(field_name for field_name, _ in namespace['fields']) + ('_loaded',)
+        lazy_fields = namespace.get('lazy_fields', ())
+        if lazy_fields:
+            if namespace.get('use_slots'):
+                raise TypeError('{} has both use_slots and lazy_fields'.format(name))
+            fields = dict(namespace['fields'])
+            for field_name in lazy_fields:
+                namespace[field_name] = LazyField(field_name, fields[field_name])
+        return super(DocumentMeta, mcs).__new__(mcs, name, bases, namespace)
+
+
 class Document(object):
+    __metaclass__ = DocumentMeta
+    # subclasses without use_slots still get a __dict__
+    __slots__ = ()
+
     fields = []
+    # indexes to create on collection_name, see indexes.py
+    indexes = []
+    use_slots = False
+    # fields that load(lazy=True) leaves to be unserialized on first access
+    lazy_fields = ()
 
     def __init__(self, **kwargs):
         for field_name, field in self.fields:
@@ -351,21 +597,131 @@ class Document(object):
         return not self == other
 
     def dump(self, context=None, exclude=None, only=None, validate_on_dump=True):
-        return_dict = {}
-
+        d = None
         if validate_on_dump:
-            is_valid, errors = self.validate()
+            loaded = getattr(self, '_loaded', None)
+            if loaded is None:
+                is_valid, errors = self.validate()
+            elif context != 'db':
+                # trusted documents are revalidated when they're written back
+                # to the db, not every time they're dumped
+                is_valid, errors = True, None
+            else:
+                # only revalidate what changed since the trusted load
+                changed, loaded_d = self._changed_fields(*loaded)
+                if loaded[0] == context and exclude is None and only is None:
+                    d = loaded_d
+                is_valid, errors = self.validate(fields=changed)
             if not is_valid:
                 raise ValidationError(str(errors))
 
+        if d is None:
+            d = type(self).compiled_dump(context, exclude, only)(self)
+        return d
+
+    def changed_fields(self):
+        '''Names of the fields that changed since the document was loaded
+        with trusted=True, or None if it wasn't. Fields are compared by their
+        dumped values, so changes made in place (e.g. to a list) count.'''
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None:
+            return None
+        return self._changed_fields(*loaded)[0]
+
+    def _changed_fields(self, context, loaded_values):
+        '''(names of the changed fields, dump of the document in context)'''
+        # lazy fields that were never read or set can't have changed. This
+        # has to be checked before dumping, which reads them.
+        lazy = getattr(self, '_lazy', None)
+        unread = [field_name for field_name in (lazy[1] if lazy else ())
+                  if field_name not in self.__dict__]
+        d = type(self).compiled_dump(context)(self)
+
+        changed = []
         for field_name, field in self.fields:
+            if field_name in unread:
+                continue
+            to_name = field_name
+            if isinstance(field.dump_to, dict):
+                to_name = field.dump_to.get(context, field_name)
+            elif isinstance(field.dump_to, str):
+                to_name = field.dump_to
+            # fields that were missing from the data (e.g. they weren't
+            # projected) or loaded lazily have no loaded value and are
+            # validated like changed ones
+            loaded_value = loaded_values.get(field_name, _MISSING)
+            if loaded_value is _MISSING or d.get(to_name) != loaded_value:
+                changed.append(field_name)
+        return changed, d
+
+    @classmethod
+    def _loaded_values(cls, context, data, lazy):
+        '''field name -> its value in data, for the fields in data that were
+        loaded right away.'''
+        compiled = cls._compiled()
+        key = ('loaded_names', context, lazy)
+        if key not in compiled:
+            lazy_fields = cls._loaded_lazily(lazy)
+            compiled[key] = [(field_name, from_name)
+                             for field_name, from_name in cls.fields_to_names(context)
+                             if field_name not in lazy_fields]
+        names = compiled[key]
+        return {field_name: data[from_name] for field_name, from_name in names
+                if from_name in data}
+
+    @classmethod
+    def _loaded_lazily(cls, lazy):
+        # lazy fields are set by LazyField, which needs a __dict__
+        return cls.lazy_fields if lazy and cls.__init__ == Document.__init__ else ()
+
+    # dump and load run functions generated for each class, context and
+    # exclude/only, which read and write every field directly with its
+    # field's serializer/unserializer instead of looking everything up per
+    # field on every call.
+
+    @classmethod
+    def _compiled(cls):
+        # not inherited, subclasses may have other fields
+        compiled = cls.__dict__.get('_compiled_functions')
+        if compiled is None:
+            compiled = {}
+            cls._compiled_functions = compiled
+        return compiled
+
+    @classmethod
+    def compiled_dump(cls, context=None, exclude=None, only=None):
+        '''Function that dumps an instance of cls like dump(context, exclude,
+        only), without validating.'''
+        key = ('dump', context,
+               frozenset(exclude) if exclude is not None else None,
+               frozenset(only) if only is not None else None)
+        compiled = cls._compiled()
+        dump = compiled.get(key)
+        if dump is None:
+            dump = compiled[key] = cls._compile_dump(context, exclude, only)
+        return dump
+
+    @classmethod
+    def compiled_load(cls, context=None, lazy=False):
+        '''Function that loads data like load(data, context, lazy=lazy),
+        without validating.'''
+        key = ('load', context, lazy)
+        compiled = cls._compiled()
+        load = compiled.get(key)
+        if load is None:
+            load = compiled[key] = cls._compile_load(context, lazy)
+        return load
+
+    @classmethod
+    def _compile_dump(cls, context, exclude, only):
+        namespace = {}
+        lines = ['def dump(self):', '    d = {}']
+        for i, (field_name, field) in enumerate(cls.fields):
             if exclude is not None and field_name in exclude:
                 continue
             if only is not None and field_name not in only:
                 continue
 
-            field_value = self.__getattribute__(field_name)
-
             to_name = field_name
             if field.dump_to is not None:
                 if isinstance(field.dump_to, dict):
@@ -373,18 +729,79 @@ class Document(object):
                 elif isinstance(field.dump_to, str):
                     to_name = field.dump_to
 
-            return_dict[to_name] = field.serialize(field_value, context, self)
+            serializer = field.serializer(context)
+            if serializer is None:
+                lines.append('    d[%r] = self.%s' % (to_name, field_name))
+            else:
+                namespace['serialize_%d' % i] = serializer
+                lines.append('    d[%r] = serialize_%d(self.%s, self)' % (to_name, i, field_name))
+        lines.append('    return d')
 
-        return return_dict
+        exec '\n'.join(lines) in namespace
+        return namespace['dump']
 
     @classmethod
-    def load(cls, data, context=None, validate_on_load=True, strict=False):
-        if not isinstance(data, dict):
-            if strict:
-                raise ValidationError("can only load data from dicts")
-            return None
+    def _compile_load(cls, context, lazy=False):
+        lazy_fields = cls._loaded_lazily(lazy)
+        namespace = {'cls': cls, 'new': object.__new__, 'missing': _MISSING}
+        lines = ['def load(data):',
+                 '    if not isinstance(data, dict):',
+                 '        return None']
+        for i, (field_name, from_name) in enumerate(cls.fields_to_names(context)):
+            if field_name in lazy_fields:
+                continue
+            field = cls.fields[i][1]
+            unserializer = field.unserializer(context)
+            if unserializer is None:
+                lines.append('    v%d = data.get(%r)' % (i, from_name))
+            else:
+                namespace['unserialize_%d' % i] = unserializer
+                lines.append('    v%d = unserialize_%d(data.get(%r), data)' % (i, i, from_name))
+
+            if callable(field.default):
+                namespace['default_%d' % i] = field.default
+                lines.append('    if v%d is None: v%d = default_%d()' % (i, i, i))
+            elif field.default is not None:
+                namespace['default_%d' % i] = field.default
+                lines.append('    if v%d is None: v%d = default_%d' % (i, i, i))
+
+        if cls.__init__ == Document.__init__:
+            # same as __init__, without looking up every field again
+            lines.append('    o = new(cls)')
+            if lazy_fields:
+                lines.append('    o._lazy = (%r, {%s})' % (context, ', '.join(
+                    '%r: data.get(%r, missing)' % (field_name, from_name)
+                    for field_name, from_name in cls.fields_to_names(context)
+                    if field_name in lazy_fields)))
+            for i, (field_name, _) in enumerate(cls.fields):
+                if field_name not in lazy_fields:
+                    lines.append('    o.%s = v%d' % (field_name, i))
+            lines.append('    o.post_init()')
+        else:
+            lines.append('    o = cls(%s)' % ', '.join(
+                '%s=v%d' % (field_name, i) for i, (field_name, _) in enumerate(cls.fields)))
+        lines.append('    return o')
+
+        exec '\n'.join(lines) in namespace
+        return namespace['load']
 
-        init_args = dict()
+    @classmethod
+    def projection(cls, context=None, exclude=None, only=None):
+        '''Mongo projection that loads just the fields dump(context, exclude,
+        only) would write, or None for every field. Fields that aren't
+        loaded get their defaults.'''
+        if only is not None:
+            names = [name for name in cls.fields_to_names(context) if name[0] in only]
+            return dict((from_name, 1) for _, from_name in names)
+        if exclude is not None:
+            names = [name for name in cls.fields_to_names(context) if name[0] in exclude]
+            return dict((from_name, 0) for _, from_name in names)
+        return None
+
+    @classmethod
+    def fields_to_names(cls, context=None):
+        '''(field name, name it's loaded from) for each field.'''
+        names = []
         for field_name, field in cls.fields:
             from_name = field_name
             if field.load_from is not None:
@@ -392,17 +809,32 @@ class Document(object):
                     from_name = field.load_from.get(context, field_name)
                 elif isinstance(field.load_from, str):
                     from_name = field.load_from
+            names.append((field_name, from_name))
+        return names
 
-            field_value = field.unserialize(data.get(from_name), context, data)
-            if field_value is None:
-                if callable(field.default):
-                    init_args[field_name] = field.default()
-                else:
-                    init_args[field_name] = field.default
-            else:
-                init_args[field_name] = field_value
+    @classmethod
+    def load(cls, data, context=None, validate_on_load=True, strict=False, trusted=False,
+             lazy=False):
+        '''trusted is for data that was dumped by this class earlier (i.e.
+        read from the db): it isn't validated, and dump(context='db') later
+        only revalidates the fields that changed since. The loaded values are
+        kept to tell, so data must not be modified afterwards. Dumps to other
+        contexts aren't validated.
+
+        lazy leaves the fields in lazy_fields to be unserialized when they're
+        first read, for callers that may never read them. Validating reads
+        them, so this is mostly useful with trusted. Their values in data
+        are kept until then and must not be modified.'''
+        if not isinstance(data, dict):
+            if strict:
+                raise ValidationError("can only load data from dicts")
+            return None
 
-        return_document = cls(**init_args)
+        return_document = cls.compiled_load(context, lazy)(data)
+
+        if trusted:
+            return_document._loaded = (context, cls._loaded_values(context, data, lazy))
+            return return_document
 
         if validate_on_load and not return_document.validate():
             is_valid, errors = self.validate()
@@ -413,12 +845,19 @@ class Document(object):
 
         return return_document
 
-    def validate(self):
+    def validate(self, fields=None):
+        '''Validates every field, or just the given field names. The whole
+        document is validated unless fields is empty.'''
         for field_name, field in self.fields:
+            if fields is not None and field_name not in fields:
+                continue
             field_value = self.__getattribute__(field_name)
             if not field.validate(field_value):
                 return False, 'validate_field ({})'.format(field_name)
 
+        if fields is not None and not fields:
+            return True, None
+
         # validate document as a whole
         valid_document, errors = self.validate_document()
         if not valid_document:
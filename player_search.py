@@ -0,0 +1,117 @@
+from bisect import bisect_left, insort
+import re
+import threading
+
+# queries at least this long also match anywhere in a player's name
+SUBSTRING_QUERY_LENGTH = 3
+
+
+def _name_tokens(name):
+    # split on: . | space
+    return [token for token in re.split('\.|\|| ', name) if token]
+
+
+def _prefix_range(keys, prefix):
+    '''Player ids of the (key, player id) pairs in sorted keys whose key
+    starts with prefix.'''
+    i = bisect_left(keys, (prefix,))
+    while i < len(keys) and keys[i][0].startswith(prefix):
+        yield keys[i][1]
+        i += 1
+
+
+class PlayerSearchIndex(object):
+    '''In-memory typeahead index over player names and aliases.
+
+    A query matches a player if it is the player's full name, the start of
+    one of the tokens of their name or aliases, or (for queries of at least
+    SUBSTRING_QUERY_LENGTH characters) anywhere in their name. All matching
+    is case insensitive.
+
+    Tokens and name suffixes are kept in sorted lists of (key, player id), so
+    each kind of match is a binary search plus a scan over the matches. The
+    index is shared between request threads, so add, remove and search hold
+    its lock.'''
+
+    def __init__(self, players=()):
+        self.lock = threading.Lock()
+        # player id -> (player, lowercase name, tokens, suffixes)
+        self.entries = {}
+        # lowercase name -> set of player ids
+        self.names = {}
+
+        tokens = []
+        suffixes = []
+        for player in players:
+            entry = self._entry(player)
+            self.entries[player.id] = entry
+            self.names.setdefault(entry[1], set()).add(player.id)
+            tokens.extend((token, player.id) for token in entry[2])
+            suffixes.extend((suffix, player.id) for suffix in entry[3])
+        self.tokens = sorted(tokens)
+        self.suffixes = sorted(suffixes)
+
+    def _entry(self, player):
+        name = player.name.lower()
+        tokens = set(_name_tokens(name))
+        for alias in player.aliases:
+            tokens.update(_name_tokens(alias.lower()))
+        suffixes = set(name[i:] for i in xrange(len(name)))
+        return player, name, tokens, suffixes
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, player):
+        '''Adds player, replacing an older version of it.'''
+        entry = self._entry(player)
+        with self.lock:
+            self._add(entry)
+
+    def _add(self, entry):
+        player = entry[0]
+        old_entry = self.entries.get(player.id)
+        if old_entry is not None and old_entry[1:] == entry[1:]:
+            # nothing we search on changed (e.g. a ratings update)
+            self.entries[player.id] = entry
+            return
+
+        self._remove(player.id)
+        self.entries[player.id] = entry
+        self.names.setdefault(entry[1], set()).add(player.id)
+        for token in entry[2]:
+            insort(self.tokens, (token, player.id))
+        for suffix in entry[3]:
+            insort(self.suffixes, (suffix, player.id))
+
+    def remove(self, player_id):
+        with self.lock:
+            self._remove(player_id)
+
+    def _remove(self, player_id):
+        entry = self.entries.pop(player_id, None)
+        if entry is None:
+            return
+        self.names[entry[1]].discard(player_id)
+        for token in entry[2]:
+            del self.tokens[bisect_left(self.tokens, (token, player_id))]
+        for suffix in entry[3]:
+            del self.suffixes[bisect_left(self.suffixes, (suffix, player_id))]
+
+    def search(self, query, limit=None):
+        '''Players matching query sorted by name, with exact name matches
+        first.'''
+        query = query.lower()
+        with self.lock:
+            exact_ids = set(self.names.get(query, ()))
+            matching_ids = set(exact_ids)
+            matching_ids.update(_prefix_range(self.tokens, query))
+            if len(query) >= SUBSTRING_QUERY_LENGTH:
+                matching_ids.update(_prefix_range(self.suffixes, query))
+            exact_players = [self.entries[id][0] for id in exact_ids]
+            other_players = [self.entries[id][0] for id in matching_ids - exact_ids]
+
+        exact_matches = sorted(exact_players, key=lambda player: player.name)
+        other_matches = sorted(other_players, key=lambda player: player.name)
+        matches = exact_matches + other_matches
+        return matches[:limit] if limit is not None else matches
@@ -0,0 +1,141 @@
+from bson.objectid import ObjectId
+from datetime import datetime
+import Queue
+import threading
+import traceback
+
+import model as M
+import rankings
+
+from dao import Dao
+
+
+class RankingJobQueue(object):
+    '''Runs ranking generation off the request thread. Jobs are stored in the
+    ranking_jobs collection so their progress can be polled, and run one at a
+    time on a single daemon worker thread.
+
+    Submitting while the region has a queued job updates that job to the
+    new parameters and returns it. Submitting while a job with the same
+    parameters is running returns the running job, and a job with different
+    parameters is queued to run after it.'''
+
+    def __init__(self, start_worker=True):
+        self.start_worker = start_worker
+        self.pending = Queue.Queue()
+        self.active_jobs = {}
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def submit(self, dao, now, day_limit=60, num_tourneys=2,
+               tournament_qualified_day_limit=999, tournament_to_diff=None):
+        parameters = {
+            'day_limit': day_limit,
+            'num_tourneys': num_tourneys,
+            'tournament_qualified_day_limit': tournament_qualified_day_limit,
+            'tournament_to_diff': tournament_to_diff.id if tournament_to_diff else None}
+
+        with self.lock:
+            # the latest job of the region, the worker only starts a job
+            # while holding the lock
+            job = self.active_jobs.get(dao.region_id)
+            if job is not None:
+                if job.status == 'queued':
+                    job.ranking_time = now
+                    for name, value in parameters.items():
+                        setattr(job, name, value)
+                    dao.update_ranking_job(job)
+                    return job
+                if job.status == 'running' and \
+                        all(getattr(job, name) == value for name, value in parameters.items()):
+                    return job
+
+            job = M.RankingJob(
+                id=ObjectId(),
+                region=dao.region_id,
+                status='queued',
+                ranking_time=now,
+                time_queued=datetime.now(),
+                **parameters)
+            dao.insert_ranking_job(job)
+            self.active_jobs[dao.region_id] = job
+            self.pending.put((job, dao))
+
+            if self.start_worker and self.worker is None:
+                self.worker = threading.Thread(target=self._work)
+                self.worker.daemon = True
+                self.worker.start()
+
+        return job
+
+    def run_pending(self):
+        '''Runs queued jobs on the calling thread until the queue is empty.
+        Used when the queue is created without a worker thread (tests).'''
+        while True:
+            try:
+                job, dao = self.pending.get_nowait()
+            except Queue.Empty:
+                return
+            self._run(job, dao)
+
+    def _work(self):
+        while True:
+            job, dao = self.pending.get()
+            try:
+                self._run(job, dao)
+            except Exception:
+                # _run records its own errors, this only keeps the worker alive
+                traceback.print_exc()
+
+    def _run(self, job, request_dao):
+        # the job is recorded through the request's dao, which works even if
+        # we couldn't create a dao for the region (e.g. it was deleted)
+        try:
+            self._generate(job, request_dao)
+            job.status = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            try:
+                job.time_finished = datetime.now()
+                request_dao.update_ranking_job(job)
+            finally:
+                with self.lock:
+                    # unless a follow-up job was queued meanwhile
+                    if self.active_jobs.get(job.region) is job:
+                        del self.active_jobs[job.region]
+
+    def _generate(self, job, request_dao):
+        # the request's dao caches players loaded during the request
+        dao = Dao(job.region, request_dao.mongo_client, database_name=request_dao.database_name)
+
+        with self.lock:
+            job.status = 'running'
+        job.time_started = datetime.now()
+        dao.update_ranking_job(job)
+
+        def progress(tournaments_processed=None, tournaments_total=None, players_updated=None):
+            if tournaments_processed is not None:
+                job.tournaments_processed = tournaments_processed
+            if tournaments_total is not None:
+                job.tournaments_total = tournaments_total
+            if players_updated is not None:
+                job.players_updated = players_updated
+            dao.update_ranking_job(job)
+
+        tournament_to_diff = None
+        if job.tournament_to_diff is not None:
+            tournament_to_diff = dao.get_tournament_by_id(job.tournament_to_diff)
+
+        ranking = rankings.generate_ranking(
+            dao, now=job.ranking_time,
+            day_limit=job.day_limit,
+            num_tourneys=job.num_tourneys,
+            tournament_qualified_day_limit=job.tournament_qualified_day_limit,
+            tournament_to_diff=tournament_to_diff,
+            incremental=True,
+            progress=progress,
+            record_history=True)
+        job.ranking = ranking.id
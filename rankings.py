@@ -1,6 +1,7 @@
 from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 
+import bisect
 import trueskill
 
 import model
@@ -13,9 +14,58 @@ def generate_ranking(
         day_limit=60,
         num_tourneys=2,
         tournament_qualified_day_limit=999,
-        tournament_to_diff=None):
-    tournaments = dao.get_all_tournaments(regions=[dao.region_id])
-    ranking_to_diff_against = None
+        tournament_to_diff=None,
+        incremental=False,
+        progress=None,
+        record_history=False):
+    '''If incremental is set, replay starts from the region's ranking
+    checkpoint and only tournaments after it are replayed. Writes to a
+    checkpointed tournament through the Dao (edits, exclusions, merges)
+    invalidate the checkpoint, and a checkpoint whose tournaments are no
+    longer the oldest qualified ones is ignored; either way we do a full
+    replay.
+
+    progress, if given, is called with keyword arguments
+    tournaments_processed/tournaments_total while replaying and
+    players_updated once the players are saved.
+
+    If record_history is set, every player's rating after each replayed
+    tournament is saved to the region's rating history.'''
+    # the replay makes several passes over the tournaments so they're all
+    # kept. each keeps its stored matches until they're first read (i.e.
+    # replayed), then only the unserialized ones
+    checkpoint_token = dao.get_ranking_checkpoint_token()
+    tournaments = list(dao.iter_tournaments(regions=[dao.region_id]))
+    checkpoint = dao.get_ranking_checkpoint() if incremental else None
+
+    ranking, checkpoint = _create_ranking_from_tournament_list(
+        dao, tournaments, now, day_limit, num_tourneys, tournament_qualified_day_limit, tournament_to_diff,
+        checkpoint=checkpoint, progress=progress, record_history=record_history)
+
+    dao.insert_ranking(ranking)
+    if not dao.update_ranking_checkpoint(checkpoint, token=checkpoint_token):
+        print 'Tournaments changed during the replay, not saving the checkpoint'
+    return ranking
+
+
+def _create_ranking_from_tournament_list(
+        dao,
+        tournaments,
+        now,
+        day_limit,
+        num_tourneys,
+        tournament_qualified_day_limit,
+        tournament_to_diff,
+        checkpoint=None,
+        progress=None,
+        record_history=False):
+    qualified_tournaments = _get_qualified_tournaments(
+        tournaments, now, tournament_qualified_day_limit)
+
+    # the ranking we diff against is the ranking as of tournament_to_diff. if
+    # its replay is a prefix of this one we snapshot the ratings on the way
+    # instead of replaying twice
+    snapshot_after = None
     if tournament_to_diff:
         tournaments_for_diff = []
         for tournament in tournaments:
@@ -23,100 +73,242 @@ def generate_ranking(
             if tournament.id == tournament_to_diff.id:
                 break
 
-        ranking_to_diff_against = _create_ranking_from_tournament_list(
-            dao, tournaments_for_diff, tournament_to_diff.date, day_limit, num_tourneys, tournament_qualified_day_limit, None)
+        qualified_tournaments_for_diff = _get_qualified_tournaments(
+            tournaments_for_diff, tournament_to_diff.date, tournament_qualified_day_limit)
+        num_qualified_for_diff = len(qualified_tournaments_for_diff)
+        if [t.id for t in qualified_tournaments_for_diff] == \
+                [t.id for t in qualified_tournaments[:num_qualified_for_diff]]:
+            snapshot_after = num_qualified_for_diff
+            if checkpoint is not None and len(checkpoint.tournaments) > snapshot_after:
+                print 'Checkpoint is past the tournament to diff, doing a full replay'
+                checkpoint = None
+
+    # a checkpoint from a run that didn't record history can't be resumed
+    # from, the history of the tournaments before it would be missing
+    if record_history and checkpoint is not None and not checkpoint.history:
+        checkpoint = None
 
+    history = {} if record_history else None
+    rater, player_id_to_player_map, snapshot, num_resumed = _replay(
+        dao, qualified_tournaments, checkpoint, snapshot_after=snapshot_after, progress=progress,
+        history=history)
 
-    dao.insert_ranking(_create_ranking_from_tournament_list(
-        dao, tournaments, now, day_limit, num_tourneys, tournament_qualified_day_limit, ranking_to_diff_against))
+    ranking_to_diff_against = None
+    if tournament_to_diff:
+        if snapshot is None:
+            print 'Replaying tournaments up to the tournament to diff separately'
+            snapshot = _replay(dao, qualified_tournaments_for_diff, None)[:2]
+        diff_rater, diff_player_id_to_player_map = snapshot
+        ranking_to_diff_against = model.Ranking(
+            id=ObjectId(),
+            region=dao.region_id,
+            time=tournament_to_diff.date,
+            tournaments=[t.id for t in tournaments_for_diff],
+            ranking=_rank_players(
+                dao, diff_rater, diff_player_id_to_player_map.values(), tournaments_for_diff,
+                qualified_tournaments_for_diff, tournament_to_diff.date, day_limit, num_tourneys, None))
 
+    print 'Checking for player inactivity...'
+    players = player_id_to_player_map.values()
+    ranking = _rank_players(
+        dao, rater, players, tournaments, qualified_tournaments, now, day_limit, num_tourneys,
+        ranking_to_diff_against)
 
-def _create_ranking_from_tournament_list(
+    print 'Updating players...'
+    for player_id, player in player_id_to_player_map.items():
+        player.ratings[dao.region_id] = rater.get_rating(player_id)
+    dao.update_players(players)
+    if progress:
+        progress(players_updated=len(players))
+
+    if record_history:
+        print 'Updating rating history...'
+        dao.update_rating_histories(
+            history, [t.id for t in qualified_tournaments[num_resumed:]], replace=num_resumed == 0)
+
+    new_checkpoint = model.RankingCheckpoint(
+        id=dao.region_id,
+        time=now,
+        tournaments=[t.id for t in qualified_tournaments],
+        ratings={str(player_id): rater.get_rating(player_id)
+                 for player_id in player_id_to_player_map},
+        history=record_history)
+
+    print 'Returning new ranking...'
+    return model.Ranking(
+        id=ObjectId(),
+        region=dao.region_id,
+        time=now,
+        tournaments=[t.id for t in tournaments],
+        ranking=ranking), new_checkpoint
+
+
+def _get_qualified_tournaments(tournaments, now, tournament_qualified_day_limit):
+    tournament_qualified_date = (now - timedelta(days=tournament_qualified_day_limit))
+    print('Qualified Date: ' + str(tournament_qualified_date))
+
+    return [tournament for tournament in tournaments
+            if tournament_qualified_date <= tournament.date]
+
+
+def _replay(dao, tournaments, checkpoint, snapshot_after=None, progress=None, history=None):
+    '''Replays tournaments, starting from checkpoint if it is still valid.
+    Returns (rater, player id -> player, snapshot, number of
+    tournaments resumed from the checkpoint) where snapshot is a copy of
+    (rater, player id -> player) taken after the first snapshot_after
+    tournaments, or None if no snapshot was asked for.
+
+    If history is a dict, each player's rating after every replayed
+    tournament they played is appended to history[player id].'''
+    rater = rating_calculators.TrueSkillBatchRater()
+    num_replayed, player_id_to_player_map = _resume_from_checkpoint(
+        dao, rater, tournaments, checkpoint)
+    if num_replayed:
+        print 'Resuming from checkpoint after', num_replayed, 'tournaments'
+    if progress:
+        progress(tournaments_processed=num_replayed, tournaments_total=len(tournaments))
+
+    players_by_id = dao.get_players_by_ids(
+        [player_id for tournament in tournaments[num_replayed:]
+         for match in tournament.matches if match.excluded is not True
+         for player_id in (match.winner, match.loser)
+         if player_id not in player_id_to_player_map])
+
+    snapshot = None
+    for i in xrange(num_replayed, len(tournaments)):
+        if i == snapshot_after:
+            snapshot = (rater.copy(), dict(player_id_to_player_map))
+
+        tournament = tournaments[i]
+        print 'Processing:', tournament.name.encode('utf-8'), str(tournament.date)
+        rated_player_ids = _replay_tournament(rater, tournament, players_by_id, player_id_to_player_map)
+        if history is not None:
+            for player_id in rated_player_ids:
+                rating = rater.get_rating(player_id)
+                history.setdefault(player_id, []).append(model.RatingHistoryEntry(
+                    tournament=tournament.id, date=tournament.date, mu=rating.mu, sigma=rating.sigma))
+        if progress:
+            progress(tournaments_processed=i + 1, tournaments_total=len(tournaments))
+
+    if snapshot_after == len(tournaments):
+        snapshot = (rater.copy(), dict(player_id_to_player_map))
+
+    return rater, player_id_to_player_map, snapshot, num_replayed
+
+
+def _rank_players(
         dao,
+        rater,
+        players,
         tournaments,
+        qualified_tournaments,
         now,
         day_limit,
         num_tourneys,
-        tournament_qualified_day_limit,
         ranking_to_diff_against):
     player_date_map = {}
-    player_id_to_player_map = {}
-
-    tournament_qualified_date = (now - timedelta(days=tournament_qualified_day_limit))
-    print('Qualified Date: ' + str(tournament_qualified_date))
-
-    for tournament in tournaments:
-        if tournament_qualified_date <= tournament.date:
-            print 'Processing:', tournament.name.encode('utf-8'), str(tournament.date)
-            for player_id in tournament.players:
-                player_date_map[player_id] = tournament.date
-
-            # TODO add a default rating entry when we add it to the map
-            for match in tournament.matches:
-                if match.excluded is True:
-                    print('match excluded:')
-                    print('Tournament: ' + str(tournament.name))
-                    print(str(match))
-                    continue
-
-                if match.winner not in player_id_to_player_map:
-                    db_player = dao.get_player_by_id(match.winner)
-                    db_player.ratings[dao.region_id] = model.Rating()
-                    player_id_to_player_map[match.winner] = db_player
-
-                if match.loser not in player_id_to_player_map:
-                    db_player = dao.get_player_by_id(match.loser)
-                    db_player.ratings[dao.region_id] = model.Rating()
-                    player_id_to_player_map[match.loser] = db_player
-
-                winner = player_id_to_player_map[match.winner]
-                loser = player_id_to_player_map[match.loser]
-
-                rating_calculators.update_trueskill_ratings(
-                    dao.region_id, winner=winner, loser=loser)
+    for tournament in qualified_tournaments:
+        for player_id in tournament.players:
+            player_date_map[player_id] = tournament.date
 
-    print 'Checking for player inactivity...'
-    rank = 1
-    players = player_id_to_player_map.values()
+    exposed_ratings = {player.id: trueskill.expose(rater.get_rating(player.id).trueskill_rating())
+                       for player in players}
     sorted_players = sorted(
         players,
-        key=lambda player: (trueskill.expose(player.ratings[dao.region_id].trueskill_rating()), player.name),
+        key=lambda player: (exposed_ratings[player.id], player.name),
         reverse=True)
+
+    attendance_index = _build_attendance_index(tournaments)
+    rank = 1
     ranking = []
     for player in sorted_players:
         player_last_active_date = player_date_map.get(player.id)
-        if _is_player_inactive(dao, player, tournaments, player_last_active_date, now, day_limit, num_tourneys):
+        if _is_player_inactive(dao, player, attendance_index, player_last_active_date, now, day_limit, num_tourneys):
             pass  # do nothing, skip this player
         else:
             ranking.append(model.RankingEntry(
                 rank=rank,
                 player=player.id,
-                rating=trueskill.expose(player.ratings[dao.region_id].trueskill_rating()),
+                rating=exposed_ratings[player.id],
                 previous_rank=ranking_to_diff_against.get_ranking_for_player_id(player.id) if ranking_to_diff_against else None))
             rank += 1
 
-    print 'Updating players...'
-    for i, p in enumerate(players, start=1):
-        dao.update_player(p)
-        # TODO: log somewhere later
-        # print 'Updated player %d of %d' % (i, len(players))
+    return ranking
 
-    print 'Returning new ranking...'
-    return model.Ranking(
-        id=ObjectId(),
-        region=dao.region_id,
-        time=now,
-        tournaments=[t.id for t in tournaments],
-        ranking=ranking)
+
+def _replay_tournament(rater, tournament, players_by_id, player_id_to_player_map):
+    '''Rates all non-excluded matches of the tournament in one batch.
+    players_by_id must contain every player that hasn't played yet. Returns
+    the ids of the players that were rated.'''
+    winner_ids = []
+    loser_ids = []
+    for match in tournament.matches:
+        if match.excluded is True:
+            print('match excluded:')
+            print('Tournament: ' + str(tournament.name))
+            print(str(match))
+            continue
+
+        for player_id in (match.winner, match.loser):
+            if player_id not in player_id_to_player_map:
+                player_id_to_player_map[player_id] = players_by_id[player_id]
+                rater.add_player(player_id, model.Rating())
+
+        winner_ids.append(match.winner)
+        loser_ids.append(match.loser)
+
+    if winner_ids:
+        rater.rate_matches(winner_ids, loser_ids)
+    return set(winner_ids) | set(loser_ids)
+
+
+def _resume_from_checkpoint(dao, rater, qualified_tournaments, checkpoint):
+    '''Loads the checkpointed ratings into rater and returns (number of
+    tournaments already replayed, player id -> player). Falls back to a full
+    replay (0, {}) if the checkpoint is missing or stale. The Dao invalidates
+    checkpoints whose tournaments were written to, so this only compares
+    tournament ids and doesn't read any matches.'''
+    if checkpoint is None:
+        return 0, {}
+
+    num_replayed = len(checkpoint.tournaments)
+    replayed_tournaments = qualified_tournaments[:num_replayed]
+    if [t.id for t in replayed_tournaments] != checkpoint.tournaments:
+        print 'Checkpoint tournaments differ, doing a full replay'
+        return 0, {}
+
+    player_id_to_player_map = dao.get_players_by_ids(
+        [ObjectId(player_id) for player_id in checkpoint.ratings])
+    if len(player_id_to_player_map) != len(checkpoint.ratings):
+        print 'Checkpointed players are missing, doing a full replay'
+        return 0, {}
+
+    for player_id, rating in checkpoint.ratings.items():
+        rater.add_player(ObjectId(player_id), rating)
+
+    return num_replayed, player_id_to_player_map
+
+
+def _build_attendance_index(tournaments):
+    '''Returns a map from player id -> sorted dates of the tournaments they
+    attended.'''
+    attendance_index = {}
+    for tournament in tournaments:
+        for player_id in tournament.players:
+            attendance_index.setdefault(player_id, []).append(tournament.date)
+
+    for dates in attendance_index.values():
+        dates.sort()
+
+    return attendance_index
 
 
-def _is_player_inactive(dao, player, tournaments, player_last_active_date, now, day_limit, num_tourneys):
+def _is_player_inactive(dao, player, attendance_index, player_last_active_date, now, day_limit, num_tourneys):
     if (player_last_active_date is None or
         dao.region_id not in player.regions):
       return True
 
-    tournaments_for_player = [
-        tournament for tournament in tournaments if
-        tournament.contains_player(player) and tournament.date >= (now - timedelta(days=day_limit))]
+    dates = attendance_index.get(player.id, [])
+    num_recent_tournaments = len(dates) - bisect.bisect_left(dates, now - timedelta(days=day_limit))
 
-    return len(tournaments_for_player) < num_tourneys
+    return num_recent_tournaments < num_tourneys
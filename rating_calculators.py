@@ -1,3 +1,5 @@
+import math
+import numpy
 import trueskill
 from model import Rating
 
@@ -12,3 +14,98 @@ def update_trueskill_ratings(region_id, winner=None, loser=None):
 
     winner_ratings_dict[region_id] = Rating.from_trueskill(new_winner_rating)
     loser_ratings_dict[region_id] = Rating.from_trueskill(new_loser_rating)
+
+
+def _erfc(x):
+    # same approximation trueskill's default backend uses, so batched results
+    # agree with trueskill.rate_1vs1 up to floating point error
+    z = numpy.abs(x)
+    t = 1. / (1. + z / 2.)
+    r = t * numpy.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (
+                      0.37409196 + t * (0.09678418 + t * (
+                      -0.18628806 + t * (0.27886807 + t * (
+                      -1.13520398 + t * (1.48851587 + t * (
+                      -0.82215223 + t * 0.17087277)))))))))
+    return numpy.where(x < 0, 2. - r, r)
+
+
+def _cdf(x):
+    return 0.5 * _erfc(-x / math.sqrt(2))
+
+
+def _pdf(x):
+    return numpy.exp(-x ** 2 / 2) / math.sqrt(2 * math.pi)
+
+
+class TrueSkillBatchRater(object):
+    '''Rates 1v1 matches in bulk. mu and sigma live in numpy arrays indexed
+    by player slot, so replaying a match list doesn't create any Rating
+    objects. Results match trueskill.rate_1vs1 (with the global environment)
+    to within 1e-6.'''
+
+    def __init__(self, env=None):
+        self.env = env or trueskill.global_env()
+        self.draw_margin = trueskill.calc_draw_margin(
+            self.env.draw_probability, 2, env=self.env)
+        self.slots = {}
+        self.mu = numpy.zeros(16)
+        self.sigma = numpy.zeros(16)
+
+    def add_player(self, player_id, rating=None):
+        if rating is None:
+            rating = Rating(mu=self.env.mu, sigma=self.env.sigma)
+        slot = len(self.slots)
+        if slot == len(self.mu):
+            self.mu = numpy.resize(self.mu, 2 * slot)
+            self.sigma = numpy.resize(self.sigma, 2 * slot)
+        self.slots[player_id] = slot
+        self.mu[slot] = rating.mu
+        self.sigma[slot] = rating.sigma
+
+    def copy(self):
+        rater = TrueSkillBatchRater(env=self.env)
+        rater.slots = dict(self.slots)
+        rater.mu = self.mu.copy()
+        rater.sigma = self.sigma.copy()
+        return rater
+
+    def get_rating(self, player_id):
+        slot = self.slots[player_id]
+        return Rating(mu=float(self.mu[slot]), sigma=float(self.sigma[slot]))
+
+    def rate_matches(self, winner_ids, loser_ids):
+        '''Applies an ordered list of matches (winner_ids[i] beat
+        loser_ids[i]). All players must have been added already.'''
+        winners = numpy.array([self.slots[p] for p in winner_ids], dtype=int)
+        losers = numpy.array([self.slots[p] for p in loser_ids], dtype=int)
+
+        # a match can be rated together with earlier matches as long as
+        # neither player has played since, so split the list into waves where
+        # nobody appears twice and rate each wave in one vectorized step
+        last_wave = {}
+        waves = numpy.empty(len(winners), dtype=int)
+        for i, (winner, loser) in enumerate(zip(winners, losers)):
+            wave = max(last_wave.get(winner, -1), last_wave.get(loser, -1)) + 1
+            last_wave[winner] = last_wave[loser] = waves[i] = wave
+
+        order = numpy.argsort(waves, kind='mergesort')
+        boundaries = numpy.flatnonzero(numpy.diff(waves[order])) + 1
+        for wave in numpy.split(order, boundaries):
+            if len(wave):
+                self._rate_wave(winners[wave], losers[wave])
+
+    def _rate_wave(self, winners, losers):
+        tau_squared = self.env.tau ** 2
+        winner_var = self.sigma[winners] ** 2 + tau_squared
+        loser_var = self.sigma[losers] ** 2 + tau_squared
+
+        c = numpy.sqrt(2 * self.env.beta ** 2 + winner_var + loser_var)
+        x = (self.mu[winners] - self.mu[losers] - self.draw_margin) / c
+        denom = _cdf(x)
+        v = numpy.where(denom > 0, _pdf(x) / numpy.where(denom > 0, denom, 1.), -x)
+        w = v * (v + x)
+
+        self.mu[winners] += winner_var / c * v
+        self.mu[losers] -= loser_var / c * v
+        self.sigma[winners] = numpy.sqrt(winner_var * (1 - winner_var / c ** 2 * w))
+        self.sigma[losers] = numpy.sqrt(loser_var * (1 - loser_var / c ** 2 * w))
@@ -0,0 +1,65 @@
+# script to measure how much memory the tournaments of a region take once
+#   loaded, and how much the embedded documents with use_slots save compared
+#   to the same documents with a __dict__ per instance.
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from config.config import Config
+from dao import Dao
+
+import model as M
+import orm
+
+def instance_size(instance):
+    size = sys.getsizeof(instance)
+    if hasattr(instance, '__dict__'):
+        size += sys.getsizeof(instance.__dict__)
+    return size
+
+def without_slots(document_type):
+    '''Same document with a __dict__ per instance, for comparison.'''
+    return type(document_type.__name__, (orm.Document,),
+                {'collection_name': None, 'fields': document_type.fields})
+
+def benchmark(region_id):
+    config = Config()
+    dao = Dao(region_id, MongoClient(host=config.get_mongo_url()))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    tournaments = dao.get_all_tournaments(regions=[region_id])
+    # matches are only built when first read, so read them before measuring
+    matches = [match for tournament in tournaments for match in tournament.matches]
+    seconds = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print "loaded %d tournaments with %d matches in %.2fs" % (len(tournaments), len(matches), seconds)
+    print "max resident memory grew by %.1f MB" % ((rss_after - rss_before) / 1024.)
+
+    if not matches:
+        return
+
+    # compare against the same matches with a __dict__
+    dict_match_type = without_slots(M.Match)
+    slots_size = instance_size(matches[0])
+    dict_size = instance_size(dict_match_type.load(matches[0].dump(context='db'), context='db'))
+    print
+    print "%-20s %10s %10s" % ('', 'per match', 'total MB')
+    print "%-20s %10d %10.1f" % ('__slots__', slots_size, slots_size * len(matches) / 1024. ** 2)
+    print "%-20s %10d %10.1f" % ('__dict__', dict_size, dict_size * len(matches) / 1024. ** 2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('region', help='region whose tournaments to load')
+    args = parser.parse_args()
+
+    benchmark(args.region)
@@ -0,0 +1,41 @@
+# script to create the indexes declared on the model documents, and report
+#   declared indexes that are missing and existing indexes that are unused or
+#   not declared. creating indexes is idempotent, so this is safe to rerun.
+
+import argparse
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from config.config import Config
+
+import indexes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--report', help='only report, don\'t create missing indexes',
+                        action='store_true')
+    args = parser.parse_args()
+
+    config = Config()
+    mongo_client = MongoClient(host=config.get_mongo_url())
+    database_name = config.get_db_name()
+
+    if not args.report:
+        for collection_name, index_name in indexes.ensure_indexes(mongo_client, database_name):
+            print 'ensured', collection_name, index_name
+
+    for collection_name, result in sorted(indexes.report_indexes(mongo_client, database_name).items()):
+        for index_name in result['missing']:
+            print '[MISSING]', collection_name, index_name
+        for index_name in result['undeclared']:
+            print '[UNDECLARED]', collection_name, index_name
+        if result['unused'] is None:
+            print '[UNKNOWN USAGE]', collection_name, '(server does not support $indexStats)'
+        else:
+            for index_name in result['unused']:
+                print '[UNUSED]', collection_name, index_name
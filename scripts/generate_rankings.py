@@ -0,0 +1,97 @@
+# script to regenerate rankings for every region (or the regions given on the
+#   command line) in parallel. regions don't share tournaments or ratings, so
+#   each one is generated by its own worker process.
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from datetime import datetime
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from config.config import Config
+from dao import Dao
+
+import rankings
+
+# one MongoClient per worker process, created after the fork (pymongo clients
+# are not fork-safe)
+mongo_client = None
+
+def init_worker():
+    global mongo_client
+    config = Config()
+    mongo_client = MongoClient(host=config.get_mongo_url())
+
+def generate_region_ranking(args):
+    region, now, incremental = args
+    start = time.time()
+    try:
+        dao = Dao(region.id, mongo_client)
+        rankings.generate_ranking(
+            dao, now=now,
+            day_limit=region.ranking_activity_day_limit,
+            num_tourneys=region.ranking_num_tourneys_attended,
+            tournament_qualified_day_limit=region.tournament_qualified_day_limit,
+            incremental=incremental,
+            record_history=True)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return region.id, time.time() - start, error
+
+def generate_rankings(region_ids=None, processes=None, incremental=True):
+    config = Config()
+    regions = Dao.get_all_regions(MongoClient(host=config.get_mongo_url()))
+    if region_ids:
+        unknown_ids = set(region_ids) - set(region.id for region in regions)
+        if unknown_ids:
+            print "unknown regions:", ', '.join(sorted(unknown_ids))
+            sys.exit(1)
+        regions = [region for region in regions if region.id in region_ids]
+
+    now = datetime.now()
+    start = time.time()
+    pool = multiprocessing.Pool(processes=processes, initializer=init_worker)
+    try:
+        results = []
+        for region_id, seconds, error in pool.imap_unordered(
+                generate_region_ranking, [(region, now, incremental) for region in regions]):
+            print "finished", region_id, "in %.1fs" % seconds
+            results.append((region_id, seconds, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    print
+    print "%-20s %10s  %s" % ('region', 'seconds', 'status')
+    for region_id, seconds, error in sorted(results, key=lambda r: -r[1]):
+        print "%-20s %10.1f  %s" % (region_id, seconds, 'failed' if error else 'ok')
+    print "%d regions in %.1fs" % (len(results), time.time() - start)
+
+    failed = [r for r in results if r[2]]
+    for region_id, _, error in failed:
+        print
+        print "error generating rankings for", region_id
+        print error
+
+    return not failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('regions', nargs='*',
+                        help='regions to regenerate (default: all regions)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: number of cpus)')
+    parser.add_argument('--full', action='store_true',
+                        help='replay every tournament instead of resuming from checkpoints')
+    args = parser.parse_args()
+
+    if not generate_rankings(args.regions, processes=args.processes, incremental=not args.full):
+        sys.exit(1)
@@ -0,0 +1,22 @@
+# one time backfill of the matches collection (each match from the point of
+#   view of both players) that match history and head to head are served
+#   from. only writes tournaments that don't have their player matches yet,
+#   so it is safe to rerun, and the deploy scripts run it on every deploy.
+#   to rewrite the whole collection, use scripts/rebuild_matches.py.
+
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../../'))
+
+from config.config import Config
+from dao import Dao
+
+config = Config()
+mongo_client = MongoClient(host=config.get_mongo_url())
+dao = Dao(None, mongo_client, database_name=config.get_db_name())
+
+print 'backfilled the player matches of', dao.rebuild_player_matches(missing_only=True), 'tournaments'
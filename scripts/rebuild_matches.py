@@ -0,0 +1,22 @@
+# script to rebuild the matches collection (each match from the point of view
+#   of both players) from the tournaments. the Dao keeps it in sync on every
+#   tournament write, so this is only needed once for databases created before
+#   the collection existed, or to repair it.
+
+import os
+import sys
+
+from pymongo import MongoClient
+
+# add root directory to python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
+
+from config.config import Config
+from dao import Dao
+
+if __name__ == '__main__':
+    config = Config()
+    mongo_client = MongoClient(host=config.get_mongo_url())
+    dao = Dao(None, mongo_client)
+    dao.rebuild_player_matches()
+    print 'rebuilt', dao.player_matches_col.count(), 'player matches'
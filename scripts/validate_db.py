@@ -13,6 +13,7 @@ from pymongo import MongoClient
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
 
 from config.config import Config
+from dao import Dao
 
 import model as M
 
@@ -20,6 +21,8 @@ def validate(fix=False):
     config = Config()
     mongo_client = MongoClient(host=config.get_mongo_url())
     database_name = config.get_db_name()
+    # not tied to a region, only used to stream whole collections
+    dao = Dao(None, mongo_client, database_name=database_name)
 
     # db collections
     players_col = mongo_client[database_name][M.Player.collection_name]
@@ -33,19 +36,18 @@ def validate(fix=False):
     regions_col = mongo_client[database_name][M.Region.collection_name]
 
     # get sets of ids for cross-referencing
-    player_ids = set([p.get('_id') for p in players_col.find()])
-    tournament_ids = set([t.get('_id') for t in tournaments_col.find()])
-    ranking_ids = set([r.get('_id') for r in rankings_col.find()])
-    user_ids = set([u.get('_id') for u in users_col.find()])
-    pending_tournament_ids = set([pt.get('_id') for pt in pending_tournaments_col.find()])
-    merge_ids = set([m.get('_id') for m in merges_col.find()])
+    player_ids = set([p.get('_id') for p in players_col.find({}, {'_id': 1})])
+    tournament_ids = set([t.get('_id') for t in tournaments_col.find({}, {'_id': 1})])
+    ranking_ids = set([r.get('_id') for r in rankings_col.find({}, {'_id': 1})])
+    user_ids = set([u.get('_id') for u in users_col.find({}, {'_id': 1})])
+    pending_tournament_ids = set([pt.get('_id') for pt in pending_tournaments_col.find({}, {'_id': 1})])
+    merge_ids = set([m.get('_id') for m in merges_col.find({}, {'_id': 1})])
     raw_file_ids = set([rf.get('_id')
         for rf in raw_files_col.find({}, {'data': 0})])
     region_ids = set([r.get('_id') for r in regions_col.find()])
 
     # Player checks
-    for p in players_col.find():
-        player = M.Player.load(p, context='db')
+    for player in dao.iter_players(all_regions=True, include_merged=True):
         error_header = '[ERROR player "{}" ({})]'.format(player.id, player.name)
         modified = False
 
@@ -99,8 +101,7 @@ def validate(fix=False):
 
 
     # Tournament checks
-    for t in tournaments_col.find():
-        tournament = M.Tournament.load(t, context='db')
+    for tournament in dao.iter_tournaments():
         error_header = '[ERROR tournament "{}" ({})]'.format(tournament.id, tournament.name)
         modified = False
 
@@ -159,8 +160,7 @@ def validate(fix=False):
 
 
     # Pending Tournament checks
-    for pt in pending_tournaments_col.find():
-        tournament = M.PendingTournament.load(pt, context='db')
+    for tournament in dao.iter_pending_tournaments():
         error_header = '[ERROR pending_tournament "{}" ({})]'.format(tournament.id, tournament.name)
 
         # check: pt valid
@@ -189,8 +189,11 @@ def validate(fix=False):
 
 
     # Ranking checks
-    for r in rankings_col.find():
-        ranking = M.Ranking.load(r, context='db')
+    # fixes are written after all rankings are checked, since deltas (see
+    # Dao.insert_ranking) are expanded from their snapshot's tournaments
+    ranking_fixes = []
+    for r in rankings_col.find({}, {'_id': 1}):
+        ranking = dao.get_ranking_by_id(r['_id'])
         error_header = '[ERROR ranking ({})]'.format(ranking.id)
         modified = False
 
@@ -218,7 +221,14 @@ def validate(fix=False):
 
         if fix and modified:
             print error_header, 'fixing ranking..'
-            rankings_col.update({'_id': ranking.id}, ranking.dump(context='db'))
+            ranking_fixes.append(ranking)
+
+    for ranking in ranking_fixes:
+        # only set the fixed field, deltas carry extra keys that a full
+        # replace would drop. deltas get their full tournaments list
+        rankings_col.update({'_id': ranking.id},
+                            {'$set': {'tournaments': ranking.tournaments},
+                             '$unset': {'base_tournaments': ''}})
 
 
     # User checks
@@ -305,14 +315,13 @@ def validate(fix=False):
 
     # check: no player with no tournaments
     pt_lists = {pid: [] for pid in player_ids}
-    for t in tournaments_col.find():
-        tournament = M.Tournament.load(t, context='db')
+    for tournament in dao.iter_tournaments(only=('id', 'players')):
         for player in tournament.players:
             if player in player_ids:
                 pt_lists[player].append(tournament.id)
 
-    for p in players_col.find():
-        player = M.Player.load(p, context='db')
+    for player in dao.iter_players(all_regions=True, include_merged=True,
+                                   only=('id', 'name', 'merged')):
         error_header = '[ERROR player "{}" ({})]'.format(player.id, player.name)
         if len(pt_lists[player.id]) == 0 and not player.merged:
             print error_header, 'player has no tournaments'
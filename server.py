@@ -8,10 +8,12 @@ from pymongo import MongoClient
 
 import re
 import sys
+import threading
 
 import alias_service
+import indexes
 import model as M
-import rankings
+import ranking_jobs
 
 from config.config import Config
 from dao import Dao
@@ -30,19 +32,46 @@ config = Config()
 mongo_client = MongoClient(host=config.get_mongo_url())
 print "parsed config: ", config.get_mongo_url()
 
+ranking_job_queue = ranking_jobs.RankingJobQueue()
+
+# region id -> (ranking view etag, rankings response without ranking_criteria).
+# checked against the view's etag on every request, so a stale entry is never
+# served.
+ranking_response_cache = {}
+
 app = Flask(__name__)
 api = restful.Api(app)
 
+@app.before_first_request
+def ensure_indexes():
+    # create_index only returns once the index is built, so don't make the
+    # first request wait for it
+    thread = threading.Thread(target=indexes.ensure_indexes, args=(mongo_client,),
+                              kwargs={'background': True})
+    thread.daemon = True
+    thread.start()
+
+@app.before_first_request
+def build_player_search_index():
+    # so the first typeahead query doesn't have to wait for it
+    Dao(None, mongo_client).get_player_search_index()
+
 player_list_get_parser = reqparse.RequestParser()
 player_list_get_parser.add_argument('alias', type=str)
 player_list_get_parser.add_argument('query', type=str)
 player_list_get_parser.add_argument('all', type=bool)
+player_list_get_parser.add_argument('limit', type=int)
+player_list_get_parser.add_argument('after', type=str)
 
 tournament_list_get_parser = reqparse.RequestParser()
 tournament_list_get_parser.add_argument('includePending', type=str)
+tournament_list_get_parser.add_argument('limit', type=int)
+tournament_list_get_parser.add_argument('after', type=str)
 
 matches_get_parser = reqparse.RequestParser()
 matches_get_parser.add_argument('opponent', type=str)
+matches_get_parser.add_argument('limit', type=int)
+matches_get_parser.add_argument('after', type=str)
 
 rankings_get_parser = reqparse.RequestParser()
 rankings_get_parser.add_argument('generateNew', type=str)
@@ -168,50 +197,6 @@ class RegionListResource(restful.Resource):
 
 class PlayerListResource(restful.Resource):
 
-    def _player_matches_query(self, player, query):
-        player_name = player.name.lower()
-        query = query.lower()
-
-        # try matching the full name first
-        if player_name == query:
-            return True
-
-        # if query is >= 3 chars, allow substring matching
-        # this is to allow players with very short names to appear for small
-        # search terms
-        if len(query) >= 3 and query in player_name:
-            return True
-
-        # split the player name on common dividers and try to match against
-        # each part starting from the beginning
-        # split on: . | space
-        tokens = re.split('\.|\|| ', player_name)
-        for token in tokens:
-            if token:
-                if token.startswith(query):
-                    return True
-
-        # no match
-        return False
-
-    def _get_players_matching_query(self, players, query):
-        matching_players = []
-
-        for player in players:
-            if self._player_matches_query(player, query):
-                matching_players.append(player)
-
-        # move exact matches to the front so that short names are guaranteed to
-        # appear
-        for i in xrange(len(matching_players)):
-            player = matching_players[i]
-            if player.name.lower() == query:
-                matching_players.insert(0, matching_players.pop(i))
-
-        matching_players = matching_players[:TYPEAHEAD_PLAYER_LIMIT]
-
-        return matching_players
-
     def get(self, region):
         args = player_list_get_parser.parse_args()
         dao = Dao(region, mongo_client=mongo_client)
@@ -231,13 +216,25 @@ class PlayerListResource(restful.Resource):
         # search multiple players by name across all regions
         elif args['query']:
             # TODO: none checks on below list comprehensions
-            all_players = dao.get_all_players(all_regions=True)
             return_dict['players'] = [p.dump(context='web',
                                              exclude=exclude_properties)
-                                      for p in self._get_players_matching_query(all_players, args['query'])]
+                                      for p in dao.search_players(args['query'], limit=TYPEAHEAD_PLAYER_LIMIT)]
+        # one page of players (in all regions with all), sorted by name as
+        # stored
+        elif args['limit'] is not None:
+            try:
+                after = ObjectId(args['after']) if args['after'] else None
+            except:
+                return 'Invalid ObjectID', 400
+            players = dao.get_all_players(all_regions=bool(args['all']), exclude=exclude_properties,
+                                          limit=args['limit'], after=after)
+            return_dict['players'] = [p.dump(context='web',
+                                             exclude=exclude_properties)
+                                      for p in players]
+            return_dict['next'] = str(players[-1].id) if len(players) == args['limit'] else None
         # get all players in all regions
         elif args['all']:
-            all_players = dao.get_all_players(all_regions=True)
+            all_players = dao.get_all_players(all_regions=True, exclude=exclude_properties)
             return_dict['players'] = [p.dump(context='web',
                                              exclude=exclude_properties)
                                       for p in sorted(all_players, key=lambda player: player.name.lower())]
@@ -246,12 +243,32 @@ class PlayerListResource(restful.Resource):
             print 'test'
             return_dict['players'] = [p.dump(context='web',
                                              exclude=exclude_properties)
-                                      for p in sorted(dao.get_all_players(),
+                                      for p in sorted(dao.get_all_players(exclude=exclude_properties),
                                       key=lambda player: player.name.lower())]
 
         return return_dict
 
 
+class PlayerRatingHistoryResource(restful.Resource):
+
+    def get(self, region, id):
+        dao = Dao(region, mongo_client=mongo_client)
+        if not dao:
+            return 'Dao not found', 404
+        player = None
+        try:
+            player = dao.get_player_by_id(ObjectId(id))
+        except:
+            return 'Invalid ObjectID', 400
+        if not player:
+            return 'Player not found', 404
+
+        history = dao.get_rating_history(player.id)
+        return {'player': str(player.id),
+                'region': region,
+                'history': history.dump(context='web')['history'] if history else []}
+
+
 class PlayerResource(restful.Resource):
 
     def get(self, region, id):
@@ -332,7 +349,7 @@ class PlayerResource(restful.Resource):
         if not is_user_admin_for_regions(user, player.regions):
             return 'Permission denied', 403
 
-        if dao.get_all_tournaments(players=[player]):
+        if dao.get_all_tournaments(players=[player], only=('id',), limit=1):
             return 'Player still has matches', 400
 
         dao.delete_player(player)
@@ -394,18 +411,30 @@ class TournamentListResource(restful.Resource):
             include_pending_tournaments = user and is_user_admin_for_region(
                 user, region)
 
-        tournaments = dao.get_all_tournaments(regions=[region])
         only_properties = ('id',
                            'name',
                            'date',
                            'regions')
 
+        try:
+            after = ObjectId(args['after']) if args['after'] else None
+        except:
+            return 'Invalid ObjectID', 400
+        tournaments = dao.get_all_tournaments(regions=[region], only=only_properties,
+                                              limit=args['limit'], after=after)
+        next_page = None
+        if args['limit'] is not None and len(tournaments) == args['limit']:
+            next_page = str(tournaments[-1].id)
+
         # temporary fix
+        # only the projected fields are loaded, so they can't be validated as
+        # whole tournaments (they were validated when written)
         all_tournament_jsons = []
         for t in tournaments:
             try:
                 all_tournament_jsons.append(t.dump(context='web',
-                                                   only=only_properties))
+                                                   only=only_properties,
+                                                   validate_on_dump=False))
             except:
                 print 'error inserting tournament', t
 
@@ -414,6 +443,8 @@ class TournamentListResource(restful.Resource):
             for t in all_tournament_jsons:
                 t['pending'] = False
 
+        # pending tournaments go on the last page
+        if include_pending_tournaments and next_page is None:
             pending_tournaments = dao.get_all_pending_tournaments(regions=[
                                                                   region])
             if pending_tournaments:
@@ -428,6 +459,8 @@ class TournamentListResource(restful.Resource):
 
         return_dict = {}
         return_dict['tournaments'] = all_tournament_jsons
+        if args['limit'] is not None:
+            return_dict['next'] = next_page
 
         return return_dict
 
@@ -519,6 +552,10 @@ class TournamentListResource(restful.Resource):
 def convert_tournament_to_response(tournament, dao):
     return_dict = tournament.dump(context='web', exclude=('orig_ids',))
 
+    dao.prefetch_players(tournament.players +
+                         [player_id for match in tournament.matches
+                          for player_id in (match.winner, match.loser)])
+
     return_dict['players'] = [{
         'id': p,
         'name': dao.get_player_by_id(ObjectId(p)).name
@@ -884,24 +921,43 @@ class RankingsResource(restful.Resource):
         dao = Dao(region, mongo_client=mongo_client)
         if not dao:
             return 'Dao not found', 404
-        return_dict = dao.get_latest_ranking().dump(context='web')
-        if not return_dict:
-            return 'Dao couldnt give us rankings', 400
-
-        ranking_list = []
-        for r in return_dict['ranking']:
-            player = dao.get_player_by_id(ObjectId(r['player']))
-            if player:
-                r['name'] = player.name
-                r['id'] = str(r.pop('player'))
+
+        view_etag = dao.get_ranking_view_etag()
+        cached = ranking_response_cache.get(region)
+        if view_etag is None or cached is None or cached[0] != view_etag:
+            view = dao.get_ranking_view()
+            if not view:
+                return 'Dao couldnt give us rankings', 400
+
+            ranking_list = []
+            for entry in view.entries:
+                r = entry.dump(context='web')
+                r['id'] = r.pop('player')
                 ranking_list.append(r)
 
-        ranking_criteria = dao.get_region_ranking_criteria(region)
+            response = M.Ranking(
+                id=view.ranking,
+                region=view.id,
+                time=view.time,
+                tournaments=view.tournaments).dump(context='web')
+            response['ranking'] = ranking_list
+            view_etag = view.etag
+            ranking_response_cache[region] = (view_etag, response)
+        else:
+            response = cached[1]
 
-        return_dict['ranking'] = ranking_list
+        ranking_criteria = dao.get_region_ranking_criteria(region)
+        etag = '%s-%s-%s-%s' % (view_etag,
+                                ranking_criteria['ranking_num_tourneys_attended'],
+                                ranking_criteria['ranking_activity_day_limit'],
+                                ranking_criteria['tournament_qualified_day_limit'])
+        headers = {'ETag': '"%s"' % etag}
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+
+        return_dict = dict(response)
         return_dict['ranking_criteria'] = ranking_criteria
-
-        return return_dict
+        return return_dict, 200, headers
 
     def put(self, region):
         dao = Dao(region, mongo_client=mongo_client)
@@ -965,23 +1021,42 @@ class RankingsResource(restful.Resource):
                                                    ranking_num_tourneys_attended=ranking_num_tourneys_attended,
                                                    ranking_activity_day_limit=ranking_activity_day_limit,
                                                    tournament_qualified_day_limit=tournament_qualified_day_limit)
-                print 'Running rankings. day_limit: ' + str(ranking_activity_day_limit) + ' and num_tourneys: ' \
+                print 'Queueing rankings. day_limit: ' + str(ranking_activity_day_limit) + ' and num_tourneys: ' \
                       + str(ranking_num_tourneys_attended) + ' and tournament_qualified_day_limit: ' + str(tournament_qualified_day_limit)
 
                 tournament_to_diff = dao.get_tournament_by_id(tournament_id_to_diff)
 
-                rankings.generate_ranking(dao, now=now,
-                                          day_limit=ranking_activity_day_limit,
-                                          num_tourneys=ranking_num_tourneys_attended,
-                                          tournament_qualified_day_limit=tournament_qualified_day_limit,
-                                          tournament_to_diff=tournament_to_diff)
+                job = ranking_job_queue.submit(dao, now,
+                                               day_limit=ranking_activity_day_limit,
+                                               num_tourneys=ranking_num_tourneys_attended,
+                                               tournament_qualified_day_limit=tournament_qualified_day_limit,
+                                               tournament_to_diff=tournament_to_diff)
             except:
-                rankings.generate_ranking(dao, now=now)
+                job = ranking_job_queue.submit(dao, now)
         except Exception as e:
             print str(e)
             return 'There was an error updating rankings', 400
 
-        return self.get(region)
+        return job.dump(context='web'), 202
+
+
+class RankingJobResource(restful.Resource):
+
+    def get(self, region, id):
+        dao = Dao(region, mongo_client=mongo_client)
+        if not dao:
+            return 'Dao not found', 404
+
+        job = None
+        try:
+            job = dao.get_ranking_job_by_id(ObjectId(id))
+        except:
+            return 'Invalid ObjectID', 400
+
+        if job is None or job.region != region:
+            return 'Ranking job not found', 404
+
+        return job.dump(context='web')
 
 
 class MatchesResource(restful.Resource):
@@ -1021,36 +1096,38 @@ class MatchesResource(restful.Resource):
             # no need to look up tournaments for merged players
             return return_dict
 
-        tournaments = dao.get_all_tournaments(players=player_list)
-        if not tournaments:
-            return 'No tournaments found', 400
-        for tournament in tournaments:
-            for match in tournament.matches:
-                if (opponent_id is not None and match.contains_players(player.id, opponent.id)) or \
-                        (opponent_id is None and match.contains_player(player.id)):
-                    match_dict = {}
-                    match_dict['tournament_id'] = str(tournament.id)
-                    match_dict['tournament_name'] = tournament.name
-                    match_dict[
-                        'tournament_date'] = tournament.date.strftime("%x")
-                    match_dict['opponent_id'] = str(
-                        match.get_opposing_player_id(player.id))
-                    try:
-                        match_dict['opponent_name'] = dao.get_player_by_id(
-                            ObjectId(match_dict['opponent_id'])).name
-                    except:
-                        return 'Invalid ObjectID', 400
+        after = None
+        if args['after'] is not None:
+            try:
+                after = ObjectId(args['after'])
+            except:
+                return 'Invalid ObjectID', 400
 
-                    if match.excluded is True:
-                        match_dict['result'] = 'excluded'
-                    elif match.did_player_win(player.id):
-                        match_dict['result'] = 'win'
-                        return_dict['wins'] += 1
-                    else:
-                        match_dict['result'] = 'lose'
-                        return_dict['losses'] += 1
+        opponent_id = opponent.id if opponent_id is not None else None
+        player_matches = dao.get_player_matches(
+            player.id, opponent_id=opponent_id, limit=args['limit'], after=after)
+        if not player_matches and after is None and \
+                not dao.player_has_tournaments(player.id):
+            return 'No tournaments found', 400
 
-                    match_list.append(match_dict)
+        dao.prefetch_players([m.opponent for m in player_matches])
+        for m in player_matches:
+            opponent_player = dao.get_player_by_id(m.opponent)
+            if opponent_player is None:
+                return 'Invalid ObjectID', 400
+            match_list.append({
+                'tournament_id': str(m.tournament),
+                'tournament_name': m.tournament_name,
+                'tournament_date': m.date.strftime("%x"),
+                'opponent_id': str(m.opponent),
+                'opponent_name': opponent_player.name,
+                'result': 'excluded' if m.excluded else m.result})
+
+        return_dict['wins'], return_dict['losses'] = dao.get_player_match_record(
+            player.id, opponent_id=opponent_id)
+        if args['limit'] is not None:
+            return_dict['next'] = str(player_matches[-1].id) \
+                if len(player_matches) == args['limit'] else None
 
         return return_dict
 
@@ -1082,11 +1159,13 @@ class MergeListResource(restful.Resource):
         return_dict = {}
         return_dict['merges'] = [m.dump(context='web')
                                  for m in dao.get_all_merges()]
+        dao.prefetch_players([ObjectId(merge[key]) for merge in return_dict['merges']
+                              for key in ('source_player_obj_id', 'target_player_obj_id')])
 
         for merge in return_dict['merges']:
             # TODO: store names in merge object
-            source_player = dao.get_player_by_id(merge['source_player_obj_id'])
-            target_player = dao.get_player_by_id(merge['target_player_obj_id'])
+            source_player = dao.get_player_by_id(ObjectId(merge['source_player_obj_id']))
+            target_player = dao.get_player_by_id(ObjectId(merge['target_player_obj_id']))
 
             if source_player is not None and target_player is not None:
                 merge['source_player_name'] = source_player.name
@@ -1298,6 +1377,7 @@ api.add_resource(RegionListResource, '/regions')
 
 api.add_resource(PlayerListResource, '/<string:region>/players')
 api.add_resource(PlayerResource, '/<string:region>/players/<string:id>')
+api.add_resource(PlayerRatingHistoryResource, '/<string:region>/players/<string:id>/history')
 
 api.add_resource(MatchesResource, '/<string:region>/matches/<string:id>')
 
@@ -1321,6 +1401,7 @@ api.add_resource(AddTournamentMatchResource,
 api.add_resource(SmashGGMappingResource, '/smashGgMap')
 
 api.add_resource(RankingsResource, '/<string:region>/rankings')
+api.add_resource(RankingJobResource, '/<string:region>/rankings/jobs/<string:id>')
 
 api.add_resource(SessionResource, '/users/session')
 
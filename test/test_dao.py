@@ -1,3 +1,4 @@
+import time
 import unittest
 
 from bson.objectid import ObjectId
@@ -5,12 +6,16 @@ from ConfigParser import ConfigParser
 from datetime import datetime
 from pymongo.errors import DuplicateKeyError
 from pymongo import MongoClient
+from mock import patch
+
+import dao
 
 from dao import Dao, InvalidRegionsException, \
     InvalidNameException, DuplicateAliasException, DuplicateUsernameException, \
     verify_password
 from model import AliasMapping, AliasMatch, Match, Merge, Player, PendingTournament, \
-                 Ranking, RankingEntry, Rating, Region, Tournament, User
+                 PlayerMatch, Ranking, RankingCheckpoint, RankingEntry, RankingJob, Rating, RatingHistoryEntry, Region, Tournament, User
+from orm import ValidationError
 
 
 DATABASE_NAME = 'garpr_test'
@@ -244,6 +249,45 @@ class TestDAO(unittest.TestCase):
         self.assertIsNone(Dao('newregion', self.mongo_client,
                               database_name=DATABASE_NAME))
 
+    def test_init_uses_region_cache(self):
+        Dao('norcal', self.mongo_client, database_name=DATABASE_NAME)
+
+        with patch.object(Dao, '_region_cache', {}) as region_cache:
+            self.assertIsNotNone(Dao('norcal', self.mongo_client, database_name=DATABASE_NAME))
+            regions_col = self.mongo_client[DATABASE_NAME][Region.collection_name]
+            with patch.object(regions_col.__class__, 'find') as mock_find:
+                self.assertIsNotNone(Dao('norcal', self.mongo_client, database_name=DATABASE_NAME))
+                self.assertIsNone(Dao('newregion', self.mongo_client, database_name=DATABASE_NAME))
+                self.assertFalse(mock_find.called)
+
+            # expired entries are reloaded
+            with patch('dao.time.time', return_value=time.time() + dao.REGION_CACHE_TTL + 1), \
+                    patch.object(regions_col.__class__, 'find', return_value=[]) as mock_find:
+                self.assertIsNone(Dao('norcal', self.mongo_client, database_name=DATABASE_NAME))
+                self.assertTrue(mock_find.called)
+
+    def test_region_cache_invalidated_by_writes(self):
+        self.assertIsNone(Dao('newregion', self.mongo_client, database_name=DATABASE_NAME))
+
+        self.norcal_dao.create_region('NewRegion')
+        self.assertIsNotNone(Dao('newregion', self.mongo_client, database_name=DATABASE_NAME))
+
+        self.norcal_dao.update_region_ranking_criteria('newregion',
+                                                       ranking_num_tourneys_attended=5,
+                                                       ranking_activity_day_limit=30,
+                                                       tournament_qualified_day_limit=100)
+        criteria = self.norcal_dao.get_region_ranking_criteria('newregion')
+        self.assertEquals(criteria['ranking_num_tourneys_attended'], 5)
+        self.assertEquals(criteria['tournament_qualified_day_limit'], 100)
+
+        region = Region(id='newregion', display_name='Renamed Region')
+        self.norcal_dao.update_region(region)
+        self.assertIn('Renamed Region', [r.display_name for r in Dao.get_all_regions(
+            self.mongo_client, database_name=DATABASE_NAME)])
+
+        self.norcal_dao.remove_region(region)
+        self.assertIsNone(Dao('newregion', self.mongo_client, database_name=DATABASE_NAME))
+
     def test_get_all_regions(self):
         # add another region
         region = Region(id='newregion', display_name='New Region')
@@ -266,6 +310,53 @@ class TestDAO(unittest.TestCase):
             self.player_3_id), self.player_3)
         self.assertIsNone(self.norcal_dao.get_player_by_id(ObjectId()))
 
+    def test_get_players_by_ids(self):
+        players = self.norcal_dao.get_players_by_ids(
+            [self.player_1_id, self.player_3_id, self.player_1_id, ObjectId()])
+        self.assertEquals(players, {self.player_1_id: self.player_1,
+                                    self.player_3_id: self.player_3})
+        self.assertEquals(self.norcal_dao.get_players_by_ids([]), {})
+
+    def test_get_player_by_id_caches_players(self):
+        players_col_class = self.norcal_dao.players_col.__class__
+        self.norcal_dao.prefetch_players([self.player_1_id, self.player_2_id, ObjectId()])
+
+        with patch.object(players_col_class, 'find_one') as mock_find_one, \
+                patch.object(players_col_class, 'find') as mock_find:
+            self.assertEquals(self.norcal_dao.get_player_by_id(self.player_1_id), self.player_1)
+            self.assertIs(self.norcal_dao.get_player_by_id(self.player_1_id),
+                          self.norcal_dao.get_player_by_id(self.player_1_id))
+            self.assertEquals(self.norcal_dao.get_players_by_ids([self.player_1_id, self.player_2_id]),
+                              {self.player_1_id: self.player_1, self.player_2_id: self.player_2})
+            self.assertFalse(mock_find_one.called)
+            self.assertFalse(mock_find.called)
+
+        # writes drop the cached player
+        player = self.norcal_dao.get_player_by_id(self.player_1_id)
+        player.name = 'garr'
+        self.norcal_dao.update_player(player)
+        self.assertIsNot(self.norcal_dao.get_player_by_id(self.player_1_id), player)
+        self.assertEquals(self.norcal_dao.get_player_by_id(self.player_1_id).name, 'garr')
+
+        self.norcal_dao.delete_player(player)
+        self.assertIsNone(self.norcal_dao.get_player_by_id(self.player_1_id))
+
+    def test_get_players_by_aliases(self):
+        aliases = ['gar', 'GAR', 'garr', 'sfat', 'miom | sfat', 'mango', 'asdf']
+        with patch.object(self.norcal_dao.players_col, 'find',
+                          wraps=self.norcal_dao.players_col.find) as mock_find:
+            players = self.norcal_dao.get_players_by_aliases(aliases)
+            self.assertEquals(mock_find.call_count, 1)
+
+        self.assertEquals(players, {
+            'gar': self.player_1,
+            'GAR': self.player_1,
+            'garr': self.player_1,
+            'sfat': self.player_2,
+            'miom | sfat': self.player_2,
+            'mango': None,
+            'asdf': None})
+
     def test_get_player_by_alias(self):
         self.assertEquals(
             self.norcal_dao.get_player_by_alias('gar'), self.player_1)
@@ -316,10 +407,80 @@ class TestDAO(unittest.TestCase):
         self.assertEquals(self.norcal_dao.get_all_players(),
                           [self.player_1, self.player_2])
 
+    def test_iter_players(self):
+        players = self.norcal_dao.iter_players(all_regions=True, batch_size=1)
+        self.assertFalse(isinstance(players, list))
+        self.assertEquals(list(players), [self.player_1, self.player_3, self.player_2])
+        self.assertEquals(list(self.norcal_dao.iter_players(limit=1, after=self.player_1_id)),
+                          [self.player_2])
+
     def test_get_all_players_all_regions(self):
         self.assertEquals(self.norcal_dao.get_all_players(all_regions=True), [
                           self.player_1, self.player_3, self.player_2])
 
+    def test_get_all_players_paged(self):
+        first_page = self.norcal_dao.get_all_players(all_regions=True, limit=2)
+        self.assertEquals(first_page, [self.player_1, self.player_3])
+        self.assertEquals(self.norcal_dao.get_all_players(all_regions=True, limit=2, after=self.player_3_id),
+                          [self.player_2])
+        self.assertEquals(self.norcal_dao.get_all_players(all_regions=True, limit=2, after=self.player_2_id), [])
+
+    def test_get_all_players_projection(self):
+        players = self.norcal_dao.get_all_players(exclude=['aliases', 'ratings'])
+        self.assertEquals([p.id for p in players], [self.player_1_id, self.player_2_id])
+        self.assertEquals([p.name for p in players], [self.player_1.name, self.player_2.name])
+        self.assertEquals([p.ratings for p in players], [{}, {}])
+
+    @patch.object(Dao, '_player_search_cache', {})
+    def test_search_players(self):
+        # mango has gar as an alias
+        self.assertEquals([p.id for p in self.norcal_dao.search_players('gar')],
+                          [self.player_1_id, self.player_3_id])
+
+        # writes through any Dao update the index without reloading it
+        other_dao = Dao('norcal', self.mongo_client, database_name=DATABASE_NAME)
+        player = other_dao.get_player_by_id(self.player_1_id)
+        player.name = 'zzz'
+        player.aliases = ['zzz']
+        other_dao.update_player(player)
+        new_player = Player.create_with_default_values('zzzz', 'norcal')
+        other_dao.insert_player(new_player)
+        other_dao.delete_player(self.player_3)
+
+        with patch.object(self.norcal_dao.players_col, 'find') as mock_find:
+            self.assertEquals([p.id for p in self.norcal_dao.search_players('zz')],
+                              [self.player_1_id, new_player.id])
+            self.assertEquals(self.norcal_dao.search_players(self.player_3.name), [])
+            self.assertFalse(mock_find.called)
+
+    @patch.object(Dao, '_player_search_cache', {})
+    @patch.object(Dao, '_player_search_rebuilds', {})
+    def test_search_players_expired(self):
+        self.norcal_dao.search_players('gar')
+        key = (id(self.mongo_client), DATABASE_NAME)
+        old_index = Dao._player_search_cache[key][2]
+        Dao._player_search_cache[key] = (self.mongo_client, 0, old_index)
+
+        # the expired index is still used while a single rebuild runs
+        with patch('dao.threading.Thread') as mock_thread:
+            self.assertEquals([p.id for p in self.norcal_dao.search_players('gar')],
+                              [self.player_1_id, self.player_3_id])
+            self.norcal_dao.search_players('gar')
+            self.assertEquals(mock_thread.call_count, 1)
+
+        # writes made during the rebuild make it into the new index, even if
+        # the rebuild read the players before them
+        new_player = Player.create_with_default_values('gar 2', 'norcal')
+        self.norcal_dao.insert_player(new_player)
+        call_kwargs = mock_thread.call_args[1]
+        with patch.object(Dao, 'get_all_players', return_value=[]):
+            call_kwargs['target'](*call_kwargs['args'])
+
+        self.assertIsNot(Dao._player_search_cache[key][2], old_index)
+        self.assertEquals(Dao._player_search_rebuilds, {})
+        self.assertEquals([p.id for p in self.norcal_dao.search_players('gar')],
+                          [new_player.id])
+
     def test_add_player_duplicate(self):
         with self.assertRaises(DuplicateKeyError):
             self.norcal_dao.insert_player(self.player_1)
@@ -398,6 +559,22 @@ class TestDAO(unittest.TestCase):
         with self.assertRaises(DuplicateAliasException):
             self.norcal_dao.add_alias_to_player(self.player_1, 'garr')
 
+    def test_update_players(self):
+        player_1 = self.norcal_dao.get_player_by_id(self.player_1_id)
+        player_2 = self.norcal_dao.get_player_by_id(self.player_2_id)
+        player_1.ratings['norcal'] = Rating(mu=30., sigma=4.)
+        player_2.ratings['norcal'] = Rating(mu=20., sigma=5.)
+        # only ratings are written
+        player_2.name = 'not sfat'
+
+        self.norcal_dao.update_players([player_1, player_2])
+
+        self.assertEquals(self.norcal_dao.get_player_by_id(self.player_1_id), player_1)
+        db_player_2 = self.norcal_dao.get_player_by_id(self.player_2_id)
+        self.assertEquals(db_player_2.ratings, player_2.ratings)
+        self.assertEquals(db_player_2.name, 'sfat')
+        self.assertIsNone(self.norcal_dao.update_players([]))
+
     def test_update_player_name(self):
         self.assertEquals(self.norcal_dao.get_player_by_id(
             self.player_1_id).name, 'gaR')
@@ -474,6 +651,10 @@ class TestDAO(unittest.TestCase):
         self.assertEquals(pending_tournament.regions,
                           self.pending_tournament_regions_1)
 
+    def test_iter_pending_tournaments(self):
+        self.assertEquals(list(self.norcal_dao.iter_pending_tournaments(batch_size=1)),
+                          self.norcal_dao.get_all_pending_tournaments())
+
     def test_get_all_pending_tournaments_for_region(self):
         pending_tournaments = self.norcal_dao.get_all_pending_tournaments(regions=[
                                                                           'norcal'])
@@ -522,6 +703,15 @@ class TestDAO(unittest.TestCase):
             self.pending_tournament_id_1)
         self.assertIsNone(deleted_tournament)
 
+    def test_update_tournament_revalidates_changes(self):
+        tournament = self.norcal_dao.get_tournament_by_id(self.tournament_id_1)
+        self.assertEquals(tournament.changed_fields(), [])
+
+        tournament.players.append(ObjectId())
+        self.assertEquals(tournament.changed_fields(), ['players'])
+        with self.assertRaises(ValidationError):
+            self.norcal_dao.update_tournament(tournament)
+
     def test_update_tournament(self):
         tournament_1 = self.norcal_dao.get_tournament_by_id(
             self.tournament_id_1)
@@ -576,6 +766,148 @@ class TestDAO(unittest.TestCase):
             self.tournament_id_1)
         self.assertIsNone(deleted_tournament)
 
+    def test_get_player_matches(self):
+        player_matches = self.norcal_dao.get_player_matches(self.player_2_id)
+        self.assertEquals([(m.tournament, m.opponent, m.result) for m in player_matches],
+                          [(self.tournament_id_2, self.player_5_id, 'lose'),
+                           (self.tournament_id_1, self.player_1_id, 'lose')])
+        self.assertEquals(player_matches[0].tournament_name, self.tournament_name_2)
+        self.assertEquals(player_matches[0].date, self.tournament_date_2)
+        self.assertEquals(self.norcal_dao.get_player_match_record(self.player_2_id), (0, 2))
+
+    def test_get_player_matches_with_opponent(self):
+        player_matches = self.norcal_dao.get_player_matches(self.player_3_id, opponent_id=self.player_4_id)
+        self.assertEquals([(m.tournament, m.result) for m in player_matches],
+                          [(self.tournament_id_2, 'win'), (self.tournament_id_1, 'win')])
+        self.assertEquals(self.norcal_dao.get_player_match_record(self.player_3_id, self.player_4_id), (2, 0))
+        self.assertEquals(self.norcal_dao.get_player_match_record(self.player_4_id, self.player_3_id), (0, 2))
+        self.assertEquals(self.norcal_dao.get_player_matches(self.player_3_id, opponent_id=self.player_5_id), [])
+
+    def test_get_player_matches_paged(self):
+        first_page = self.norcal_dao.get_player_matches(self.player_3_id, limit=1)
+        self.assertEquals([m.tournament for m in first_page], [self.tournament_id_2])
+
+        second_page = self.norcal_dao.get_player_matches(self.player_3_id, limit=1, after=first_page[0].id)
+        self.assertEquals([m.tournament for m in second_page], [self.tournament_id_1])
+
+        self.assertEquals(self.norcal_dao.get_player_matches(self.player_3_id, limit=1, after=second_page[0].id), [])
+        self.assertEquals(self.norcal_dao.get_player_matches(self.player_3_id, after=ObjectId()), [])
+
+    def test_player_matches_follow_match_edits(self):
+        tournament = self._insert_tournament_with_match_ids()
+
+        self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(tournament.id, 1, True)
+        player_matches = self.norcal_dao.get_player_matches(self.player_3_id, opponent_id=self.player_1_id)
+        self.assertEquals([(m.match_id, m.result, m.excluded) for m in player_matches], [(1, 'win', True)])
+        self.assertEquals(self.norcal_dao.get_player_match_record(self.player_3_id, self.player_1_id), (0, 0))
+
+        self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(tournament.id, 0)
+        player_matches = self.norcal_dao.get_player_matches(self.player_2_id, opponent_id=self.player_1_id)
+        self.assertEquals([(m.tournament, m.result) for m in player_matches],
+                          [(self.tournament_id_1, 'lose'), (tournament.id, 'win')])
+
+        self.norcal_dao.add_match_by_tournament_id(tournament.id, self.player_4_id, self.player_1_id)
+        player_matches = self.norcal_dao.get_player_matches(self.player_1_id, opponent_id=self.player_4_id)
+        self.assertEquals([(m.tournament, m.match_id, m.result) for m in player_matches],
+                          [(tournament.id, 2, 'lose')])
+
+    def test_match_edits_keep_player_match_ids(self):
+        tournament = self._insert_tournament_with_match_ids()
+        ids = {m['_id'] for m in self.norcal_dao.player_matches_col.find({'tournament': tournament.id})}
+        self.assertEquals(len(ids), 4)
+
+        self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(tournament.id, 0)
+        self.norcal_dao.add_match_by_tournament_id(tournament.id, self.player_4_id, self.player_1_id)
+
+        player_matches = [PlayerMatch.load(m, context='db') for m in
+                          self.norcal_dao.player_matches_col.find({'tournament': tournament.id})]
+        self.assertEquals(len(player_matches), 6)
+        self.assertTrue(ids.issubset({m.id for m in player_matches}))
+        new_matches = [m for m in player_matches if m.match_id == 2]
+        self.assertEquals(sorted((m.result, m.tournament_name, m.date) for m in new_matches),
+                          [('lose', tournament.name, tournament.date),
+                           ('win', tournament.name, tournament.date)])
+
+    def test_player_matches_follow_tournament_writes(self):
+        tournament = self.norcal_dao.get_tournament_by_id(self.tournament_id_1)
+        tournament.name = 'new name'
+        self.norcal_dao.update_tournament(tournament)
+        self.assertEquals([m.tournament_name for m in self.norcal_dao.get_player_matches(self.player_1_id)],
+                          ['new name'])
+
+        tournament.replace_player(player_to_remove=self.player_1, player_to_add=self.player_5)
+        self.norcal_dao.update_tournaments([tournament])
+        self.assertEquals(self.norcal_dao.get_player_matches(self.player_1_id), [])
+        self.assertEquals([m.tournament for m in self.norcal_dao.get_player_matches(self.player_5_id)],
+                          [self.tournament_id_2, self.tournament_id_1])
+
+        self.norcal_dao.delete_tournament(tournament)
+        self.assertEquals([m.tournament for m in self.norcal_dao.get_player_matches(self.player_5_id)],
+                          [self.tournament_id_2])
+
+    def test_rebuild_player_matches(self):
+        expected = self.norcal_dao.get_player_matches(self.player_3_id)
+        self.norcal_dao.player_matches_col.remove()
+
+        self.norcal_dao.rebuild_player_matches()
+        rebuilt = self.norcal_dao.get_player_matches(self.player_3_id)
+        self.assertEquals([(m.tournament, m.opponent, m.result) for m in rebuilt],
+                          [(m.tournament, m.opponent, m.result) for m in expected])
+
+    def test_rebuild_missing_player_matches(self):
+        expected = self.norcal_dao.get_player_matches(self.player_3_id)
+        kept_ids = [m['_id'] for m in self.norcal_dao.player_matches_col.find(
+            {'tournament': self.tournament_id_2})]
+        self.norcal_dao.player_matches_col.remove({'tournament': self.tournament_id_1})
+
+        self.assertEquals(self.norcal_dao.rebuild_player_matches(missing_only=True), 1)
+        rebuilt = self.norcal_dao.get_player_matches(self.player_3_id)
+        self.assertEquals([(m.tournament, m.opponent, m.result) for m in rebuilt],
+                          [(m.tournament, m.opponent, m.result) for m in expected])
+        # tournaments that already had their player matches are left alone
+        self.assertEquals([m['_id'] for m in self.norcal_dao.player_matches_col.find(
+            {'tournament': self.tournament_id_2})], kept_ids)
+        self.assertEquals(self.norcal_dao.rebuild_player_matches(missing_only=True), 0)
+
+    def test_get_all_tournaments_paged(self):
+        first_page = self.norcal_dao.get_all_tournaments(limit=1)
+        self.assertEquals([t.id for t in first_page], [self.tournament_id_2])
+        second_page = self.norcal_dao.get_all_tournaments(limit=1, after=self.tournament_id_2)
+        self.assertEquals([t.id for t in second_page], [self.tournament_id_1])
+        self.assertEquals(self.norcal_dao.get_all_tournaments(limit=1, after=self.tournament_id_1), [])
+
+    def test_get_all_tournaments_projection(self):
+        tournaments = self.norcal_dao.get_all_tournaments(only=('id', 'name', 'date', 'regions'))
+        self.assertEquals([(t.id, t.name, t.date) for t in tournaments],
+                          [(self.tournament_id_2, self.tournament_name_2, self.tournament_date_2),
+                           (self.tournament_id_1, self.tournament_name_1, self.tournament_date_1)])
+        self.assertEquals([(t.matches, t.players, t.type) for t in tournaments], [([], [], None)] * 2)
+
+        # missing fields aren't trusted, so they can't be written back
+        self.assertIsNone(tournaments[0].changed_fields())
+        with self.assertRaises(ValidationError):
+            self.norcal_dao.update_tournament(tournaments[0])
+        self.assertEquals(self.norcal_dao.get_tournament_by_id(self.tournament_id_2), self.tournament_2)
+
+    def test_get_all_tournaments_lazy_matches(self):
+        tournament = self.norcal_dao.get_all_tournaments()[1]
+        self.assertNotIn('matches', tournament.__dict__)
+        self.assertEquals(tournament.players, self.tournament_players_1)
+
+        tournament.name = 'new name'
+        self.norcal_dao.update_tournament(tournament)
+        tournament = self.norcal_dao.get_tournament_by_id(self.tournament_id_1)
+        self.assertEquals(tournament.name, 'new name')
+        self.assertEquals(tournament.matches, self.tournament_matches_1)
+
+    def test_iter_tournaments(self):
+        tournaments = self.norcal_dao.iter_tournaments(batch_size=1)
+        self.assertFalse(isinstance(tournaments, list))
+        self.assertEquals(list(tournaments), [self.tournament_2, self.tournament_1])
+        self.assertEquals([t.id for t in self.norcal_dao.iter_tournaments(
+                              players=[self.player_1], only=('id',))],
+                          [self.tournament_id_1])
+
     def test_get_all_tournament_ids(self):
         tournament_ids = self.norcal_dao.get_all_tournament_ids()
 
@@ -727,6 +1059,18 @@ class TestDAO(unittest.TestCase):
         self.assertTrue(any(player.name == "gaR" for player in dao.get_players_with_similar_alias(
             "garpr goog youtube gar")))
 
+    def test_get_players_with_similar_aliases(self):
+        aliases = ['gar', 'GAR', 'g a r', 'garpr | gar', '1 1 gar', 'p1s2 GOOG| gar',
+                   'miom | sfat', 'ASDFASDF']
+        with patch.object(self.norcal_dao.players_col, 'find',
+                          wraps=self.norcal_dao.players_col.find) as mock_find:
+            similar_players = self.norcal_dao.get_players_with_similar_aliases(aliases)
+            self.assertEquals(mock_find.call_count, 1)
+
+        self.assertEquals(similar_players,
+                          {alias: self.norcal_dao.get_players_with_similar_alias(alias)
+                           for alias in aliases})
+
     def test_get_players_with_similar_alias_match_name(self):
         player = Player(
             name='ivanvan',
@@ -738,11 +1082,162 @@ class TestDAO(unittest.TestCase):
         self.assertEquals(self.norcal_dao.get_players_with_similar_alias(
             'ivanvan'), [player])
 
+    def _insert_tournament_with_match_ids(self):
+        tournament = Tournament(
+            id=ObjectId(),
+            name='tournament with match ids',
+            type='tio',
+            date=self.tournament_date_1,
+            regions=['norcal'],
+            players=[self.player_1_id, self.player_2_id, self.player_3_id],
+            matches=[Match(match_id=0, winner=self.player_1_id, loser=self.player_2_id),
+                     Match(match_id=1, winner=self.player_3_id, loser=self.player_1_id)])
+        self.norcal_dao.insert_tournament(tournament)
+        return tournament
+
+    def test_set_match_exclusion(self):
+        tournament = self._insert_tournament_with_match_ids()
+
+        self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(tournament.id, 1, True)
+        matches = self.norcal_dao.get_tournament_by_id(tournament.id).matches
+        self.assertFalse(matches[0].excluded)
+        self.assertTrue(matches[1].excluded)
+
+        self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(tournament.id, 1, False)
+        self.assertFalse(self.norcal_dao.get_tournament_by_id(tournament.id).matches[1].excluded)
+
+    def test_swap_winner_loser(self):
+        tournament = self._insert_tournament_with_match_ids()
+
+        self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(tournament.id, 0)
+        matches = self.norcal_dao.get_tournament_by_id(tournament.id).matches
+        self.assertEquals((matches[0].winner, matches[0].loser), (self.player_2_id, self.player_1_id))
+        self.assertEquals(matches[1], tournament.matches[1])
+
+        with self.assertRaises(ValueError):
+            self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(tournament.id, 5)
+
+    def test_add_match(self):
+        tournament = self._insert_tournament_with_match_ids()
+
+        self.norcal_dao.add_match_by_tournament_id(tournament.id, self.player_2_id, self.player_3_id)
+        self.norcal_dao.add_match_by_tournament_id(tournament.id, self.player_4_id, self.player_1_id)
+
+        updated = self.norcal_dao.get_tournament_by_id(tournament.id)
+        self.assertEquals(updated.matches[2], Match(match_id=2, winner=self.player_2_id, loser=self.player_3_id))
+        self.assertEquals(updated.matches[3], Match(match_id=3, winner=self.player_4_id, loser=self.player_1_id))
+        self.assertEquals(updated.players, tournament.players + [self.player_4_id])
+        self.assertEquals(updated.orig_ids, tournament.orig_ids + [self.player_4_id])
+        self.assertTrue(updated.validate()[0])
+
+        with self.assertRaises(ValueError):
+            self.norcal_dao.add_match_by_tournament_id(tournament.id, self.player_2_id, self.player_2_id)
+
+    def test_get_num_matches(self):
+        tournament = self._insert_tournament_with_match_ids()
+        tournaments_col = self.norcal_dao.tournaments_col
+        for num_matches in [0, 1, 2, 3, 5, 8, 13]:
+            matches = [Match(match_id=i, winner=self.player_1_id, loser=self.player_2_id)
+                       for i in xrange(num_matches)]
+            tournaments_col.update({'_id': tournament.id},
+                                   {'$set': {'matches': [m.dump(context='db') for m in matches]}})
+            with patch.object(tournaments_col, 'find_one', wraps=tournaments_col.find_one) as mock_find_one:
+                self.assertEquals(self.norcal_dao._get_num_matches(tournament.id), num_matches)
+            # only ids are read, never the matches
+            for call_args in mock_find_one.call_args_list:
+                self.assertEquals(call_args[0][1], {'_id': 1})
+
+    def test_add_match_retries_after_concurrent_add(self):
+        tournament = self._insert_tournament_with_match_ids()
+        tournaments_col = self.norcal_dao.tournaments_col
+        find_one = tournaments_col.find_one
+
+        # another admin adds a match between our read and our write
+        added = []
+
+        def find_one_then_add(*args, **kwargs):
+            result = find_one(*args, **kwargs)
+            if 'players' in args[1] and not added:
+                added.append(True)
+                tournaments_col.update({'_id': tournament.id}, {'$push': {'matches': Match(
+                    match_id=2, winner=self.player_3_id, loser=self.player_2_id).dump(context='db')}})
+            return result
+
+        with patch.object(tournaments_col, 'find_one', side_effect=find_one_then_add):
+            self.norcal_dao.add_match_by_tournament_id(tournament.id, self.player_2_id, self.player_1_id)
+
+        matches = self.norcal_dao.get_tournament_by_id(tournament.id).matches
+        self.assertEquals([match.match_id for match in matches], [0, 1, 2, 3])
+        self.assertEquals(matches[3].winner, self.player_2_id)
+
     # TODO: add more tests for merging players
     # this is currently covered by test_get_and_insert_merge
     # def test_merge_players(self):
     #     pass
 
+    def test_merge_and_unmerge_players_only_touch_their_tournaments(self):
+        # player 5 only played tournament 2, player 1 only tournament 1
+        self.norcal_dao.insert_player(self.player_5)
+        the_merge = Merge(source_player_obj_id=self.player_5_id,
+                          target_player_obj_id=self.player_1_id,
+                          time=datetime.today(),
+                          id=ObjectId())
+
+        with patch.object(self.norcal_dao, 'get_all_tournament_ids') as mock_get_all_tournament_ids, \
+                patch.object(self.norcal_dao, 'get_tournament_by_id') as mock_get_tournament_by_id:
+            self.norcal_dao.merge_players(the_merge)
+            self.assertFalse(mock_get_all_tournament_ids.called)
+            self.assertFalse(mock_get_tournament_by_id.called)
+
+        tournament_1 = self.norcal_dao.get_tournament_by_id(self.tournament_id_1)
+        tournament_2 = self.norcal_dao.get_tournament_by_id(self.tournament_id_2)
+        self.assertEquals(tournament_1, self.tournament_1)
+        self.assertIn(self.player_1_id, tournament_2.players)
+        self.assertNotIn(self.player_5_id, tournament_2.players)
+        self.assertEquals(tournament_2.matches[0].winner, self.player_1_id)
+        self.assertEquals(tournament_2.orig_ids, self.tournament_2.orig_ids)
+
+        self.norcal_dao.unmerge_players(the_merge)
+
+        self.assertEquals(self.norcal_dao.get_tournament_by_id(self.tournament_id_1), self.tournament_1)
+        tournament_2 = self.norcal_dao.get_tournament_by_id(self.tournament_id_2)
+        self.assertEquals(set(tournament_2.players), set(self.tournament_2.players))
+        self.assertEquals(tournament_2.matches, self.tournament_2.matches)
+
+    @patch('dao.ITER_BATCH_SIZE', 1)
+    def test_merge_and_unmerge_players_in_batches(self):
+        target = Player.create_with_default_values('new', 'norcal')
+        self.norcal_dao.insert_player(target)
+        the_merge = Merge(source_player_obj_id=self.player_2_id,
+                          target_player_obj_id=target.id,
+                          time=datetime.today(),
+                          id=ObjectId())
+
+        with patch.object(self.norcal_dao, 'update_tournaments',
+                          wraps=self.norcal_dao.update_tournaments) as mock_update_tournaments:
+            self.norcal_dao.merge_players(the_merge)
+            self.assertEquals([len(call[0][0]) for call in mock_update_tournaments.call_args_list],
+                              [1, 1, 0])
+        for tournament in self.norcal_dao.get_all_tournaments():
+            self.assertIn(target.id, tournament.players)
+            self.assertNotIn(self.player_2_id, tournament.players)
+
+        self.norcal_dao.unmerge_players(the_merge)
+        for tournament, original in zip(self.norcal_dao.get_all_tournaments(),
+                                        [self.tournament_2, self.tournament_1]):
+            self.assertEquals(set(tournament.players), set(original.players))
+            self.assertEquals(tournament.matches, original.matches)
+
+    def test_merge_players_who_played_each_other(self):
+        the_merge = Merge(source_player_obj_id=self.player_2_id,
+                          target_player_obj_id=self.player_1_id,
+                          time=datetime.today(),
+                          id=ObjectId())
+
+        with self.assertRaises(ValueError):
+            self.norcal_dao.merge_players(the_merge)
+        self.assertFalse(self.norcal_dao.get_player_by_id(self.player_2_id).merged)
+
     def test_merge_players_same_player(self):
         dao = self.norcal_dao
         all_players = dao.get_all_players()
@@ -794,6 +1289,229 @@ class TestDAO(unittest.TestCase):
         self.assertEquals(rankings[1], self.ranking_entry_2)
         self.assertEquals(rankings[2], self.ranking_entry_4)
 
+    def test_get_ranking_by_id(self):
+        for ranking in self.rankings:
+            self.assertEquals(self.norcal_dao.get_ranking_by_id(ranking.id), ranking)
+        self.assertIsNone(self.norcal_dao.get_ranking_by_id(ObjectId()))
+
+    def test_insert_ranking_stores_deltas(self):
+        # ranking_1 is the snapshot, ranking_2 only differs in its last entry
+        # and ranking_3 drops it
+        ranking_2_dict = self.norcal_dao.rankings_col.find_one({'_id': self.ranking_2.id})
+        self.assertEquals(ranking_2_dict['base'], self.ranking_1.id)
+        self.assertEquals(ranking_2_dict['base_tournaments'], 2)
+        self.assertEquals(ranking_2_dict['tournaments'], [])
+        self.assertEquals(ranking_2_dict['order'], [[0, 2], self.player_4_id])
+        entry_4_dict = self.ranking_entry_4.dump(context='db', validate_on_dump=False)
+        del entry_4_dict['rank']
+        self.assertEquals(ranking_2_dict['ranking'], [entry_4_dict])
+
+        ranking_3_dict = self.norcal_dao.rankings_col.find_one({'_id': self.ranking_3.id})
+        self.assertEquals(ranking_3_dict['base'], self.ranking_1.id)
+        self.assertEquals(ranking_3_dict['order'], [[0, 2]])
+        self.assertEquals(ranking_3_dict['ranking'], [])
+
+    def test_insert_ranking_delta_ignores_rank_shifts(self):
+        # a new tournament with a new player ranked first: everyone else
+        # moves down a rank, but only the new entry and the new tournament
+        # are stored
+        new_tournament_id = ObjectId()
+        ranking = Ranking(
+            id=ObjectId(),
+            region='norcal',
+            time=datetime(2013, 4, 22),
+            tournaments=self.tournament_ids + [new_tournament_id],
+            ranking=[RankingEntry(rank=1, player=self.player_5_id, rating=25),
+                     RankingEntry(rank=2, player=self.player_1_id, rating=20),
+                     RankingEntry(rank=3, player=self.player_2_id, rating=19),
+                     RankingEntry(rank=4, player=self.player_3_id, rating=17.5)])
+        self.norcal_dao.insert_ranking(ranking)
+
+        ranking_dict = self.norcal_dao.rankings_col.find_one({'_id': ranking.id})
+        self.assertEquals(ranking_dict['base'], self.ranking_1.id)
+        self.assertEquals(ranking_dict['tournaments'], [new_tournament_id])
+        self.assertEquals(ranking_dict['order'], [self.player_5_id, [0, 3]])
+        self.assertEquals([entry_dict['player'] for entry_dict in ranking_dict['ranking']],
+                          [self.player_5_id])
+        self.assertEquals(self.norcal_dao.get_ranking_by_id(ranking.id), ranking)
+
+    def test_insert_ranking_out_of_order_is_snapshot(self):
+        ranking = Ranking(
+            id=ObjectId(),
+            region='norcal',
+            time=datetime(2013, 4, 22),
+            tournaments=self.tournament_ids,
+            ranking=[self.ranking_entry_1, self.ranking_entry_3])
+        self.norcal_dao.insert_ranking(ranking)
+
+        self.assertNotIn('base', self.norcal_dao.rankings_col.find_one({'_id': ranking.id}))
+        self.assertEquals(self.norcal_dao.get_ranking_by_id(ranking.id), ranking)
+
+    def test_insert_ranking_takes_snapshot_every_interval(self):
+        old_interval = dao.RANKING_SNAPSHOT_INTERVAL
+        dao.RANKING_SNAPSHOT_INTERVAL = 3
+        try:
+            ranking = Ranking(
+                id=ObjectId(),
+                region='norcal',
+                time=datetime(2013, 4, 22),
+                tournaments=self.tournament_ids,
+                ranking=[self.ranking_entry_2])
+            self.norcal_dao.insert_ranking(ranking)
+        finally:
+            dao.RANKING_SNAPSHOT_INTERVAL = old_interval
+
+        ranking_dict = self.norcal_dao.rankings_col.find_one({'_id': ranking.id})
+        self.assertNotIn('base', ranking_dict)
+        self.assertEquals(ranking_dict['ranking'], [self.ranking_entry_2.dump(context='db', validate_on_dump=False)])
+        self.assertEquals(self.norcal_dao.get_latest_ranking(), ranking)
+
+    def test_get_ranking_view(self):
+        latest_ranking = self.norcal_dao.get_latest_ranking()
+        view = self.norcal_dao.get_ranking_view()
+
+        self.assertEquals(view.id, 'norcal')
+        self.assertEquals(view.ranking, latest_ranking.id)
+        self.assertEquals(view.time, latest_ranking.time)
+        self.assertEquals(view.tournaments, latest_ranking.tournaments)
+        # player 4 isn't in the db, so it's left out
+        self.assertEquals([(entry.player, entry.rank, entry.rating, entry.name) for entry in view.entries],
+                          [(self.player_1_id, 1, 20, self.player_1.name),
+                           (self.player_2_id, 2, 19, self.player_2.name)])
+        self.assertEquals(latest_ranking.ranking[2].player, self.player_4_id)
+        self.assertEquals(self.norcal_dao.get_ranking_view_etag(), view.etag)
+
+    def test_get_ranking_view_builds_missing_view(self):
+        self.norcal_dao.ranking_views_col.remove()
+        self.assertIsNone(self.norcal_dao.get_ranking_view_etag())
+
+        view = self.norcal_dao.get_ranking_view()
+        self.assertEquals(view.ranking, self.norcal_dao.get_latest_ranking().id)
+        self.assertEquals(self.norcal_dao.get_ranking_view_etag(), view.etag)
+
+    def test_get_ranking_view_no_rankings(self):
+        texas_dao = Dao('texas', self.mongo_client, database_name=DATABASE_NAME)
+        self.assertIsNone(texas_dao.get_ranking_view())
+        self.assertIsNone(texas_dao.get_ranking_view_etag())
+
+    def test_update_player_renames_in_ranking_view(self):
+        old_etag = self.norcal_dao.get_ranking_view_etag()
+
+        self.player_1.name = 'new name'
+        self.norcal_dao.update_player(self.player_1)
+
+        view = self.norcal_dao.get_ranking_view()
+        self.assertEquals(view.entries[0].player, self.player_1_id)
+        self.assertEquals(view.entries[0].name, 'new name')
+        self.assertEquals(view.entries[1].name, self.player_2.name)
+        self.assertNotEquals(view.etag, old_etag)
+
+    def test_update_player_same_name_keeps_ranking_view(self):
+        old_etag = self.norcal_dao.get_ranking_view_etag()
+        self.norcal_dao.update_player(self.player_1)
+        self.assertEquals(self.norcal_dao.get_ranking_view_etag(), old_etag)
+
+    def test_delete_player_removes_from_ranking_view(self):
+        self.norcal_dao.delete_player(self.player_2)
+
+        view = self.norcal_dao.get_ranking_view()
+        self.assertEquals([entry.player for entry in view.entries], [self.player_1_id])
+
+    def test_update_and_get_ranking_checkpoint(self):
+        self.assertIsNone(self.norcal_dao.get_ranking_checkpoint())
+
+        checkpoint = RankingCheckpoint(
+            id='norcal',
+            time=self.ranking_time_1,
+            tournaments=self.tournament_ids,
+            ratings={str(self.player_1_id): Rating(mu=30., sigma=5.)})
+        self.norcal_dao.update_ranking_checkpoint(checkpoint)
+        self.assertEquals(self.norcal_dao.get_ranking_checkpoint(), checkpoint)
+
+        checkpoint.time = self.ranking_time_2
+        self.norcal_dao.update_ranking_checkpoint(checkpoint)
+        self.assertEquals(self.norcal_dao.get_ranking_checkpoint().time, self.ranking_time_2)
+
+        self.norcal_dao.delete_ranking_checkpoint()
+        self.assertIsNone(self.norcal_dao.get_ranking_checkpoint())
+
+    def test_ranking_checkpoint_token(self):
+        checkpoint = RankingCheckpoint(
+            id='norcal',
+            time=self.ranking_time_1,
+            tournaments=self.tournament_ids,
+            ratings={str(self.player_1_id): Rating(mu=30., sigma=5.)})
+
+        token = self.norcal_dao.get_ranking_checkpoint_token()
+        self.assertIsNone(self.norcal_dao.get_ranking_checkpoint())
+        self.assertEquals(self.norcal_dao.get_ranking_checkpoint_token(), token)
+        self.assertTrue(self.norcal_dao.update_ranking_checkpoint(checkpoint, token=token))
+        self.assertEquals(self.norcal_dao.get_ranking_checkpoint(), checkpoint)
+
+        # the token changed when the checkpoint was saved
+        checkpoint.time = self.ranking_time_2
+        self.assertFalse(self.norcal_dao.update_ranking_checkpoint(checkpoint, token=token))
+        self.assertEquals(self.norcal_dao.get_ranking_checkpoint().time, self.ranking_time_1)
+
+    def test_tournament_writes_invalidate_ranking_checkpoint(self):
+        tournament = self._insert_tournament_with_match_ids()
+        checkpoint = RankingCheckpoint(
+            id='norcal',
+            time=self.ranking_time_1,
+            tournaments=[tournament.id],
+            ratings={str(self.player_1_id): Rating(mu=30., sigma=5.)})
+        writes = [
+            lambda: self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(
+                tournament.id, 1, True),
+            lambda: self.norcal_dao.swap_winner_loser_by_tournament_id_and_match_id(
+                tournament.id, 0),
+            lambda: self.norcal_dao.add_match_by_tournament_id(
+                tournament.id, self.player_1_id, self.player_4_id),
+            lambda: self.norcal_dao.update_tournament(
+                self.norcal_dao.get_tournament_by_id(tournament.id)),
+            lambda: self.norcal_dao.delete_tournament(tournament)]
+
+        for write in writes:
+            self.norcal_dao.update_ranking_checkpoint(checkpoint)
+            token = self.norcal_dao.get_ranking_checkpoint_token()
+            write()
+            self.assertIsNone(self.norcal_dao.get_ranking_checkpoint())
+            self.assertNotEquals(self.norcal_dao.get_ranking_checkpoint_token(), token)
+
+    def test_update_and_get_rating_history(self):
+        self.assertIsNone(self.norcal_dao.get_rating_history(self.player_1_id))
+
+        entry_1 = RatingHistoryEntry(tournament=self.tournament_id_1, date=self.tournament_date_1, mu=26., sigma=7.)
+        entry_2 = RatingHistoryEntry(tournament=self.tournament_id_2, date=self.tournament_date_2, mu=27., sigma=6.)
+        self.norcal_dao.update_rating_histories({self.player_1_id: [entry_1]}, [self.tournament_id_1], replace=True)
+        self.assertEquals(self.norcal_dao.get_rating_history(self.player_1_id).history, [entry_1])
+
+        # appending drops entries for the replayed tournaments first
+        self.norcal_dao.update_rating_histories({self.player_1_id: [entry_2]}, [self.tournament_id_2])
+        self.norcal_dao.update_rating_histories({self.player_1_id: [entry_2]}, [self.tournament_id_2])
+        self.assertEquals(self.norcal_dao.get_rating_history(self.player_1_id).history, [entry_1, entry_2])
+        self.assertIsNone(self.norcal_dao.get_rating_history(self.player_2_id))
+
+        self.norcal_dao.update_rating_histories({self.player_2_id: [entry_2]}, [self.tournament_id_2], replace=True)
+        self.assertIsNone(self.norcal_dao.get_rating_history(self.player_1_id))
+        self.assertEquals(self.norcal_dao.get_rating_history(self.player_2_id).region, 'norcal')
+
+    def test_insert_update_and_get_ranking_job(self):
+        job = RankingJob(
+            id=ObjectId(),
+            region='norcal',
+            status='queued',
+            ranking_time=self.ranking_time_1)
+        self.norcal_dao.insert_ranking_job(job)
+        self.assertEquals(self.norcal_dao.get_ranking_job_by_id(job.id), job)
+
+        job.status = 'running'
+        job.tournaments_processed = 3
+        self.norcal_dao.update_ranking_job(job)
+        self.assertEquals(self.norcal_dao.get_ranking_job_by_id(job.id), job)
+
+        self.assertIsNone(self.norcal_dao.get_ranking_job_by_id(ObjectId()))
+
     def test_get_all_users(self):
         users = self.norcal_dao.get_all_users()
         self.assertEquals(len(users), 2)
@@ -0,0 +1,68 @@
+import unittest
+
+from collections import defaultdict
+from mock import Mock
+from pymongo.errors import OperationFailure
+
+import indexes
+import model as M
+
+
+class TestIndexes(unittest.TestCase):
+    def setUp(self):
+        def new_collection():
+            return Mock(**{'index_information.return_value': {'_id_': {}},
+                           'aggregate.return_value': []})
+        self.collections = defaultdict(new_collection)
+        self.mongo_client = {'garpr_test': self.collections}
+
+    def test_index_name(self):
+        self.assertEquals(M.Ranking.indexes[0].name, 'region_1_time_-1')
+        self.assertEquals(M.Player.indexes[0].name, 'aliases_1')
+
+    def test_get_indexed_documents(self):
+        documents = indexes.get_indexed_documents()
+
+        self.assertIn(M.Player, documents)
+        self.assertIn(M.Tournament, documents)
+        self.assertIn(M.Session, documents)
+        self.assertNotIn(M.Region, documents)
+        self.assertNotIn(M.Rating, documents)
+
+    def test_ensure_indexes(self):
+        ensured = indexes.ensure_indexes(self.mongo_client, 'garpr_test')
+
+        self.assertIn(('tournaments', 'players_1'), ensured)
+        self.assertIn(('users', 'username_1'), ensured)
+        self.collections['rankings'].create_index.assert_any_call(
+            [('base', 1)], name='base_1', sparse=True)
+        self.assertEquals(self.collections['players'].create_index.call_count,
+                          len(M.Player.indexes))
+
+    def test_ensure_indexes_background(self):
+        indexes.ensure_indexes(self.mongo_client, 'garpr_test', background=True)
+
+        self.collections['rankings'].create_index.assert_any_call(
+            [('base', 1)], name='base_1', sparse=True, background=True)
+
+    def test_report_indexes(self):
+        self.collections['players'].index_information.return_value = {
+            '_id_': {}, 'aliases_1': {}, 'name_1': {}, 'old_index_1': {}}
+        self.collections['players'].aggregate.return_value = [
+            {'name': '_id_', 'accesses': {'ops': 0}},
+            {'name': 'aliases_1', 'accesses': {'ops': 10}},
+            {'name': 'name_1', 'accesses': {'ops': 0}},
+            {'name': 'old_index_1', 'accesses': {'ops': 0}}]
+        self.collections['users'].index_information.return_value = {'_id_': {}}
+        self.collections['users'].aggregate.side_effect = OperationFailure('unrecognized pipeline stage')
+
+        report = indexes.report_indexes(self.mongo_client, 'garpr_test')
+
+        self.assertEquals(report['players'], {
+            'missing': ['regions_1_merged_1_name_1'],
+            'undeclared': ['old_index_1'],
+            'unused': ['name_1', 'old_index_1']})
+        self.assertEquals(report['users'], {
+            'missing': ['username_1'],
+            'undeclared': [],
+            'unused': None})
@@ -8,6 +8,7 @@ from datetime import datetime
 from model import AliasMapping, AliasMatch, Match, Player, PendingTournament, \
                  Ranking, RankingEntry, Rating, Region, Tournament, User
 
+from orm import ValidationError
 from scraper.challonge import ChallongeScraper
 
 
@@ -175,6 +176,11 @@ class TestPlayer(unittest.TestCase):
         self.assertEqual(self.player_1, Player.load(
             self.player_1_json_dict, context='db'))
 
+    def test_projection(self):
+        self.assertIsNone(Player.projection('db'))
+        self.assertEqual(Player.projection('db', exclude=['aliases', 'ratings']),
+                         {'aliases': 0, 'ratings': 0})
+
 
 class TestTournament(unittest.TestCase):
 
@@ -313,6 +319,12 @@ class TestTournament(unittest.TestCase):
         self.assertEqual(tournament.players, self.player_ids)
         self.assertEqual(tournament.regions, self.regions)
 
+    def test_projection(self):
+        self.assertEqual(Tournament.projection('db', only=('id', 'name', 'date')),
+                         {'_id': 1, 'name': 1, 'date': 1})
+        self.assertEqual(Tournament.projection('web', only=('id', 'name')),
+                         {'id': 1, 'name': 1})
+
     def test_validate_document(self):
         result, msg = self.tournament.validate_document()
         self.assertTrue(result)
@@ -577,6 +589,15 @@ class TestRanking(unittest.TestCase):
     def test_get_ranking_for_player_id_not_found(self):
       self.assertIsNone(self.ranking.get_ranking_for_player_id(ObjectId()))
 
+    def test_get_ranking_for_player_id_after_reassigning_ranking(self):
+      self.assertEqual(
+          self.ranking_entry_1.rank,
+          self.ranking.get_ranking_for_player_id(self.ranking_entry_1.player))
+
+      self.ranking.ranking = [RankingEntry(rank=1, player=self.ranking_entry_2.player, rating=21.)]
+      self.assertIsNone(self.ranking.get_ranking_for_player_id(self.ranking_entry_1.player))
+      self.assertEqual(1, self.ranking.get_ranking_for_player_id(self.ranking_entry_2.player))
+
 
 class TestRankingEntry(unittest.TestCase):
 
@@ -666,3 +687,238 @@ class TestUser(unittest.TestCase):
         self.assertEqual(user.id, self.id)
         self.assertEqual(user.username, self.username)
         self.assertEqual(user.admin_regions, self.admin_regions)
+
+
+def _dump_field_by_field(document, context, exclude=None, only=None):
+    # what dump did before it was compiled
+    d = {}
+    for field_name, field in document.fields:
+        if exclude is not None and field_name in exclude:
+            continue
+        if only is not None and field_name not in only:
+            continue
+        to_name = field_name
+        if isinstance(field.dump_to, dict):
+            to_name = field.dump_to.get(context, field_name)
+        d[to_name] = field.serialize(getattr(document, field_name), context, document)
+    return d
+
+
+def _load_field_by_field(cls, data, context):
+    # what load did before it was compiled
+    init_args = {}
+    for field_name, from_name in cls.fields_to_names(context):
+        field = dict(cls.fields)[field_name]
+        value = field.unserialize(data.get(from_name), context, data)
+        if value is None:
+            value = field.default() if callable(field.default) else field.default
+        init_args[field_name] = value
+    return cls(**init_args)
+
+
+class TestCompiledSerializers(unittest.TestCase):
+
+    def setUp(self):
+        self.player = Player(
+            id=ObjectId(),
+            name=u'gar\xe9',
+            aliases=['gar', 'garr'],
+            ratings={'norcal': Rating(mu=30., sigma=2.), 'texas': Rating()},
+            regions=['norcal'],
+            merged=False)
+        self.tournament = Tournament(
+            id=ObjectId(),
+            name='tournament',
+            type='tio',
+            date=datetime(2016, 3, 4),
+            regions=['norcal'],
+            players=[self.player.id, ObjectId()],
+            matches=[Match(match_id=0, winner=self.player.id, loser=ObjectId(), excluded=True)])
+        self.tournament.players[1] = self.tournament.matches[0].loser
+
+    def test_dump(self):
+        for document in (self.player, self.tournament):
+            for context in ('db', 'web', None):
+                self.assertEqual(document.dump(context=context, validate_on_dump=False),
+                                 _dump_field_by_field(document, context))
+
+    def test_dump_exclude_only(self):
+        self.assertEqual(self.player.dump(context='web', exclude=['aliases']),
+                         _dump_field_by_field(self.player, 'web', exclude=['aliases']))
+        self.assertEqual(self.tournament.dump(context='web', only=('id', 'name', 'date')),
+                         _dump_field_by_field(self.tournament, 'web', only=('id', 'name', 'date')))
+
+    def test_load(self):
+        for document in (self.player, self.tournament):
+            for context in ('db', 'web'):
+                data = document.dump(context=context)
+                self.assertEqual(type(document).load(data, context=context),
+                                 _load_field_by_field(type(document), data, context))
+
+    def test_load_bad_values(self):
+        data = {'_id': 'not an id', 'winner': 'asdf', 'loser': str(ObjectId()),
+                'match_id': 'one', 'excluded': 1}
+        self.assertEqual(Match.load(data, context='web'), _load_field_by_field(Match, data, 'web'))
+        data = {'name': 5, 'aliases': 'abc', 'ratings': ['x'], 'merged': None}
+        self.assertEqual(Player.load(data, context='db'), _load_field_by_field(Player, data, 'db'))
+
+    def test_compiled_functions_are_cached(self):
+        self.assertIs(Player.compiled_dump('web', exclude=['aliases']),
+                      Player.compiled_dump('web', exclude=('aliases',)))
+        self.assertIsNot(Player.compiled_dump('web'), Player.compiled_dump('db'))
+        self.assertIs(Player.compiled_load('db'), Player.compiled_load('db'))
+
+
+class TestTrustedLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.player_1 = ObjectId()
+        self.player_2 = ObjectId()
+        self.data = Tournament(
+            id=ObjectId(),
+            name='tournament',
+            type='tio',
+            date=datetime(2016, 3, 4),
+            regions=['norcal'],
+            players=[self.player_1, self.player_2],
+            matches=[Match(match_id=0, winner=self.player_1, loser=self.player_2)]).dump(context='db')
+
+    def test_load_does_not_validate(self):
+        self.data['players'].append(self.player_1)
+        self.data['orig_ids'] = []
+        with mock.patch.object(Tournament, 'validate') as validate:
+            tournament = Tournament.load(self.data, context='db', trusted=True)
+        self.assertFalse(validate.called)
+        self.assertEquals(tournament.players, [self.player_1, self.player_2, self.player_1])
+
+    def test_changed_fields(self):
+        tournament = Tournament.load(self.data, context='db', trusted=True)
+        self.assertEquals(tournament.changed_fields(), [])
+
+        tournament.name = 'new name'
+        tournament.matches[0].excluded = True
+        self.assertEquals(tournament.changed_fields(), ['name', 'matches'])
+
+        self.assertIsNone(Tournament.load(self.data, context='db').changed_fields())
+
+    def test_data_not_kept(self):
+        tournament = Tournament.load(self.data, context='db', trusted=True, lazy=True)
+        self.assertNotIn(self.data, tournament.__dict__.values())
+        self.assertIsNot(tournament.players, self.data['players'])
+
+        # lazy values aren't kept once they're read
+        tournament.matches
+        self.assertNotIn('matches', tournament._loaded[1])
+        self.assertNotIn('_lazy', tournament.__dict__)
+
+    def test_changed_fields_lazy(self):
+        tournament = Tournament.load(self.data, context='db', trusted=True, lazy=True)
+        self.assertEquals(tournament.changed_fields(), [])
+        tournament.matches[0].excluded = True
+        self.assertEquals(tournament.changed_fields(), ['matches'])
+
+        # set without being read first
+        tournament = Tournament.load(self.data, context='db', trusted=True, lazy=True)
+        tournament.matches = []
+        self.assertEquals(tournament.changed_fields(), ['matches'])
+        with self.assertRaises(ValidationError):
+            tournament.dump(context='db')
+
+    def test_missing_fields_are_changed(self):
+        del self.data['type']
+        tournament = Tournament.load(self.data, context='db', trusted=True)
+        self.assertEquals(tournament.changed_fields(), ['type'])
+        with self.assertRaises(ValidationError):
+            tournament.dump(context='db')
+
+    def test_dump_unchanged_skips_validation(self):
+        web_data = Tournament.load(self.data, context='db').dump(context='web')
+        tournament = Tournament.load(self.data, context='db', trusted=True)
+        with mock.patch.object(Tournament, 'validate_document') as validate_document:
+            self.assertEquals(tournament.dump(context='db'), self.data)
+            self.assertEquals(tournament.dump(context='web'), web_data)
+        self.assertFalse(validate_document.called)
+
+    def test_dump_validates_changed_fields(self):
+        tournament = Tournament.load(self.data, context='db', trusted=True)
+        tournament.name = None
+        with self.assertRaises(ValidationError):
+            tournament.dump(context='db')
+
+        tournament = Tournament.load(self.data, context='db', trusted=True)
+        # changed in place, makes the document as a whole invalid
+        tournament.matches[0].loser = self.player_1
+        with self.assertRaises(ValidationError):
+            tournament.dump(context='db')
+
+    def test_dump_to_web_skips_validation(self):
+        tournament = Tournament.load(self.data, context='db', trusted=True)
+        tournament.name = None
+        with mock.patch.object(Tournament, 'validate') as validate:
+            self.assertIsNone(tournament.dump(context='web')['name'])
+        self.assertFalse(validate.called)
+
+
+class TestSlots(unittest.TestCase):
+
+    def test_embedded_documents_have_no_dict(self):
+        match = Match(match_id=0, winner=ObjectId(), loser=ObjectId())
+        self.assertFalse(hasattr(match, '__dict__'))
+        self.assertFalse(hasattr(Rating(), '__dict__'))
+        with self.assertRaises(AttributeError):
+            match.not_a_field = True
+
+        # documents without use_slots are unchanged
+        player = Player.create_with_default_values('gar', 'norcal')
+        player.not_a_field = True
+
+    def test_load_and_dump(self):
+        data = Match(match_id=0, winner=ObjectId(), loser=ObjectId()).dump(context='db')
+        match = Match.load(data, context='db', trusted=True)
+        self.assertEquals(match.changed_fields(), [])
+        self.assertEquals(match.dump(context='db'), data)
+        self.assertIsNone(Match.load(data, context='db').changed_fields())
+
+
+class TestLazyLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.player_1 = ObjectId()
+        self.player_2 = ObjectId()
+        self.tournament = Tournament(
+            id=ObjectId(),
+            name='tournament',
+            type='tio',
+            date=datetime(2016, 3, 4),
+            regions=['norcal'],
+            players=[self.player_1, self.player_2],
+            matches=[Match(match_id=0, winner=self.player_1, loser=self.player_2)])
+
+    def test_matches_loaded_on_first_access(self):
+        for context in ('db', 'web'):
+            data = self.tournament.dump(context=context)
+            with mock.patch.object(Match, 'compiled_load') as compiled_load:
+                tournament = Tournament.load(data, context=context, trusted=True, lazy=True)
+                self.assertEquals(tournament.name, 'tournament')
+            self.assertFalse(compiled_load.called)
+            self.assertNotIn('matches', tournament.__dict__)
+
+            self.assertEquals(tournament.matches, self.tournament.matches)
+            self.assertIs(tournament.matches, tournament.matches)
+            # the loaded matches aren't kept once they're unserialized
+            self.assertNotIn('_lazy', tournament.__dict__)
+            self.assertEquals(tournament, Tournament.load(data, context=context))
+
+    def test_missing_matches_get_default(self):
+        data = self.tournament.dump(context='db')
+        del data['matches']
+        self.assertEquals(Tournament.load(data, context='db', lazy=True).matches, [])
+
+    def test_set_before_access(self):
+        tournament = Tournament.load(self.tournament.dump(context='db'), context='db', lazy=True)
+        tournament.matches = []
+        self.assertEquals(tournament.matches, [])
+
+    def test_not_lazy(self):
+        tournament = Tournament.load(self.tournament.dump(context='db'), context='db')
+        self.assertIn('matches', tournament.__dict__)
@@ -0,0 +1,70 @@
+import unittest
+
+from bson.objectid import ObjectId
+
+from model import Player
+from player_search import PlayerSearchIndex
+
+
+def _player(name, aliases=None):
+    player = Player.create_with_default_values(name, 'norcal')
+    if aliases:
+        player.aliases.extend(aliases)
+    return player
+
+
+class TestPlayerSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.gar = _player('gar')
+        self.garsh = _player('Garsh')
+        self.dr_z = _player('dr.z')
+        self.zift = _player('Zift')
+        self.laudandus = _player('laudandus')
+        self.ampersand = _player('Ampersand', aliases=['amp'])
+        self.l = _player('l')
+        self.index = PlayerSearchIndex([self.gar, self.garsh, self.dr_z, self.zift,
+                                        self.laudandus, self.ampersand, self.l])
+
+    def test_search_token_prefix(self):
+        self.assertEquals(self.index.search('z'), [self.zift, self.dr_z])
+        self.assertEquals(self.index.search('DR'), [self.dr_z])
+
+    def test_search_substring(self):
+        self.assertEquals(self.index.search('and'), [self.ampersand, self.laudandus])
+        # too short to match inside a name
+        self.assertEquals(self.index.search('an'), [])
+
+    def test_search_alias(self):
+        self.assertEquals(self.index.search('amp'), [self.ampersand])
+
+    def test_search_exact_match_first(self):
+        self.assertEquals(self.index.search('gar'), [self.gar, self.garsh])
+        self.assertEquals(self.index.search('l'), [self.l, self.laudandus])
+
+    def test_search_limit(self):
+        self.assertEquals(self.index.search('gar', limit=1), [self.gar])
+
+    def test_add(self):
+        zeke = _player('zeke')
+        self.index.add(zeke)
+        self.assertEquals(self.index.search('z'), [self.zift, self.dr_z, zeke])
+        self.assertEquals(len(self.index), 8)
+
+    def test_add_replaces_player(self):
+        renamed = Player.load(self.zift.dump(context='db'), context='db')
+        renamed.name = 'Zeal'
+        renamed.aliases = ['zeal']
+        self.index.add(renamed)
+
+        self.assertEquals(self.index.search('zif'), [])
+        self.assertEquals(self.index.search('zea'), [renamed])
+        self.assertEquals(len(self.index), 7)
+
+    def test_remove(self):
+        self.index.remove(self.dr_z.id)
+        self.assertEquals(self.index.search('z'), [self.zift])
+        self.assertEquals(self.index.tokens, sorted(self.index.tokens))
+
+        # removing a player that isn't there is a no-op
+        self.index.remove(ObjectId())
+        self.assertEquals(len(self.index), 6)
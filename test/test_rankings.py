@@ -236,3 +236,214 @@ class TestRankings(unittest.TestCase):
         self.assertEquals(entry.player, self.player_2_id)
         self.assertAlmostEquals(entry.rating, -1.349, delta=delta)
         self.assertEquals(entry.previous_rank, 3)
+
+    def _insert_tournament_3(self):
+        self.tournament_id_3 = ObjectId()
+        self.tournament_3 = Tournament(
+                    type='tio',
+                    date=datetime(2013, 10, 20),
+                    name='tournament 3',
+                    players=[self.player_1_id, self.player_5_id],
+                    matches=[Match(winner=self.player_1_id, loser=self.player_5_id)],
+                    regions=['norcal'],
+                    id=self.tournament_id_3)
+        self.dao.insert_tournament(self.tournament_3)
+
+    def _get_norcal_ratings(self):
+        return {player.id: player.ratings['norcal'] for player in self.dao.get_all_players()}
+
+    def test_generate_rankings_loads_players_in_bulk(self):
+        now = datetime(2013, 10, 17)
+
+        with patch.object(self.dao, 'get_player_by_id') as mock_get_player_by_id, \
+                patch.object(self.dao, 'update_player') as mock_update_player:
+            rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+            self.assertFalse(mock_get_player_by_id.called)
+            self.assertFalse(mock_update_player.called)
+
+        self.assertAlmostEquals(self.dao.get_player_by_id(self.player_5_id).ratings['norcal'].mu,
+                                29.396, delta=delta)
+
+    def test_build_attendance_index(self):
+        attendance_index = rankings._build_attendance_index([self.tournament_1, self.tournament_2])
+
+        self.assertEquals(attendance_index[self.player_1_id], [self.tournament_date_1])
+        self.assertEquals(attendance_index[self.player_2_id],
+                          [self.tournament_date_2, self.tournament_date_1])
+        self.assertEquals(attendance_index[self.player_5_id], [self.tournament_date_2])
+
+    def test_generate_rankings_saves_checkpoint(self):
+        now = datetime(2013, 10, 17)
+
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+
+        checkpoint = self.dao.get_ranking_checkpoint()
+        self.assertEquals(checkpoint.id, self.region_id)
+        self.assertEquals(checkpoint.time, now)
+        self.assertEquals(checkpoint.tournaments, [self.tournament_id_2, self.tournament_id_1])
+        self.assertEquals(len(checkpoint.ratings), 5)
+        self.assertAlmostEquals(checkpoint.ratings[str(self.player_5_id)].mu, 29.396, delta=delta)
+
+    def test_generate_rankings_incremental_only_replays_new_tournaments(self):
+        now = datetime(2013, 10, 21)
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+        self._insert_tournament_3()
+
+        with patch('rankings._replay_tournament', wraps=rankings._replay_tournament) as mock_replay:
+            rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1, incremental=True)
+            self.assertEquals(mock_replay.call_count, 1)
+        incremental_ratings = self._get_norcal_ratings()
+        incremental_ranking = self.dao.get_latest_ranking()
+
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+        full_ratings = self._get_norcal_ratings()
+        full_ranking = self.dao.get_latest_ranking()
+
+        for player_id, rating in full_ratings.items():
+            self.assertAlmostEquals(incremental_ratings[player_id].mu, rating.mu, delta=delta)
+            self.assertAlmostEquals(incremental_ratings[player_id].sigma, rating.sigma, delta=delta)
+        self.assertEquals([e.player for e in incremental_ranking.ranking],
+                          [e.player for e in full_ranking.ranking])
+        self.assertEquals(self.dao.get_ranking_checkpoint().tournaments,
+                          [self.tournament_id_2, self.tournament_id_1, self.tournament_id_3])
+
+    def _get_rating_history(self, player_id):
+        return [(entry.tournament, entry.mu, entry.sigma)
+                for entry in self.dao.get_rating_history(player_id).history]
+
+    def test_generate_rankings_records_history(self):
+        now = datetime(2013, 10, 17)
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1, record_history=True)
+
+        # player 2 played both tournaments, player 1 only the later one
+        history = self.dao.get_rating_history(self.player_2_id).history
+        self.assertEquals([entry.tournament for entry in history],
+                          [self.tournament_id_2, self.tournament_id_1])
+        self.assertEquals([entry.date for entry in history],
+                          [self.tournament_date_2, self.tournament_date_1])
+        self.assertTrue(history[0].mu > history[1].mu)
+        self.assertEquals(history[-1].mu, self.dao.get_player_by_id(self.player_2_id).ratings['norcal'].mu)
+
+        self.assertEquals([entry.tournament for entry in self.dao.get_rating_history(self.player_1_id).history],
+                          [self.tournament_id_1])
+
+        # rerunning replaces the history instead of appending to it
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1, record_history=True)
+        self.assertEquals(len(self.dao.get_rating_history(self.player_2_id).history), 2)
+
+    def test_generate_rankings_incremental_appends_history(self):
+        now = datetime(2013, 10, 21)
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1, record_history=True)
+        self._insert_tournament_3()
+
+        with patch('rankings._replay_tournament', wraps=rankings._replay_tournament) as mock_replay:
+            rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1,
+                                      incremental=True, record_history=True)
+            self.assertEquals(mock_replay.call_count, 1)
+        incremental_history = {player.id: self._get_rating_history(player.id) for player in self.players}
+
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1, record_history=True)
+        full_history = {player.id: self._get_rating_history(player.id) for player in self.players}
+
+        self.assertEquals([entry[0] for entry in full_history[self.player_1_id]],
+                          [self.tournament_id_1, self.tournament_id_3])
+        for player_id, history in full_history.items():
+            self.assertEquals(len(incremental_history[player_id]), len(history))
+            for (tournament, mu, sigma), (full_tournament, full_mu, full_sigma) in \
+                    zip(incremental_history[player_id], history):
+                self.assertEquals(tournament, full_tournament)
+                self.assertAlmostEquals(mu, full_mu, delta=delta)
+                self.assertAlmostEquals(sigma, full_sigma, delta=delta)
+
+    def test_generate_rankings_history_needs_checkpoint_with_history(self):
+        now = datetime(2013, 10, 21)
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+
+        with patch('rankings._replay_tournament', wraps=rankings._replay_tournament) as mock_replay:
+            rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1,
+                                      incremental=True, record_history=True)
+            self.assertEquals(mock_replay.call_count, 2)
+        self.assertTrue(self.dao.get_ranking_checkpoint().history)
+
+    def test_generate_rankings_incremental_full_replay_after_edit(self):
+        now = datetime(2013, 10, 21)
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+        self._insert_tournament_3()
+
+        # excluding a match in an already checkpointed tournament invalidates the checkpoint
+        self.tournament_2.matches[0].excluded = True
+        self.dao.update_tournament(self.tournament_2)
+
+        with patch('rankings._replay_tournament', wraps=rankings._replay_tournament) as mock_replay:
+            rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1, incremental=True)
+            self.assertEquals(mock_replay.call_count, 3)
+        incremental_ratings = self._get_norcal_ratings()
+
+        rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+        full_ratings = self._get_norcal_ratings()
+
+        for player_id, rating in full_ratings.items():
+            self.assertAlmostEquals(incremental_ratings[player_id].mu, rating.mu, delta=delta)
+            self.assertAlmostEquals(incremental_ratings[player_id].sigma, rating.sigma, delta=delta)
+
+    def test_generate_rankings_edit_during_replay_not_checkpointed(self):
+        now = datetime(2013, 10, 21)
+        replay_tournament = rankings._replay_tournament
+
+        def edit_then_replay(rater, tournament, *args):
+            if tournament.id == self.tournament_id_2:
+                self.dao.set_match_exclusion_by_tournament_id_and_match_id(
+                    self.tournament_id_2, 0, True)
+            return replay_tournament(rater, tournament, *args)
+
+        with patch('rankings._replay_tournament', side_effect=edit_then_replay):
+            rankings.generate_ranking(self.dao, now=now, day_limit=30, num_tourneys=1)
+        self.assertIsNone(self.dao.get_ranking_checkpoint())
+
+    def _get_prefix_ranks(self, tournaments, now, tournament_qualified_day_limit=999):
+        # what the ranking to diff against used to be computed from
+        ranking, _ = rankings._create_ranking_from_tournament_list(
+            self.dao, tournaments, now, 45, 1, tournament_qualified_day_limit, None)
+        return {entry.player: entry.rank for entry in ranking.ranking}
+
+    def test_generate_rankings_diff_replays_once(self):
+        now = datetime(2013, 11, 25)
+        ranks_at_tournament_2 = self._get_prefix_ranks([self.tournament_2], self.tournament_date_2)
+
+        with patch('rankings._replay_tournament', wraps=rankings._replay_tournament) as mock_replay:
+            rankings.generate_ranking(self.dao, now=now, day_limit=45, num_tourneys=1,
+                                      tournament_to_diff=self.tournament_2)
+            self.assertEquals(mock_replay.call_count, 2)
+
+        for entry in self.dao.get_latest_ranking().ranking:
+            self.assertEquals(entry.previous_rank, ranks_at_tournament_2.get(entry.player))
+
+    def test_generate_rankings_diff_with_checkpoint_past_diff(self):
+        now = datetime(2013, 11, 25)
+        ranks_at_tournament_2 = self._get_prefix_ranks([self.tournament_2], self.tournament_date_2)
+        rankings.generate_ranking(self.dao, now=datetime(2013, 11, 24), day_limit=45, num_tourneys=1)
+
+        rankings.generate_ranking(self.dao, now=now, day_limit=45, num_tourneys=1,
+                                  tournament_to_diff=self.tournament_2, incremental=True)
+
+        for entry in self.dao.get_latest_ranking().ranking:
+            self.assertEquals(entry.previous_rank, ranks_at_tournament_2.get(entry.player))
+
+    def test_generate_rankings_diff_outside_qualified_window(self):
+        # tournament 2 qualifies for the ranking as of tournament 1, but not
+        # for the ranking as of now, so the diff needs its own replay
+        now = datetime(2013, 11, 25)
+        ranks_at_tournament_1 = self._get_prefix_ranks(
+            [self.tournament_2, self.tournament_1], self.tournament_date_1, tournament_qualified_day_limit=42)
+        self.assertEquals(len(ranks_at_tournament_1), 4)
+
+        with patch('rankings._replay_tournament', wraps=rankings._replay_tournament) as mock_replay:
+            rankings.generate_ranking(self.dao, now=now, day_limit=45, num_tourneys=1,
+                                      tournament_qualified_day_limit=42,
+                                      tournament_to_diff=self.tournament_1)
+            self.assertEquals(mock_replay.call_count, 3)
+
+        ranking = self.dao.get_latest_ranking().ranking
+        self.assertEquals(len(ranking), 3)
+        for entry in ranking:
+            self.assertEquals(entry.previous_rank, ranks_at_tournament_1.get(entry.player))
@@ -28,3 +28,31 @@ class TestRatingCalculators(unittest.TestCase):
 
         self.assertTrue(self.player_2.ratings[self.region_id].mu < 25)
         self.assertTrue(self.player_2.ratings['socal'].mu == 25)
+
+    def test_batch_rater_matches_update_trueskill_ratings(self):
+        player_3 = Player(
+                name='mango',
+                aliases=['mango'],
+                ratings={'norcal': Rating(mu=30., sigma=4.)},
+                id=ObjectId())
+        players = [self.player_1, self.player_2, player_3]
+        matches = [(self.player_1, self.player_2),
+                   (player_3, self.player_1),
+                   (self.player_2, player_3),
+                   (self.player_1, self.player_2),
+                   (player_3, self.player_2)]
+
+        rater = rating_calculators.TrueSkillBatchRater()
+        for player in players:
+            rater.add_player(player.id, player.ratings[self.region_id])
+        rater.rate_matches([winner.id for winner, _ in matches],
+                           [loser.id for _, loser in matches])
+
+        for winner, loser in matches:
+            rating_calculators.update_trueskill_ratings(self.region_id, winner=winner, loser=loser)
+
+        for player in players:
+            self.assertAlmostEquals(rater.get_rating(player.id).mu,
+                                    player.ratings[self.region_id].mu, delta=1e-6)
+            self.assertAlmostEquals(rater.get_rating(player.id).sigma,
+                                    player.ratings[self.region_id].sigma, delta=1e-6)
@@ -12,6 +12,7 @@ from bson.objectid import ObjectId
 from datetime import datetime
 from mock import patch, Mock
 
+import ranking_jobs
 import rankings
 import server
 
@@ -71,7 +72,7 @@ class TestServer(unittest.TestCase):
             norcal_dao.insert_pending_tournament(PendingTournament.from_scraper('tio', scraper, norcal_dao.region_id)[0])
 
         now = datetime(2014, 11, 1)
-        rankings.generate_ranking(norcal_dao, now=now)
+        rankings.generate_ranking(norcal_dao, now=now, record_history=True)
         rankings.generate_ranking(texas_dao, now=now)
 
         user_id = 'asdf'
@@ -107,6 +108,11 @@ class TestServer(unittest.TestCase):
         self.mongo_client_patcher = patch('server.mongo_client', new=mongomock.MongoClient())
         self.mongo_client = self.mongo_client_patcher.start()
 
+        # run ranking jobs inline with run_pending() instead of on a thread
+        self.ranking_job_queue_patcher = patch('server.ranking_job_queue',
+                                               new=ranking_jobs.RankingJobQueue(start_worker=False))
+        self.ranking_job_queue = self.ranking_job_queue_patcher.start()
+        self.addCleanup(self.ranking_job_queue_patcher.stop)
 
         # copy data from globals
         # faster than loading every time
@@ -210,6 +216,33 @@ class TestServer(unittest.TestCase):
         self.assertEquals(len(json_data['players']), 41)
         for_region(json_data, self.texas_dao)
 
+    def test_get_player_list_paged(self):
+        def get_all_pages(url):
+            players = []
+            after = None
+            while True:
+                page_url = url + '&after=' + after if after else url
+                json_data = json.loads(self.app.get(page_url).data)
+                self.assertEquals(set(json_data.keys()), {'players', 'next'})
+                self.assertTrue(len(json_data['players']) <= 10)
+                players.extend(json_data['players'])
+                after = json_data['next']
+                if after is None:
+                    return players
+
+        players = get_all_pages('/norcal/players?limit=10')
+        self.assertEquals(len(players), 65)
+        self.assertEquals([p['name'] for p in players], sorted(p['name'] for p in players))
+        self.assertNotIn('aliases', players[0])
+
+        players = get_all_pages('/norcal/players?all=true&limit=10')
+        self.assertEquals(len(set(p['id'] for p in players)),
+                          len(self.norcal_dao.get_all_players(all_regions=True)))
+
+    def test_get_player_list_invalid_after(self):
+        response = self.app.get('/norcal/players?limit=10&after=asdf')
+        self.assertEquals(response.status_code, 400)
+
     def test_get_player_list_with_alias(self):
         player = self.norcal_dao.get_player_by_alias('gar')
 
@@ -286,6 +319,29 @@ class TestServer(unittest.TestCase):
         json_player = json_data['players'][0]
         self.assertEquals(json_player['name'], 'CT Denti')
 
+    def test_get_player_rating_history(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        data = self.app.get('/norcal/players/' + str(player.id) + '/history').data
+        json_data = json.loads(data)
+
+        self.assertEquals(json_data['player'], str(player.id))
+        self.assertEquals(json_data['region'], 'norcal')
+        self.assertEquals(len(json_data['history']), 2)
+        self.assertEquals(json_data['history'][-1]['mu'], player.ratings['norcal'].mu)
+        self.assertEquals(json_data['history'][-1]['sigma'], player.ratings['norcal'].sigma)
+
+        # texas rankings were generated without history
+        player = self.texas_dao.get_player_by_alias('wobbles')
+        json_data = json.loads(self.app.get('/texas/players/' + str(player.id) + '/history').data)
+        self.assertEquals(json_data['history'], [])
+
+    def test_get_player_rating_history_not_found(self):
+        response = self.app.get('/norcal/players/' + str(ObjectId()) + '/history')
+        self.assertEquals(response.status_code, 404)
+
+        response = self.app.get('/norcal/players/asdf/history')
+        self.assertEquals(response.status_code, 400)
+
     def test_get_player(self):
         player = self.norcal_dao.get_player_by_alias('gar')
         data = self.app.get('/norcal/players/' + str(player.id)).data
@@ -339,6 +395,26 @@ class TestServer(unittest.TestCase):
         data = self.app.get('/texas/tournaments').data
         for_region(data, self.texas_dao)
 
+    @patch('server.get_user_from_request')
+    def test_get_tournament_list_paged(self, mock_get_user_from_request):
+        mock_get_user_from_request.return_value = self.user
+        all_tournaments = json.loads(self.app.get('/norcal/tournaments?includePending=true').data)['tournaments']
+
+        tournaments = []
+        after = None
+        while True:
+            url = '/norcal/tournaments?includePending=true&limit=2'
+            if after:
+                url += '&after=' + after
+            json_data = json.loads(self.app.get(url).data)
+            self.assertEquals(set(json_data.keys()), {'tournaments', 'next'})
+            tournaments.extend(json_data['tournaments'])
+            after = json_data['next']
+            if after is None:
+                break
+
+        self.assertEquals(tournaments, all_tournaments)
+
     @patch('server.get_user_from_request')
     def test_get_tournament_list_include_pending(self, mock_get_user_from_request):
         dao = self.norcal_dao
@@ -945,6 +1021,49 @@ class TestServer(unittest.TestCase):
         self.assertTrue(ranking_entry['rating'] > -3.86)
         self.assertEquals(ranking_entry['previous_rank'], db_ranking_entry.previous_rank)
 
+    def test_get_rankings_etag(self):
+        response = self.app.get('/norcal/rankings')
+        self.assertEquals(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        response = self.app.get('/norcal/rankings', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.data, '')
+
+        response = self.app.get('/norcal/rankings', headers={'If-None-Match': '"something else"'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(json.loads(response.data).keys()), 6)
+
+    def test_get_rankings_etag_changes_with_criteria(self):
+        etag = self.app.get('/norcal/rankings').headers['ETag']
+        self.norcal_dao.update_region_ranking_criteria(
+            'norcal', ranking_num_tourneys_attended=3, ranking_activity_day_limit=90,
+            tournament_qualified_day_limit=999)
+
+        response = self.app.get('/norcal/rankings', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response.headers['ETag'], etag)
+        self.assertEquals(json.loads(response.data)['ranking_criteria']['ranking_num_tourneys_attended'], 3)
+
+    def test_get_rankings_cached(self):
+        self.app.get('/norcal/rankings')
+        with patch.object(Dao, 'get_ranking_view') as mock_get_ranking_view:
+            json_data = json.loads(self.app.get('/norcal/rankings').data)
+            self.assertFalse(mock_get_ranking_view.called)
+        self.assertEquals(len(json_data['ranking']), len(self.norcal_dao.get_latest_ranking().ranking))
+
+    def test_get_rankings_after_rename(self):
+        etag = self.app.get('/norcal/rankings').headers['ETag']
+        player = self.norcal_dao.get_player_by_id(self.norcal_dao.get_latest_ranking().ranking[0].player)
+        player.name = 'someone'
+        self.norcal_dao.update_player(player)
+
+        response = self.app.get('/norcal/rankings', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        json_data = json.loads(response.data)
+        self.assertEquals(json_data['ranking'][0]['id'], str(player.id))
+        self.assertEquals(json_data['ranking'][0]['name'], 'someone')
+
     @patch('server.get_user_from_request')
     @patch('server.datetime')
     def test_post_rankings(self, mock_datetime, mock_get_user_from_request):
@@ -953,8 +1072,16 @@ class TestServer(unittest.TestCase):
         mock_datetime.now.return_value = now
         mock_get_user_from_request.return_value = self.user
 
-        data = self.app.post('/norcal/rankings').data
-        json_data = json.loads(data)
+        response = self.app.post('/norcal/rankings')
+        json_data = json.loads(response.data)
+
+        self.assertEquals(response.status_code, 202)
+        self.assertEquals(json_data['status'], 'queued')
+        self.assertEquals(json_data['region'], 'norcal')
+
+        self.ranking_job_queue.run_pending()
+
+        json_data = json.loads(self.app.get('/norcal/rankings').data)
         db_ranking = self.norcal_dao.get_latest_ranking()
 
         self.assertEquals(now, db_ranking.time)
@@ -974,8 +1101,13 @@ class TestServer(unittest.TestCase):
             'ranking_activity_day_limit': 1,
             'tournament_qualified_day_limit': 999
         }
-        data = self.app.post('/norcal/rankings', data=json.dumps(the_data), content_type='application/json').data
-        json_data = json.loads(data)
+        json_data = json.loads(self.app.post('/norcal/rankings', data=json.dumps(the_data), content_type='application/json').data)
+        self.assertEquals(json_data['num_tourneys'], 3)
+        self.assertEquals(json_data['day_limit'], 1)
+
+        self.ranking_job_queue.run_pending()
+
+        json_data = json.loads(self.app.get('/norcal/rankings').data)
         db_ranking = self.norcal_dao.get_latest_ranking()
 
         self.assertEquals(now, db_ranking.time)
@@ -999,8 +1131,12 @@ class TestServer(unittest.TestCase):
             'tournament_qualified_day_limit': 10000,
             'tournament_id_to_diff': str(tournament_to_diff.id),
         }
-        data = self.app.post('/norcal/rankings', data=json.dumps(the_data), content_type='application/json').data
-        json_data = json.loads(data)
+        json_data = json.loads(self.app.post('/norcal/rankings', data=json.dumps(the_data), content_type='application/json').data)
+        self.assertEquals(json_data['tournament_to_diff'], str(tournament_to_diff.id))
+
+        self.ranking_job_queue.run_pending()
+
+        json_data = json.loads(self.app.get('/norcal/rankings').data)
         db_ranking = self.norcal_dao.get_latest_ranking()
 
         self.assertEquals(now, db_ranking.time)
@@ -1010,6 +1146,109 @@ class TestServer(unittest.TestCase):
         # Spot check to see that we calculated a previous rank.
         self.assertIsNotNone(json_data['ranking'][1])
 
+    @patch('server.get_user_from_request')
+    @patch('server.datetime')
+    def test_post_rankings_coalesces_queued_job(self, mock_datetime, mock_get_user_from_request):
+        mock_datetime.now.return_value = datetime(2014, 11, 2)
+        mock_get_user_from_request.return_value = self.user
+
+        first = json.loads(self.app.post('/norcal/rankings').data)
+        second = json.loads(self.app.post('/norcal/rankings').data)
+        self.assertEquals(first['id'], second['id'])
+
+        self.ranking_job_queue.run_pending()
+
+        third = json.loads(self.app.post('/norcal/rankings').data)
+        self.assertNotEquals(first['id'], third['id'])
+
+    @patch('server.get_user_from_request')
+    @patch('server.datetime')
+    def test_post_rankings_different_parameters(self, mock_datetime, mock_get_user_from_request):
+        mock_datetime.now.return_value = datetime(2014, 11, 2)
+        mock_get_user_from_request.return_value = self.user
+        the_data = {
+            'ranking_num_tourneys_attended': 5,
+            'ranking_activity_day_limit': 1,
+            'tournament_qualified_day_limit': 999
+        }
+
+        # a queued job is updated to the new parameters
+        first = json.loads(self.app.post('/norcal/rankings').data)
+        second = json.loads(self.app.post('/norcal/rankings', data=json.dumps(the_data),
+                                          content_type='application/json').data)
+        self.assertEquals(first['id'], second['id'])
+        self.assertEquals((second['day_limit'], second['num_tourneys']), (1, 5))
+        job = self.norcal_dao.get_ranking_job_by_id(ObjectId(first['id']))
+        self.assertEquals((job.day_limit, job.num_tourneys), (1, 5))
+
+        # a running job gets a follow-up job, unless it has the same parameters
+        self.ranking_job_queue.active_jobs['norcal'].status = 'running'
+        third = json.loads(self.app.post('/norcal/rankings', data=json.dumps(the_data),
+                                         content_type='application/json').data)
+        self.assertEquals(first['id'], third['id'])
+        the_data['ranking_num_tourneys_attended'] = 2
+        fourth = json.loads(self.app.post('/norcal/rankings', data=json.dumps(the_data),
+                                          content_type='application/json').data)
+        self.assertNotEquals(first['id'], fourth['id'])
+        self.assertEquals(fourth['num_tourneys'], 2)
+
+        self.ranking_job_queue.run_pending()
+        self.assertEquals(self.ranking_job_queue.active_jobs, {})
+        for job_id in (first['id'], fourth['id']):
+            json_data = json.loads(self.app.get('/norcal/rankings/jobs/' + job_id).data)
+            self.assertEquals(json_data['status'], 'done')
+
+    @patch('server.get_user_from_request')
+    @patch('server.datetime')
+    def test_post_rankings_failed_job(self, mock_datetime, mock_get_user_from_request):
+        mock_datetime.now.return_value = datetime(2014, 11, 2)
+        mock_get_user_from_request.return_value = self.user
+
+        job_id = json.loads(self.app.post('/norcal/rankings').data)['id']
+        # e.g. the region was deleted while the job was queued
+        with patch('ranking_jobs.Dao', side_effect=AttributeError('no region')):
+            self.ranking_job_queue.run_pending()
+
+        json_data = json.loads(self.app.get('/norcal/rankings/jobs/' + job_id).data)
+        self.assertEquals(json_data['status'], 'failed')
+        self.assertEquals(json_data['error'], 'no region')
+        self.assertEquals(self.ranking_job_queue.active_jobs, {})
+
+        # the next job for the region runs
+        job_id = json.loads(self.app.post('/norcal/rankings').data)['id']
+        self.ranking_job_queue.run_pending()
+        json_data = json.loads(self.app.get('/norcal/rankings/jobs/' + job_id).data)
+        self.assertEquals(json_data['status'], 'done')
+
+    @patch('server.get_user_from_request')
+    @patch('server.datetime')
+    def test_get_ranking_job(self, mock_datetime, mock_get_user_from_request):
+        mock_datetime.now.return_value = datetime(2014, 11, 2)
+        mock_get_user_from_request.return_value = self.user
+
+        job_id = json.loads(self.app.post('/norcal/rankings').data)['id']
+
+        json_data = json.loads(self.app.get('/norcal/rankings/jobs/' + job_id).data)
+        self.assertEquals(json_data['status'], 'queued')
+        self.assertEquals(json_data['tournaments_processed'], 0)
+
+        self.ranking_job_queue.run_pending()
+
+        json_data = json.loads(self.app.get('/norcal/rankings/jobs/' + job_id).data)
+        db_ranking = self.norcal_dao.get_latest_ranking()
+        self.assertEquals(json_data['status'], 'done')
+        self.assertEquals(json_data['ranking'], str(db_ranking.id))
+        self.assertEquals(json_data['tournaments_total'], 2)
+        self.assertEquals(json_data['tournaments_processed'], 2)
+        self.assertTrue(json_data['players_updated'] > 0)
+
+    def test_get_ranking_job_not_found(self):
+        response = self.app.get('/norcal/rankings/jobs/' + str(ObjectId()))
+        self.assertEquals(response.status_code, 404)
+
+        response = self.app.get('/norcal/rankings/jobs/asdf')
+        self.assertEquals(response.status_code, 400)
+
     @patch('server.get_user_from_request')
     def test_post_rankings_permission_denied(self, mock_get_user_from_request):
         mock_get_user_from_request.return_value = self.user
@@ -1121,6 +1360,65 @@ class TestServer(unittest.TestCase):
         self.assertEquals(match['tournament_name'], tournament.name)
         self.assertEquals(match['tournament_date'], tournament.date.strftime("%x"))
 
+    def test_get_matches_paged(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        all_matches = json.loads(self.app.get('/norcal/matches/' + str(player.id)).data)['matches']
+
+        matches = []
+        after = None
+        while True:
+            url = '/norcal/matches/' + str(player.id) + '?limit=3'
+            if after:
+                url += '&after=' + after
+            json_data = json.loads(self.app.get(url).data)
+            self.assertEquals(len(json_data.keys()), 5)
+            self.assertEquals(json_data['wins'], 3)
+            self.assertEquals(json_data['losses'], 4)
+            self.assertTrue(len(json_data['matches']) <= 3)
+            matches.extend(json_data['matches'])
+            after = json_data['next']
+            if after is None:
+                break
+
+        self.assertEquals(matches, all_matches)
+
+    def test_get_matches_never_played(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        tournament = self.norcal_dao.get_all_tournaments(players=[player])[0]
+        opponent_ids = set(m.opponent for m in self.norcal_dao.get_player_matches(player.id))
+        opponent_id = [p for p in tournament.players
+                       if p != player.id and p not in opponent_ids][0]
+        response = self.app.get('/norcal/matches/' + str(player.id) + "?opponent=" + str(opponent_id))
+        self.assertEquals(response.status_code, 200)
+        json_data = json.loads(response.data)
+        self.assertEquals(json_data['matches'], [])
+        self.assertEquals(json_data['wins'], 0)
+        self.assertEquals(json_data['losses'], 0)
+
+    def test_get_matches_no_tournaments(self):
+        player = Player.create_with_default_values('new player', 'norcal')
+        self.norcal_dao.insert_player(player)
+        response = self.app.get('/norcal/matches/' + str(player.id))
+        self.assertEquals(response.status_code, 400)
+
+    def test_get_matches_invalid_after(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        response = self.app.get('/norcal/matches/' + str(player.id) + '?after=asdf')
+        self.assertEquals(response.status_code, 400)
+
+    def test_get_matches_excluded(self):
+        player = self.norcal_dao.get_player_by_alias('gar')
+        opponent = self.norcal_dao.get_player_by_alias('tang')
+        player_match = self.norcal_dao.get_player_matches(player.id, opponent_id=opponent.id)[0]
+        self.norcal_dao.set_match_exclusion_by_tournament_id_and_match_id(
+            player_match.tournament, player_match.match_id, True)
+
+        data = self.app.get('/norcal/matches/' + str(player.id) + "?opponent=" + str(opponent.id)).data
+        json_data = json.loads(data)
+        self.assertEquals(json_data['wins'], 0)
+        self.assertEquals(json_data['losses'], 0)
+        self.assertEquals(json_data['matches'][0]['result'], 'excluded')
+
     @patch('server.get_user_from_request')
     def test_get_current_user(self, mock_get_user_from_request):
         mock_get_user_from_request.return_value = self.user
@@ -1523,7 +1821,8 @@ class TestServer(unittest.TestCase):
         response = self.app.delete('/norcal/players/' + str(player_id))
 
         self.assertEquals(response.status_code, 200)
-        self.assertIsNone(self.norcal_dao.get_player_by_id(player_id))
+        # fresh dao, norcal_dao has the player cached
+        self.assertIsNone(Dao('norcal', mongo_client=self.mongo_client).get_player_by_id(player_id))
 
     @patch('server.get_user_from_request')
     def test_delete_player_still_has_matches(self, mock_get_user_from_request):
@@ -1550,6 +1849,35 @@ class TestServer(unittest.TestCase):
         response = self.app.delete('/norcal/players/' + str(player_id))
         self.assertEquals(response.status_code, 403, msg=response.status_code)
 
+    @patch('server.get_user_from_request')
+    def test_get_merges(self, mock_get_user_from_request):
+        mock_get_user_from_request.return_value = self.user
+        source = Player.create_with_default_values('merge source', 'norcal')
+        self.norcal_dao.insert_player(source)
+        target = self.norcal_dao.get_player_by_alias('gar')
+        self.norcal_dao.insert_merge(Merge(id=ObjectId(),
+                                           requester_user_id=self.user.id,
+                                           source_player_obj_id=source.id,
+                                           target_player_obj_id=target.id,
+                                           time=datetime(2014, 11, 2)))
+
+        json_data = json.loads(self.app.get('/norcal/merges').data)
+
+        self.assertEquals(len(json_data['merges']), 1)
+        self.assertEquals(json_data['merges'][0]['source_player_name'], 'merge source')
+        self.assertEquals(json_data['merges'][0]['target_player_name'], 'gar')
+
+    def test_get_tournament_loads_players_in_bulk(self):
+        tournament = self.norcal_dao.get_all_tournaments(regions=['norcal'])[0]
+        players_col = self.mongo_client[DATABASE_NAME][Player.collection_name]
+
+        with patch.object(players_col, 'find_one', side_effect=AssertionError('players loaded one at a time')):
+            data = self.app.get('/norcal/tournaments/' + str(tournament.id)).data
+        json_data = json.loads(data)
+
+        self.assertEquals(len(json_data['players']), len(tournament.players))
+        self.assertEquals(len(json_data['matches']), len(tournament.matches))
+
     @patch('server.get_user_from_request')
     def test_put_merge(self, mock_get_user_from_request):
         mock_get_user_from_request.return_value = self.user
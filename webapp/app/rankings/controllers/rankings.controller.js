@@ -1,4 +1,4 @@
-angular.module('app.rankings').controller("RankingsController", function($scope, $http, $routeParams, $modal, RegionService, RankingsService, SessionService, TournamentService) {
+angular.module('app.rankings').controller("RankingsController", function($scope, $http, $timeout, $routeParams, $modal, RegionService, RankingsService, SessionService, TournamentService) {
     RegionService.setRegion($routeParams.region);
     $scope.regionService = RegionService;
     $scope.rankingsService = RankingsService
@@ -33,11 +33,32 @@ angular.module('app.rankings').controller("RankingsController", function($scope,
     $scope.confirm = function() {
         $scope.disableButtons = true;
         url = hostname + $routeParams.region + '/rankings';
-        successCallback = function(data) {
-            $scope.rankingsService.rankingsList = data;
-            $scope.modalInstance.close();
+        var failureCallback = function(message) {
+            alert('There was an error generating the rankings' + (message ? ': ' + message : '.'));
             $scope.disableButtons = false;
         };
+        // generation runs as a background job, so poll it until it finishes
+        // and then reload the rankings
+        var pollJob = function(jobId) {
+            $http.get(url + '/jobs/' + jobId).success(function(job) {
+                if (job.status == 'queued' || job.status == 'running') {
+                    $timeout(function() { pollJob(jobId); }, 1000);
+                    return;
+                }
+                if (job.status == 'failed') {
+                    failureCallback(job.error);
+                    return;
+                }
+                $http.get(url).success(function(data) {
+                    $scope.rankingsService.rankingsList = data;
+                    $scope.modalInstance.close();
+                    $scope.disableButtons = false;
+                }).error(failureCallback);
+            }).error(failureCallback);
+        };
+        successCallback = function(job) {
+            pollJob(job.id);
+        };
 
         var postParams = {
             ranking_num_tourneys_attended: $scope.rankingsNumTourneysAttended,
@@ -46,7 +67,7 @@ angular.module('app.rankings').controller("RankingsController", function($scope,
             tournament_id_to_diff: $scope.postData.tournamentToDiff.id
         }
 
-        $scope.sessionService.authenticatedPost(url, postParams, successCallback, angular.noop);
+        $scope.sessionService.authenticatedPost(url, postParams, successCallback, failureCallback);
     };
 
     $scope.cancel = function() {